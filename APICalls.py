@@ -2,30 +2,188 @@ import requests
 import pandas as pd
 import geopandas as gpd
 import os
+import json
+import time
+import hashlib
+import uuid
 import numpy as np
 import zipfile
 from io import BytesIO
+from urllib.parse import urlparse, urlencode
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 try:
 	from config import BEA_KEY,CENSUS_API_KEY
 except:
 	BEA_KEY,CENSUS_API_KEY = None,None
 
-def fetch(url,params=None,nAttempts=5,quietly=True):
+def mirror_path(root,url,params=None):
 	'''
-	Attempts to retrieve the given url until status_code equals 200.
+	Returns the path of the given url (and query parameters) in a local mirror located in root:
+		https://host/a/b.csv  -> root/host/a/b.csv
+		https://host/a/       -> root/host/a/index.html
+	Query parameters (except the API key) are hashed into the file name.
+	'''
+	parsed = urlparse(url)
+	parts = [parsed.netloc]+[p for p in parsed.path.split('/') if p!='']
+	if (parsed.path=='')|(parsed.path.endswith('/')):
+		parts.append('index.html')
+	path = os.path.join(root,*parts)
+	query = ([(k,str(v)) for k,v in sorted(params.items()) if k!='key'] if params is not None else [])
+	if parsed.query!='':
+		query = [('',parsed.query)]+query
+	if len(query)!=0:
+		path = path+'@'+hashlib.md5(urlencode(query).encode()).hexdigest()[:16]
+	return path
+
+def atomic_write(fpath,content):
+	'''
+	Writes the given bytes to fpath through a temporary file, so that fpath is either complete or missing.
+	'''
+	dirname = os.path.dirname(fpath)
+	if (dirname!='')&(not os.path.isdir(dirname)):
+		os.makedirs(dirname,exist_ok=True)
+	# unique temporary name, so that concurrent writers (threads included) never share it
+	tmp_path = '{}.{}.part'.format(fpath,uuid.uuid4().hex)
+	try:
+		with open(tmp_path,'xb') as f:
+			f.write(content)
+		os.replace(tmp_path,fpath)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+class MirrorResponse:
+	'''
+	Minimal response (same attributes as requests.Response used in this module) for files served from a local mirror.
 	'''
-	attempts = 0
-	success = False
-	while (attempts<nAttempts)&(not success):
+	def __init__(self,url,content,status_code=200):
+		self.url = url
+		self.content = content
+		self.status_code = status_code
+
+	@property
+	def text(self):
+		return self.content.decode()
+
+	def json(self):
+		return json.loads(self.content)
+
+class HTTPFetcher:
+	'''
+	Retrieves urls through HTTP, retrying until status_code equals 200.
+
+	Parameters
+	----------
+	nAttempts : int (default=5)
+		Number of attempts for each url. Connection errors also count as failed attempts.
+	backoff : float (default=0.5)
+		Seconds to wait after the first failed attempt, doubled after each failure.
+	timeout : float (default=60)
+		Timeout of each request in seconds (time to connect, and time without receiving data), so that a stalled connection counts as a failed attempt.
+	mirror_dir : str (optional)
+		If provided, the successful responses are also saved in this directory (see mirror_path),
+		so that they can later be served by a LocalMirrorFetcher.
+	'''
+	def __init__(self,nAttempts=5,backoff=0.5,timeout=60,mirror_dir=None):
+		self.nAttempts  = nAttempts
+		self.backoff    = backoff
+		self.timeout    = timeout
+		self.mirror_dir = mirror_dir
+
+	def get(self,url,params=None,nAttempts=None,quietly=True):
+		nAttempts = (self.nAttempts if nAttempts is None else nAttempts)
+		r = None
+		for attempt in range(nAttempts):
+			if not quietly:
+				print(url,'Attempt:',attempt)
+			try:
+				r = requests.get(url,params=params,timeout=self.timeout)
+			except requests.exceptions.RequestException:
+				if attempt==nAttempts-1:
+					raise
+				r = None
+			if (r is not None) and (r.status_code==200):
+				if self.mirror_dir is not None:
+					atomic_write(mirror_path(self.mirror_dir,url,params),r.content)
+				return r
+			if (attempt<nAttempts-1)&(self.backoff>0):
+				time.sleep(self.backoff*2**attempt)
+		return r
+
+class LocalMirrorFetcher:
+	'''
+	Serves urls from a local directory mirror instead of the remote servers (see mirror_path).
+	Urls not found in the mirror get a response with status_code 404.
+
+	Parameters
+	----------
+	root : str
+		Directory of the mirror.
+	'''
+	def __init__(self,root):
+		self.root = root
+
+	def get(self,url,params=None,nAttempts=None,quietly=True):
+		fpath = mirror_path(self.root,url,params)
 		if not quietly:
-			print(url,'Attempt:',attempts)
-		r = requests.get(url,params=params)
-		if r.status_code==200:
-			success=True
-		else:
-			attempts+=1
-	return r
+			print(url,'->',fpath)
+		if not os.path.isfile(fpath):
+			return MirrorResponse(url,b'',status_code=404)
+		with open(fpath,'rb') as f:
+			return MirrorResponse(url,f.read())
+
+FETCHER = HTTPFetcher()
+
+def set_fetcher(fetcher):
+	'''
+	Sets the fetcher used by all the calls in this module (e.g. LocalMirrorFetcher(root) to work from a local mirror).
+	'''
+	global FETCHER
+	FETCHER = fetcher
+
+def fetch(url,params=None,nAttempts=None,quietly=True,fetcher=None):
+	'''
+	Attempts to retrieve the given url until status_code equals 200.
+	Uses the given fetcher, or the one set with set_fetcher (HTTPFetcher by default).
+	If nAttempts is not provided, the number of attempts of the fetcher is used.
+	'''
+	fetcher = (FETCHER if fetcher is None else fetcher)
+	return fetcher.get(url,params=params,nAttempts=nAttempts,quietly=quietly)
+
+def download_files(files,n_workers=8,fetcher=None,quietly=True):
+	'''
+	Downloads several files concurrently, with at most n_workers requests at a time.
+	Each file is written atomically, and files that already exist are not downloaded again, 
+	so an interrupted download can be resumed by calling this function again.
+
+	Parameters
+	----------
+	files : list
+		List of (url, path) tuples.
+
+	Returns
+	-------
+	paths : list
+		Path of each file, or None if the file could not be downloaded.
+	'''
+	def download(url_path):
+		url,fpath = url_path
+		if os.path.isfile(fpath):
+			return fpath
+		try:
+			r = fetch(url,quietly=quietly,fetcher=fetcher)
+		except requests.exceptions.RequestException as e:
+			qprint('Failed to download {}: {}'.format(url,e),quietly)
+			return None
+		if r.status_code!=200:
+			qprint('Failed to download {}: status {}'.format(url,r.status_code),quietly)
+			return None
+		atomic_write(fpath,r.content)
+		return fpath
+	with ThreadPoolExecutor(max_workers=n_workers) as executor:
+		return list(executor.map(download,files))
 
 def qprint(s,quietly):
 	print((s if not quietly else ''),end=('' if quietly else '\n'))
@@ -124,7 +282,7 @@ def ZBPCall(zipcodeList=None,NAICS_lvl=None,query=None,base_url = 'https://api.c
 	return df
 
 
-def ACSCall(varNames,level='tract',groupName=None,year=2018,API_KEY=CENSUS_API_KEY,base_url = 'https://api.census.gov/data/{}/acs/acs5',extension='',quietly=True,someStates=False):
+def ACSCall(varNames,level='tract',groupName=None,year=2018,API_KEY=CENSUS_API_KEY,base_url = 'https://api.census.gov/data/{}/acs/acs5',extension='',quietly=True,someStates=False,n_workers=8,cache_dir=None):
 	'''
 	Calls American Commnuity Survey API:
 	https://api.census.gov/data/2018/acs/acs5.html
@@ -154,6 +312,11 @@ def ACSCall(varNames,level='tract',groupName=None,year=2018,API_KEY=CENSUS_API_K
 		Variables that start with 'S' are usually found in the subject API.
 	quietly : boolean (default=True)
 		If false it will print progress. Used for debugging.
+	n_workers : int (default=8)
+		Maximum number of concurrent requests when the data is requested state by state.
+	cache_dir : str (optional)
+		If provided, the response of each state is saved in this directory (see mirror_path) and reused in later calls,
+		so an interrupted call can be resumed.
 
 	Returns
 	-------
@@ -176,18 +339,26 @@ def ACSCall(varNames,level='tract',groupName=None,year=2018,API_KEY=CENSUS_API_K
 	base_url = base_url+'/'+extension
 
 	if len(states)!=0:
-		out = []
-		for s in states:
+		def state_call(s):
 			qprint(s,quietly)
 			if groupName is None:
 				query = {'get':','.join(varNames),'for':'{}:*'.format(level),'in':'state:{}'.format(s),'key':API_KEY}
 			else:
 				query = {'get':'group({})'.format(groupName),'for':'{}:*'.format(level),'in':'state:{}'.format(s),'key':API_KEY}
-			r = fetch(base_url,params=query)
-			qprint(r.url,quietly)
-			qprint(r.status_code,quietly)
-			df = pd.DataFrame(r.json()[1:],columns=r.json()[0])
-			out.append(df)
+			fpath = (mirror_path(cache_dir,base_url,query) if cache_dir is not None else None)
+			if (fpath is not None) and os.path.isfile(fpath):
+				with open(fpath,'rb') as f:
+					data = json.loads(f.read())
+			else:
+				r = fetch(base_url,params=query)
+				qprint(r.url,quietly)
+				qprint(r.status_code,quietly)
+				data = r.json()
+				if fpath is not None:
+					atomic_write(fpath,r.content)
+			return pd.DataFrame(data[1:],columns=data[0])
+		with ThreadPoolExecutor(max_workers=n_workers) as executor:
+			out = list(executor.map(state_call,sorted(states)))
 		out = pd.concat(out,sort=True)
 	else:
 		if groupName is None:
@@ -289,9 +460,36 @@ def patentsViewDownload(tableName):
 	For a list of available tables, run:
 	> patentsViewListTables()
 	'''
-	table_url = patentsViewLatest(tableName=tableName)
-	table = pd.read_csv(table_url, compression='zip', header=0, sep=',', quotechar='"',delimiter='\t')
-	return table
+	return patentsViewRead(tableName)
+
+def patentsViewRead(tableName,usecols=None,dtype=None,chunksize=None,local_dir=None):
+	'''
+	Reads the given table from patentsView (see patentsViewDownload), or from a local copy of the dumps.
+
+	Parameters
+	----------
+	tableName : str
+		Name of the table (see patentsViewListTables).
+	usecols : list (optional)
+		Columns to read. 
+	dtype : dict (optional)
+		Type of the columns, passed to pandas.read_csv.
+	chunksize : int (optional)
+		If provided, returns an iterator over chunks of chunksize rows instead of the full table.
+	local_dir : str (optional)
+		Directory with the dumps as downloaded from https://www.patentsview.org/download/ 
+		(tableName.tsv.zip or tableName.tsv). If provided, the table is read from this directory.
+	'''
+	if local_dir is None:
+		source = patentsViewLatest(tableName=tableName)
+	else:
+		sources = [os.path.join(local_dir,tableName+extension) for extension in ['.tsv.zip','.tsv','.zip']]
+		sources = [source for source in sources if os.path.isfile(source)]
+		if len(sources)==0:
+			raise NameError('Table {} not found in {}'.format(tableName,local_dir))
+		source = sources[0]
+	compression = ('zip' if source.endswith('.zip') else None)
+	return pd.read_csv(source,compression=compression,header=0,quotechar='"',delimiter='\t',usecols=usecols,dtype=dtype,chunksize=chunksize)
 
 def load_zipped_excel(url,fname):
 	'''
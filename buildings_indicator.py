@@ -38,10 +38,11 @@ import numpy as np
 import json
 import pandas as pd
 from pprint import pprint
-import pickle
 import urllib
 import matplotlib.pyplot as plt
 from indicator_tools import fit_rf_regressor, flatten_grid_cell_attributes
+from compiled_models import try_compile_forest
+from model_registry import MODEL_REGISTRY
 import operator
 
 pba_to_lbcs={
@@ -66,6 +67,21 @@ pba_to_lbcs={
         26: '4300', # service = utilities?
         91: '9000'
         }
+def grid_max_floors(geogrid_props, default=30):
+    '''
+    Returns the largest height allowed by the types of the grid, 
+    or the default (the top-coded floor count of the training data) if the types do not define heights.
+    '''
+    heights=[]
+    for type_def in geogrid_props.get('types', {}).values():
+        if isinstance(type_def, dict) and (type_def.get('height') is not None):
+            height=type_def['height']
+            heights.extend(height if isinstance(height, list) else [height])
+    heights=[h for h in heights if isinstance(h, (int, float))]
+    if len(heights)==0:
+        return default
+    return int(max(max(heights), 1))
+
 def year_con_to_age(year_con, base_year):
     if year_con==995:
         return 100
@@ -149,8 +165,10 @@ class BuildingsIndicator(Indicator):
         with urllib.request.urlopen(GEOGRID_loc) as url:
             geogrid=json.loads(url.read().decode())
         self.cell_size=geogrid['properties']['header']['cellSize']
+        self.max_floors=kwargs.get('max_floors', grid_max_floors(geogrid['properties']))
         self.max_result_per_worker=100000
         self.min_result_per_worker=50000
+        self.energy_lookup=None
                 
     def train(self):
         comm_data=pd.read_csv(self.train_data_loc+'/2012_public_use_data_aug2016.csv')
@@ -180,33 +198,75 @@ class BuildingsIndicator(Indicator):
 #        self.min_result_per_worker=min(comm_model_df['MFBTU']/comm_model_df['NWKER'])
         model_object={'model': self.comm_model, 'features': self.comm_model_features,
                       'max': self.max_result_per_worker, 'min': self.min_result_per_worker}
-        pickle.dump(model_object, open(self.fitted_model_object_loc, 'wb'))
+        MODEL_REGISTRY.dump(model_object, self.fitted_model_object_loc)
                
         
-    def load_module(self):
+    def watched_files(self):
+        return [self.fitted_model_object_loc]
+
+    def prepare_reload(self):
+        # a model that fails to load during a reload is an error, not a reason to train
+        return Indicator.prepare_reload(self, train=False)
+
+    def load_module(self, train=True):
         print('loading')
         try:
-            fitted_comm_model=pickle.load(open(self.fitted_model_object_loc, 'rb'))
-            self.comm_model=fitted_comm_model['model']
-            self.comm_model_features=fitted_comm_model['features']  
+            # the random forest is evaluated with numpy (see compiled_models.CompiledForest) and shared through the registry
+            self.comm_model, self.comm_model_features=MODEL_REGISTRY.get(self.fitted_model_object_loc, 'forest', table=self.table_name)
 #            self.max_result_per_worker=fitted_comm_model['max'] 
 #            self.min_result_per_worker=fitted_comm_model['min'] 
-        except:
+        except FileNotFoundError:
+            if not train:
+                raise
             print('Model not yet trained. Training now')
             self.train()
+            self.comm_model=try_compile_forest(self.comm_model, self.comm_model_features, name='commercial energy model')
+        self.build_energy_lookup()
+
+    def build_energy_lookup(self, max_floors=None):
+        '''
+        Precomputes the model prediction for every commercial LBCS class and floor count.
+        The model only sees the main LBCS code and the height of the cell (SQM follows from the height and AGE is always 0),
+        so return_indicator can look predictions up instead of calling the model.
+        The table is rebuilt when the Handler reloads the model (see watched_files).
+
+        Parameters
+        ----------
+        max_floors : int (optional)
+            Largest floor count in the table. Defaults to self.max_floors.
+        '''
+        if max_floors is None:
+            max_floors=self.max_floors
+        self.comm_model_lbcs=[feat.split('_')[1] for feat in self.comm_model_features if 'LBCS' in feat]
+        self.lbcs_to_lookup_row={lbcs: i for i, lbcs in enumerate(self.comm_model_lbcs)}
+        floors=np.arange(max_floors+1)
+        X=pd.DataFrame(0, index=range(len(self.comm_model_lbcs)*len(floors)), columns=self.comm_model_features)
+        X['NFLOOR']=np.tile(floors, len(self.comm_model_lbcs))
+        X['SQM']=self.cell_size*self.cell_size*X['NFLOOR']
+        for i, lbcs in enumerate(self.comm_model_lbcs):
+            X.loc[i*len(floors):(i+1)*len(floors)-1, 'LBCS_{}'.format(lbcs)]=1
+        self.energy_lookup=self.comm_model.predict(X[self.comm_model_features]).reshape(len(self.comm_model_lbcs), len(floors))
+
+    def predict_energy(self, lbcs_rows, floors):
+        '''
+        Returns the model prediction for each building, given its row in the lookup table and its floor count.
+        Floor counts above the table are added to it first.
+        '''
+        floors=np.asarray(floors, dtype=int)
+        if floors.max()>=self.energy_lookup.shape[1]:
+            self.build_energy_lookup(max_floors=int(floors.max()))
+        return self.energy_lookup[np.asarray(lbcs_rows, dtype=int), floors]
                    
     def return_indicator(self, geogrid_data):
-        comm_blds_list=[]
-        comm_model_lbcs=[feat.split('_')[1] for feat in self.comm_model_features if 'LBCS' in feat]
+        lbcs_rows=[]
+        floors=[]
+        workers=[]
         for grid_cell in geogrid_data:
             height=grid_cell['height']
             if isinstance(height, list):
                 height=height[-1]
             if ((height>0) and (grid_cell['name'] in self.types_def) and (not grid_cell['name'] =='Park')):
                 # if there is actually a building here
-                this_bld={feat:0 for feat in self.comm_model_features}
-    #            if grid_cell["name"] in ['Office', 'Office Tower', 'Mix-Use', 'Retail']:                
-    #                this_bld['LBCS_2300']=1
                 all_lbcs=flatten_grid_cell_attributes(
                             type_def=self.types_def[grid_cell['name']], height=grid_cell['height'],
                             attribute_name='LBCS', area_per_floor=self.geogrid_header['cellSize']**2)
@@ -215,19 +275,14 @@ class BuildingsIndicator(Indicator):
                     # if there is any LBCS code
                     main_lbcs=max(all_lbcs.items(), key=operator.itemgetter(1))[0]
                     main_lbcs_2_digit=main_lbcs[:2]+'00'
-                    this_bld['LBCS_{}'.format(str(main_lbcs_2_digit))]=1
-                    this_bld['NFLOOR']=height
-                    this_bld['SQM']=self.cell_size*self.cell_size*this_bld['NFLOOR']
-                    if main_lbcs_2_digit in comm_model_lbcs:  
+                    if main_lbcs_2_digit in self.lbcs_to_lookup_row:  
                         # if the main use is commercial
-                        this_bld['NWKER']=all_people
-                        comm_blds_list.append(this_bld)
-        if len(comm_blds_list)>0:
-            X_df=pd.DataFrame.from_dict(comm_blds_list)
-            X=X_df[self.comm_model_features]
-            X_df['pred']=self.comm_model.predict(X)
-#            X_df['energy_per_worker']=X_df['pred']/X_df['NWKER']
-            avg_energy_per_worker=sum(X_df['pred'])/sum(X_df['NWKER'])
+                        lbcs_rows.append(self.lbcs_to_lookup_row[main_lbcs_2_digit])
+                        floors.append(height)
+                        workers.append(all_people)
+        if len(lbcs_rows)>0:
+            pred=self.predict_energy(lbcs_rows, floors)
+            avg_energy_per_worker=pred.sum()/sum(workers)
             norm_avg_energy_per_worker=(avg_energy_per_worker-self.min_result_per_worker
                                         )/(self.max_result_per_worker-self.min_result_per_worker)
             norm_avg_energy_per_worker=1-max(0, min(1, norm_avg_energy_per_worker)) 
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pure numpy evaluators for fitted sklearn models.
+
+compile_pipeline flattens the pipelines trained in train_InnoIndicator:
+    FactorExtractor -> ColumnTransformer([
+        ('num', Pipeline([SimpleImputer, StandardScaler, PolynomialFeatures]), numeric_features),
+        ('cat', Pipeline([SimpleImputer(constant), OneHotEncoder]), categorical_features)
+    ]) -> Lasso (or any linear model with coef_ and intercept_)
+into a CompiledLinearPipeline that only evaluates the terms with non-zero coefficients.
+
+compile_forest flattens a fitted sklearn RandomForestRegressor (or any forest of DecisionTreeRegressors with one output)
+into a CompiledForest, stored as one array of nodes that can be memory mapped (see load_forest).
+"""
+import os
+import json
+import pickle
+from io import BytesIO
+from warnings import warn
+import numpy as np
+import pandas as pd
+
+from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import StandardScaler, OneHotEncoder, PolynomialFeatures
+
+from indicator_tools import file_fingerprint
+from APICalls import atomic_write
+
+
+class CompiledLinearPipeline:
+    '''
+    Numpy evaluator of a fitted linear pipeline (see compile_pipeline).
+
+    Parameters
+    ----------
+    features : list
+        Input columns of the pipeline (the columns selected by the FactorExtractor).
+    numeric_blocks : list
+        One dict per numeric transformer with:
+            columns: indices of the input columns used by the block
+            fill: value used for the missing values of each column
+            keep: boolean mask of the columns kept after the imputation
+            mean, scale: standard scaling of the kept columns
+            terms: array (n_terms x degree) of indices of the columns multiplied in each term (-1 for a constant 1)
+            coefs: coefficient of each term
+    categorical_blocks : list
+        One dict per categorical transformer with:
+            columns: indices of the input columns used by the block
+            fill: value used for the missing values of each column
+            categories: list with the categories of each column
+            coefs: list with the coefficient of each category of each column
+    intercept : float
+    '''
+    def __init__(self, features, numeric_blocks, categorical_blocks, intercept):
+        self.features = list(features)
+        self.feature_index = {f: i for i, f in enumerate(self.features)}
+        self.numeric_blocks = numeric_blocks
+        self.categorical_blocks = categorical_blocks
+        self.intercept = intercept
+        self.numeric_columns = sorted(set([c for block in numeric_blocks for c in block['columns']]))
+        self.categorical_columns = sorted(set([c for block in categorical_blocks for c in block['columns']]))
+        numeric_position = {c: i for i, c in enumerate(self.numeric_columns)}
+        categorical_position = {c: i for i, c in enumerate(self.categorical_columns)}
+        for block in numeric_blocks:
+            block['positions'] = np.array([numeric_position[c] for c in block['columns']], dtype=int)
+        for block in categorical_blocks:
+            block['positions'] = [categorical_position[c] for c in block['columns']]
+        self.numeric_features = [self.features[c] for c in self.numeric_columns]
+        self.categorical_features = [self.features[c] for c in self.categorical_columns]
+
+    def n_terms(self):
+        '''
+        Returns the number of terms with a non-zero coefficient.
+        '''
+        return sum([len(block['coefs']) for block in self.numeric_blocks])+sum(
+            [len(coefs) for block in self.categorical_blocks for coefs in block['coefs']])
+
+    def _to_arrays(self, X):
+        '''
+        Converts the input to a float array with the numeric columns and an object array with the categorical columns.
+        X can be a DataFrame, a dict (one row), a list of dicts, or a 2-D array with the columns in self.features.
+        Missing columns are treated as missing values (same as the FactorExtractor).
+        '''
+        if isinstance(X, dict):
+            X = [X]
+        n_rows = len(X)
+        if isinstance(X, pd.DataFrame):
+            numeric = X.reindex(columns=self.numeric_features).to_numpy(dtype=float)
+            categorical = X.reindex(columns=self.categorical_features).to_numpy(dtype=object)
+        elif isinstance(X, (list, tuple)) and all([isinstance(row, dict) for row in X]):
+            numeric = np.array([[row.get(f, np.nan) for f in self.numeric_features] for row in X], dtype=float)
+            categorical = np.array([[row.get(f, np.nan) for f in self.categorical_features] for row in X], dtype=object)
+        else:
+            X = np.asarray(X)
+            if X.ndim==1:
+                X = X.reshape(1, -1)
+            n_rows = len(X)
+            if X.shape[1]!=len(self.features):
+                raise NameError('Input should have {} columns, got {}'.format(len(self.features), X.shape[1]))
+            numeric = X[:, self.numeric_columns].astype(float)
+            categorical = X[:, self.categorical_columns].astype(object)
+        return numeric.reshape(n_rows, len(self.numeric_columns)), categorical.reshape(n_rows, len(self.categorical_columns))
+
+    def predict(self, X):
+        '''
+        Returns the prediction for each row of X (see _to_arrays for the accepted inputs).
+        '''
+        numeric, categorical = self._to_arrays(X)
+        n_rows = len(numeric)
+        prediction = np.full(n_rows, self.intercept, dtype=float)
+        for block in self.numeric_blocks:
+            values = numeric[:, block['positions']]
+            values = np.where(np.isnan(values), block['fill'], values)[:, block['keep']]
+            values = (values-block['mean'])/block['scale']
+            # the last column is the constant used by the terms of degree lower than the polynomial degree
+            values = np.hstack((values, np.ones((n_rows, 1))))
+            terms = np.prod(values[:, block['terms']], axis=2)
+            prediction += terms.dot(block['coefs'])
+        for block in self.categorical_blocks:
+            for position, fill, categories, coefs in zip(block['positions'], block['fill'], block['categories'], block['coefs']):
+                column = [fill if is_missing(v) else v for v in categorical[:, position]]
+                for category, coef in zip(categories, coefs):
+                    prediction += coef*np.array([v==category for v in column], dtype=float)
+        return prediction
+
+    def gradient(self, X):
+        '''
+        Returns the derivative of the prediction with respect to each input feature (columns, in the order of self.features)
+        for each row of X. Missing values are imputed, so their derivative is 0, as is the derivative of categorical features.
+        '''
+        numeric, _ = self._to_arrays(X)
+        n_rows = len(numeric)
+        gradient = np.zeros((n_rows, len(self.features)))
+        for block in self.numeric_blocks:
+            raw = numeric[:, block['positions']]
+            observed = ~np.isnan(raw)
+            values = np.where(observed, raw, block['fill'])[:, block['keep']]
+            values = (values-block['mean'])/block['scale']
+            values = np.hstack((values, np.ones((n_rows, 1))))
+            n_kept = values.shape[1]-1
+            block_gradient = np.zeros((n_rows, n_kept+1))
+            terms = block['terms']
+            # derivative of each term with respect to the column at each position: the product of the other positions
+            for p in range(terms.shape[1]):
+                others = np.prod(values[:, np.delete(terms, p, axis=1)], axis=2) if terms.shape[1]>1 else np.ones((n_rows, len(terms)))
+                np.add.at(block_gradient.T, terms[:, p], (others*block['coefs']).T)
+            block_gradient = block_gradient[:, :n_kept]/block['scale']
+            kept_columns = np.array(block['columns'])[block['keep']]
+            gradient[:, kept_columns] += block_gradient*observed[:, block['keep']]
+        return gradient
+
+    def predict_one(self, row):
+        '''
+        Returns the prediction for a single row given as a dict {feature: value}.
+        '''
+        return float(self.predict(row)[0])
+
+    def verify(self, pipeline, X, rtol=1e-7, atol=1e-9):
+        '''
+        Returns True if the compiled model gives the same predictions as the pipeline for X (a DataFrame).
+        '''
+        return np.allclose(self.predict(X), np.asarray(pipeline.predict(X), dtype=float).ravel(), rtol=rtol, atol=atol)
+
+    def sample_inputs(self):
+        '''
+        Returns a DataFrame with a few rows built from the fitted imputation values, useful to verify the compiled model.
+        '''
+        fill = {}
+        for block in self.numeric_blocks:
+            for c, v in zip(block['columns'], block['fill']):
+                fill[self.features[c]] = v
+        for block in self.categorical_blocks:
+            for c, categories in zip(block['columns'], block['categories']):
+                fill[self.features[c]] = categories[0] if len(categories)!=0 else np.nan
+        rows = [dict(fill)]
+        for scale in [0.5, 2]:
+            rows.append({f: (v*scale if (isinstance(v, float) and not np.isnan(v)) else v) for f, v in fill.items()})
+        rows.append({})
+        return pd.DataFrame(rows, columns=self.features)
+
+
+def is_missing(value):
+    try:
+        return value is None or np.isnan(value)
+    except TypeError:
+        return False
+
+
+def _transformer_steps(transformer):
+    if isinstance(transformer, Pipeline):
+        return [step for _, step in transformer.steps if step not in [None, 'passthrough']]
+    return [transformer]
+
+
+def _compile_numeric_block(columns, steps, coefs):
+    '''
+    Compiles a sequence of SimpleImputer, StandardScaler and PolynomialFeatures (in this order, all optional).
+    Returns the block and the number of coefficients it uses.
+    '''
+    n = len(columns)
+    fill = np.full(n, np.nan)
+    keep = np.ones(n, dtype=bool)
+    mean, scale = np.zeros(n), np.ones(n)
+    powers = None
+    order = {SimpleImputer: 0, StandardScaler: 1, PolynomialFeatures: 2}
+    last = -1
+    for step in steps:
+        if type(step) not in order or order[type(step)]<=last:
+            raise NameError('Cannot compile numeric step: {}'.format(step))
+        last = order[type(step)]
+        if isinstance(step, SimpleImputer):
+            if step.strategy=='constant':
+                fill = np.full(n, float(step.fill_value if step.fill_value is not None else 0))
+            else:
+                fill = np.asarray(step.statistics_, dtype=float)
+                # columns without any value in the training data are dropped by the imputer
+                if not getattr(step, 'keep_empty_features', False):
+                    keep = ~np.isnan(fill)
+        elif isinstance(step, StandardScaler):
+            n_kept = keep.sum()
+            mean = np.asarray(step.mean_, dtype=float) if (step.with_mean and step.mean_ is not None) else np.zeros(n_kept)
+            scale = np.asarray(step.scale_, dtype=float) if (step.with_std and step.scale_ is not None) else np.ones(n_kept)
+        elif isinstance(step, PolynomialFeatures):
+            powers = np.asarray(step.powers_, dtype=int)
+    n_kept = keep.sum()
+    if len(mean)!=n_kept:
+        mean, scale = np.zeros(n_kept), np.ones(n_kept)
+    if powers is None:
+        powers = np.eye(n_kept, dtype=int)
+    block_coefs = coefs[:len(powers)]
+    degree = max(1, powers.sum(axis=1).max()) if len(powers)!=0 else 1
+    terms, term_coefs = [], []
+    for power, coef in zip(powers, block_coefs):
+        if coef==0:
+            continue
+        indices = [i for i, p in enumerate(power) for _ in range(p)]
+        terms.append(indices+[-1]*(degree-len(indices)))
+        term_coefs.append(coef)
+    block = {'columns': list(columns), 'fill': fill, 'keep': keep, 'mean': mean, 'scale': scale,
+             'terms': np.array(terms, dtype=int).reshape(-1, degree), 'coefs': np.array(term_coefs, dtype=float)}
+    return block, len(powers)
+
+
+def _compile_categorical_block(columns, steps, coefs):
+    '''
+    Compiles an optional SimpleImputer(strategy='constant') followed by a OneHotEncoder.
+    Returns the block and the number of coefficients it uses.
+    '''
+    fill = [np.nan]*len(columns)
+    encoder = None
+    for step in steps:
+        if isinstance(step, SimpleImputer) and encoder is None:
+            if step.strategy=='constant':
+                fill = [step.fill_value if step.fill_value is not None else 0]*len(columns)
+            else:
+                fill = list(step.statistics_)
+        elif isinstance(step, OneHotEncoder):
+            encoder = step
+        else:
+            raise NameError('Cannot compile categorical step: {}'.format(step))
+    if encoder is None:
+        raise NameError('Categorical block without OneHotEncoder')
+    if getattr(encoder, 'drop_idx_', None) is not None:
+        raise NameError('Cannot compile OneHotEncoder with drop')
+    if encoder.handle_unknown not in ['ignore', 'infrequent_if_exist']:
+        raise NameError('Cannot compile OneHotEncoder with handle_unknown={}'.format(encoder.handle_unknown))
+    if getattr(encoder, 'infrequent_categories_', None) is not None and any(
+            [c is not None for c in encoder.infrequent_categories_]):
+        raise NameError('Cannot compile OneHotEncoder with infrequent categories')
+    categories, block_coefs = [], []
+    start = 0
+    for column_categories in encoder.categories_:
+        column_coefs = coefs[start:start+len(column_categories)]
+        start += len(column_categories)
+        categories.append([c for c, coef in zip(column_categories, column_coefs) if coef!=0])
+        block_coefs.append([coef for coef in column_coefs if coef!=0])
+    return {'columns': list(columns), 'fill': fill, 'categories': categories, 'coefs': block_coefs}, start
+
+
+def compile_pipeline(pipeline):
+    '''
+    Flattens a fitted pipeline into a CompiledLinearPipeline.
+    Raises a NameError if the pipeline contains steps that cannot be compiled.
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Fitted pipeline with an optional column selector (any step with a factor attribute, like FactorExtractor),
+        a ColumnTransformer and a linear model with coef_ and intercept_.
+    '''
+    steps = [step for _, step in pipeline.steps]
+    features = None
+    if hasattr(steps[0], 'factor'):
+        features = list(steps[0].factor)
+        steps = steps[1:]
+    if len(steps)!=2 or not isinstance(steps[0], ColumnTransformer):
+        raise NameError('Pipeline should have a ColumnTransformer followed by a linear model')
+    preprocessor, model = steps
+    coefs = np.asarray(model.coef_, dtype=float)
+    if coefs.ndim>1:
+        if coefs.shape[0]!=1:
+            raise NameError('Only models with one output can be compiled')
+        coefs = coefs[0]
+    intercept = float(np.ravel(model.intercept_)[0]) if np.ndim(model.intercept_)>0 else float(model.intercept_)
+
+    if features is None:
+        features = [c for _, _, columns in preprocessor.transformers_ if isinstance(columns, list) for c in columns]
+    feature_index = {f: i for i, f in enumerate(features)}
+
+    numeric_blocks, categorical_blocks = [], []
+    start = 0
+    for name, transformer, columns in preprocessor.transformers_:
+        if transformer=='drop' or (name=='remainder' and len(columns)==0):
+            continue
+        if transformer=='passthrough':
+            raise NameError('Cannot compile passthrough columns')
+        columns = [feature_index[c] if c in feature_index else int(c) for c in columns]
+        transformer_steps = _transformer_steps(transformer)
+        if any([isinstance(step, OneHotEncoder) for step in transformer_steps]):
+            block, n_coefs = _compile_categorical_block(columns, transformer_steps, coefs[start:])
+            categorical_blocks.append(block)
+        else:
+            block, n_coefs = _compile_numeric_block(columns, transformer_steps, coefs[start:])
+            numeric_blocks.append(block)
+        start += n_coefs
+    if start!=len(coefs):
+        raise NameError('Compiled {} coefficients but the model has {}'.format(start, len(coefs)))
+    return CompiledLinearPipeline(features, numeric_blocks, categorical_blocks, intercept)
+
+
+FOREST_NODE_DTYPE = np.dtype([('feature', '<i4'), ('threshold', '<f4'), ('left', '<i4'), ('right', '<i4'),
+                              ('missing_left', 'u1'), ('value', '<f8')])
+
+
+class CompiledForest:
+    '''
+    Numpy evaluator of a fitted random forest (see compile_forest).
+    All the trees are stored in one array of nodes (FOREST_NODE_DTYPE). 
+    Leaves point to themselves, so every row can be moved down all the trees at once until all of them reach a leaf.
+
+    Parameters
+    ----------
+    nodes : numpy.ndarray
+        Nodes of all the trees. The threshold is the largest float32 not greater than the sklearn threshold, 
+        so comparing the inputs as float32 (as sklearn does) gives the same splits.
+    roots : list
+        Index of the root node of each tree.
+    max_depth : int
+        Largest depth of the trees.
+    features : list (optional)
+        Names of the input columns.
+    '''
+    def __init__(self, nodes, roots, max_depth, features=None):
+        self.nodes = nodes
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.max_depth = int(max_depth)
+        self.features = (list(features) if features is not None else None)
+        self.n_features = int(nodes['feature'].max())+1 if len(nodes)!=0 else 0
+        if self.features is not None:
+            self.n_features = len(self.features)
+
+    def n_trees(self):
+        return len(self.roots)
+
+    def _to_matrix(self, X):
+        '''
+        Converts the input to a float32 array with the columns in the order used by the trees.
+        X can be a DataFrame or a dict (one row) or a list of dicts with the columns in self.features, or a 1-D or 2-D array.
+        '''
+        if isinstance(X, dict):
+            X = [X]
+        if isinstance(X, pd.DataFrame):
+            if self.features is not None:
+                X = X.reindex(columns=self.features)
+            X = X.to_numpy(dtype=np.float32)
+        elif isinstance(X, (list, tuple)) and len(X)!=0 and all([isinstance(row, dict) for row in X]):
+            if self.features is None:
+                raise NameError('Forest compiled without feature names, pass an array instead')
+            X = np.array([[row.get(f, np.nan) for f in self.features] for row in X], dtype=np.float32)
+        else:
+            X = np.asarray(X, dtype=np.float32)
+            if X.ndim==1:
+                X = X.reshape(1, -1)
+        if X.shape[1]!=self.n_features:
+            raise NameError('Input should have {} columns, got {}'.format(self.n_features, X.shape[1]))
+        return X
+
+    def apply(self, X):
+        '''
+        Returns the index of the leaf reached in each tree by each row of X (n_rows x n_trees).
+        '''
+        X = self._to_matrix(X)
+        feature, threshold = self.nodes['feature'], self.nodes['threshold']
+        left, right, missing_left = self.nodes['left'], self.nodes['right'], self.nodes['missing_left']
+        rows = np.arange(len(X))[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            x = X[rows, feature[node]]
+            go_left = np.where(np.isnan(x), missing_left[node]==1, x<=threshold[node])
+            next_node = np.where(go_left, left[node], right[node])
+            if (next_node==node).all():
+                break
+            node = next_node
+        return node
+
+    def predict_trees(self, X):
+        '''
+        Returns the prediction of each tree for each row of X (n_rows x n_trees), useful to estimate the spread of the prediction.
+        '''
+        return self.nodes['value'][self.apply(X)]
+
+    def predict(self, X):
+        '''
+        Returns the prediction (the mean over the trees) for each row of X (see _to_matrix for the accepted inputs).
+        '''
+        return self.predict_trees(X).mean(axis=1)
+
+    def predict_one(self, row):
+        '''
+        Returns the prediction for a single row given as a dict {feature: value} or a 1-D array.
+        '''
+        return float(self.predict(row)[0])
+
+    def verify(self, model, X):
+        '''
+        Returns True if the compiled forest gives the same predictions as the sklearn model for X.
+        '''
+        return np.allclose(self.predict(X), np.asarray(model.predict(X), dtype=float).ravel())
+
+    def save(self, fpath, source=None):
+        '''
+        Saves the nodes to fpath (.npy) and the rest of the forest to a json file next to it (see forest_paths).
+        Both files are written with APICalls.atomic_write, so readers never see a partial forest.
+
+        Parameters
+        ----------
+        fpath : str
+            Path of the .npy file.
+        source : str (optional)
+            Fingerprint of the model file the forest was compiled from (see indicator_tools.file_fingerprint), used by load_forest to detect changes.
+        '''
+        nodes_path, meta_path = forest_paths(fpath)
+        nodes = BytesIO()
+        np.save(nodes, np.asarray(self.nodes))
+        atomic_write(nodes_path, nodes.getvalue())
+        meta = {'roots': self.roots.tolist(), 'max_depth': self.max_depth, 'features': self.features, 'source': source}
+        atomic_write(meta_path, json.dumps(meta).encode())
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        '''
+        Loads a forest saved with save. If mmap is True, the nodes are memory mapped instead of read into memory.
+        '''
+        nodes_path, meta_path = forest_paths(fpath)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        nodes = np.load(nodes_path, mmap_mode=('r' if mmap else None))
+        forest = cls(nodes, meta['roots'], meta['max_depth'], meta['features'])
+        forest.source = meta.get('source')
+        return forest
+
+
+def compile_forest(model, features=None):
+    '''
+    Flattens a fitted forest into a CompiledForest.
+    Raises a NameError if the model is not a forest of regression trees with one output.
+
+    Parameters
+    ----------
+    model : sklearn.ensemble.RandomForestRegressor
+        Fitted forest (any model with estimators_ made of fitted trees), or a single fitted tree.
+    features : list (optional)
+        Names of the input columns.
+    '''
+    estimators = getattr(model, 'estimators_', [model])
+    trees = [getattr(estimator, 'tree_', None) for estimator in estimators]
+    if any([tree is None for tree in trees]):
+        raise NameError('Cannot compile forest: all the estimators should be fitted trees')
+    if any([(tree.n_outputs!=1) or (tree.value.shape[2]!=1) for tree in trees]):
+        raise NameError('Only regression forests with one output can be compiled')
+    nodes = np.zeros(sum([tree.node_count for tree in trees]), dtype=FOREST_NODE_DTYPE)
+    roots, max_depth = [], 0
+    start = 0
+    for tree in trees:
+        n = tree.node_count
+        index = np.arange(start, start+n)
+        is_leaf = tree.children_left==-1
+        threshold = tree.threshold.astype(np.float32)
+        # sklearn compares float32 inputs with float64 thresholds: round them down to keep the same splits
+        threshold = np.where(threshold.astype(np.float64)>tree.threshold, np.nextafter(threshold, np.float32(-np.inf)), threshold)
+        block = nodes[start:start+n]
+        block['feature'] = np.where(is_leaf, 0, tree.feature)
+        block['threshold'] = np.where(is_leaf, np.inf, threshold)
+        block['left'] = np.where(is_leaf, index, tree.children_left+start)
+        block['right'] = np.where(is_leaf, index, tree.children_right+start)
+        missing_left = getattr(tree, 'missing_go_to_left', None)
+        block['missing_left'] = (np.asarray(missing_left, dtype=np.uint8) if missing_left is not None else 0)
+        block['value'] = tree.value[:, 0, 0]
+        roots.append(start)
+        max_depth = max(max_depth, tree.max_depth)
+        start += n
+    if features is None and hasattr(model, 'feature_names_in_'):
+        features = list(model.feature_names_in_)
+    return CompiledForest(nodes, roots, max_depth, features)
+
+
+def forest_paths(fpath):
+    '''
+    Returns the paths of the nodes (.npy) and of the description (.json) of a compiled forest.
+    '''
+    base = (fpath[:-4] if fpath.endswith('.npy') else fpath)
+    return base+'.npy', base+'.json'
+
+
+
+
+def load_forest(model_object_loc, mmap=True):
+    '''
+    Returns the compiled forest and features of a pickled model object {'model': forest, 'features': list}.
+    The forest is compiled once and saved next to the pickle (<name>_forest.npy and <name>_forest.json);
+    it is compiled again only when the pickle changes, so later loads do not unpickle the sklearn model.
+
+    Parameters
+    ----------
+    model_object_loc : str
+        Path of the pickled model object.
+    mmap : boolean (default=True)
+        If True, the nodes are memory mapped.
+
+    Returns
+    -------
+    forest : CompiledForest
+        Or the sklearn model if it cannot be compiled (see try_compile_forest).
+    features : list
+    '''
+    fpath = os.path.splitext(model_object_loc)[0]+'_forest.npy'
+    source = file_fingerprint([model_object_loc])
+    nodes_path, meta_path = forest_paths(fpath)
+    if os.path.isfile(nodes_path) and os.path.isfile(meta_path):
+        try:
+            forest = CompiledForest.load(fpath, mmap=mmap)
+            if forest.source==source:
+                return forest, forest.features
+        except Exception:
+            # unreadable sidecar: compiled again below
+            pass
+    with open(model_object_loc, 'rb') as f:
+        model_object = pickle.load(f)
+    features = list(model_object['features'])
+    forest = try_compile_forest(model_object['model'], features, name=model_object_loc)
+    if not isinstance(forest, CompiledForest):
+        return forest, features
+    try:
+        forest.save(fpath, source=source)
+        forest = CompiledForest.load(fpath, mmap=mmap)
+    except Exception as e:
+        warn('Could not save the compiled forest of {} ({}), using it from memory'.format(model_object_loc, e))
+    return forest, features
+
+
+def try_compile_forest(model, features, name='model'):
+    '''
+    Returns the compiled forest of the model (see compile_forest), or the sklearn model itself, with a warning, if it cannot be compiled.
+    '''
+    try:
+        return compile_forest(model, features=features)
+    except Exception as e:
+        warn('Could not compile the forest of {} ({}), using the sklearn model'.format(name, e))
+        return model
@@ -11,6 +11,7 @@ from innovation_indicator import InnoIndicator
 from economic_indicator import EconomicIndicator
 from buildings_indicator import BuildingsIndicator
 from diversity_indicator import DiversityIndicator
+from mobility_indicator import MobilityIndicator
 
 import json
 import pandas as pd
@@ -30,6 +31,15 @@ B= BuildingsIndicator(name='buildings',  table_name='corktown')
 D= DiversityIndicator(name='diversity',  table_name='corktown')
 E = EconomicIndicator(name='Economic',
                       table_name='corktown')
+M = MobilityIndicator(name='mobility',  table_name='corktown')
+
+# future_mobility level of the regular rows: the level used by the live table (see MobilityIndicator.return_indicator)
+LIVE_MOBILITY=1
+# future_mobility level of the Future Mobility row.
+# All the simulations the mobility models are trained on (mobility_sim_output.json) have future_mobility=1, 
+# so the models cannot tell the levels apart: until they are trained on other levels, 
+# the mobility indicators of the Future Mobility row are the same as those of Campus Only.
+FUTURE_MOBILITY=1
 
 # =============================================================================
 # Load contextual data
@@ -52,7 +62,7 @@ reporting_types=[t for t in types if t not in ['None','Residential Low Density',
 
 for ind in [I, P, 
 #             P_hm, 
-            B, D, E]:
+            B, D, E, M]:
     ind.types_def=types
     ind.geogrid_header=geogrid['properties']['header']
 
@@ -96,16 +106,45 @@ def get_type_stats(geogrid_data, reporting_types, updatable,cell_area, types_def
 
 
 
-def get_all_indicators(geogrid_data):
+def get_batch_indicators(scenario_names):
+    """
+    calculates the innovation and economic indicators of all the scenarios in one pass
+    returns a list of indicators for each scenario
+    """
+    industry_compositions=[I.grid_to_industries(all_scenarios[name]) for name in scenario_names]
+    print('Innovation and Economic')
+    batch_results={**I.return_indicator_batch(industry_compositions), 
+                   **E.return_indicator_batch(industry_compositions)}
+    batch_indicators={}
+    for i, name in enumerate(scenario_names):
+        batch_indicators[name]=[{'name': ind_name, 'value': batch_results[ind_name]['value'][i],
+                                 'raw_value': batch_results[ind_name]['raw_value'][i],
+                                 'units': batch_results[ind_name]['units']} for ind_name in batch_results]
+    return batch_indicators
+
+def get_mobility_indicators(scenario_names, future_mobility=sorted(set([LIVE_MOBILITY, FUTURE_MOBILITY]))):
+    """
+    calculates the mobility indicators of all the scenarios and future_mobility levels in one pass
+    returns a dict {(scenario name, future_mobility level): list of indicators}
+    """
+    print('Mobility')
+    outputs=M.return_indicator_batch({name: all_scenarios[name] for name in scenario_names}, future_mobility=future_mobility)
+    mobility_indicators={}
+    for _, row in outputs.iterrows():
+        mobility_indicators[(row['scenario'], row['future_mobility'])]=[
+                {'name': 'Mobility CO2 Performance', 'value': row['Mobility CO2 Performance'], 
+                 'raw_value': row['avg_co2'], 'units': 'kg/day'},
+                {'name': 'Mobility Health Impacts', 'value': row['Mobility Health Impacts'], 
+                 'raw_value': row['delta_f_physical_activity_pp'], 'units': 'mortality/year'}]
+    return mobility_indicators
+
+def get_all_indicators(geogrid_data, batch_indicators):
     """
     calculates values of all the individual indicators for a given scenario
+    batch_indicators are the indicators of this scenario calculated by get_batch_indicators
     """
     all_ind=[]
-    print('Innovation')
-    all_ind.extend(I.return_indicator(geogrid_data))
-
-    print('Economic')
-    all_ind.extend(E.return_indicator(geogrid_data))
+    all_ind.extend(batch_indicators)
 
     print('Proximity')
     all_ind.extend(P.return_indicator(geogrid_data))
@@ -135,21 +174,31 @@ def create_scenario_row(all_ind, stats, scenario_name):
 # Calculate indicators and land use stats for each scenario
 # =============================================================================
 
-base_indicators=get_all_indicators(all_scenarios['Baseline'])
+scenario_names=['Baseline', 'Campus_Only', 'Campus_Housing', 'Innovation_Community']
+batch_indicators=get_batch_indicators(scenario_names)
+mobility_indicators=get_mobility_indicators(scenario_names)
+
+base_indicators=get_all_indicators(all_scenarios['Baseline'], batch_indicators['Baseline'])
 base_stats=get_type_stats(all_scenarios['Baseline'], reporting_types, updatable,cell_area)
 
-campus_indicators=get_all_indicators(all_scenarios['Campus_Only'])
+campus_indicators=get_all_indicators(all_scenarios['Campus_Only'], batch_indicators['Campus_Only'])
 campus_stats=get_type_stats(all_scenarios['Campus_Only'], reporting_types, updatable,cell_area)
 
-campus_mobility_indicators=get_all_indicators(all_scenarios['Campus_Only'])
+# the Future Mobility scenario only differs from Campus Only in the mobility indicators
+campus_mobility_indicators=campus_indicators+mobility_indicators[('Campus_Only', FUTURE_MOBILITY)]
 campus_mobility_stats=campus_stats
 
-housing_indicators=get_all_indicators(all_scenarios['Campus_Housing'])
+housing_indicators=get_all_indicators(all_scenarios['Campus_Housing'], batch_indicators['Campus_Housing'])
 housing_stats=get_type_stats(all_scenarios['Campus_Housing'], reporting_types, updatable,cell_area)
 
-inno_com_indicators=get_all_indicators(all_scenarios['Innovation_Community'])
+inno_com_indicators=get_all_indicators(all_scenarios['Innovation_Community'], batch_indicators['Innovation_Community'])
 inno_com_stats=get_type_stats(all_scenarios['Innovation_Community'], reporting_types, updatable,cell_area)
 
+base_indicators+=mobility_indicators[('Baseline', LIVE_MOBILITY)]
+campus_indicators=campus_indicators+mobility_indicators[('Campus_Only', LIVE_MOBILITY)]
+housing_indicators+=mobility_indicators[('Campus_Housing', LIVE_MOBILITY)]
+inno_com_indicators+=mobility_indicators[('Innovation_Community', LIVE_MOBILITY)]
+
 all_scenarios=[]
 all_scenarios.append(create_scenario_row(base_indicators, base_stats, scenario_name='BAU'))
 all_scenarios.append(create_scenario_row(campus_indicators, campus_stats, scenario_name='Campus Only'))
@@ -166,6 +215,7 @@ output=pd.DataFrame(all_scenarios)
 
 aggregation={
         'Innovation Potential': ['Knowledge','Skills','R&D Funding'],
+         'Sustainable Mobility': ['Mobility CO2 Performance','Mobility Health Impacts'],
          'Economic Performance': ['Average Salary','Productivity','Employment Density', 'Diversity Jobs'],
          'Sustainable Buildings': ['Buildings Energy Performance'],
          'Community Benefits':  ['Access to housing', 'Access to education', 'Access to 3rd Places',
@@ -1,7 +1,10 @@
+import os
 import pandas as pd
+import numpy as np
 import json
 from toolbox import Handler, Indicator
-from indicator_tools import EconomicIndicatorBase, shannon_equitability_score, flatten_grid_cell_attributes, collect_grid_cell_counts
+from indicator_tools import EconomicIndicatorBase, shannon_equitability_scores, flatten_grid_cell_attributes, file_fingerprint
+from APICalls import atomic_write
 
 class DiversityIndicator(EconomicIndicatorBase):
     def setup(self ,*args,**kwargs):
@@ -15,13 +18,34 @@ class DiversityIndicator(EconomicIndicatorBase):
 #                                    '4451', '4452', '4453' ]
         self.education_naics_codes=['6111', '6113', '6115', 
                                     '6116' ]
-        parcel_data_loc='./tables/{}/geometry/{}_site_parcels_cs_types.geojson'.format(self.table_name, self.table_name)
-        self.parcel_data=json.load(open(parcel_data_loc))
+        self.parcel_data_loc='./tables/{}/geometry/{}_site_parcels_cs_types.geojson'.format(self.table_name, self.table_name)
+        self.base_populations_loc='./tables/{}/diversity_base_populations.json'.format(self.table_name)
         self.school_type_to_NAICS={'School': '6111'}
-        self.prepare_base_populations()
-        
+        # if True, only the cells that changed since the last update are flattened again (see update_species_counts)
+        self.incremental=kwargs.get('incremental', True)
+        self.load_base_populations()
+        self.prepare_species_index()
         
-
+    def load_base_populations(self):
+        '''
+        Loads the baseline populations from the precomputed file (self.base_populations_loc).
+        The file is created from the parcel data the first time, and created again when the parcel data changes.
+        If the parcel data is not available, the precomputed file is used as is.
+        '''
+        fingerprint=file_fingerprint([self.parcel_data_loc])
+        if os.path.isfile(self.base_populations_loc):
+            base_populations=json.load(open(self.base_populations_loc))
+            if (fingerprint is None) or (base_populations['source']==fingerprint):
+                self.housing_counts=base_populations['housing_counts']
+                self.education_counts=base_populations['education_counts']
+                self.third_place_counts=base_populations['third_place_counts']
+                return
+        self.parcel_data=json.load(open(self.parcel_data_loc))
+        self.prepare_base_populations()
+        del self.parcel_data
+        base_populations={'source': fingerprint, 'housing_counts': self.housing_counts,
+                          'education_counts': self.education_counts, 'third_place_counts': self.third_place_counts}
+        atomic_write(self.base_populations_loc, json.dumps(base_populations).encode())
         
     def prepare_base_populations(self):
         # create dict of housing {'R2', 'R3', 'R5', 'R6'}
@@ -44,73 +68,89 @@ class DiversityIndicator(EconomicIndicatorBase):
                 self.third_place_counts['2100']+=0.1*floor_area
             elif feat['properties']['CS_LU']=='Park':
                 self.third_place_counts['7240']+=area
-            
-    def return_indicator(self,geogrid_data):
-        industry_composition=self.grid_to_industries(geogrid_data)
-        industry_species_counts={}
-#        third_place_species_counts={}
-#        education_species_counts={}
-        for td_code in self.two_digit_naics_species:
-            industry_species_counts[td_code]=sum([industry_composition[code] for 
-                                 code in industry_composition if code[:2]==td_code])
-#        for tp_code in self.third_place_naics_codes:
-#            third_place_species_counts[tp_code]=sum([industry_composition[code] for 
-#                                 code in industry_composition if code==tp_code])
-#        for ed_code in self.education_naics_codes:
-#            education_species_counts[ed_code]=sum([industry_composition[code] for 
-#                                 code in industry_composition if code==ed_code])
-    
-        job_diversity=shannon_equitability_score([industry_species_counts[code] for code in industry_species_counts])
-#        third_diversity=shannon_equitability_score([third_place_species_counts[code] for code in third_place_species_counts])
-#        edu_diversity=shannon_equitability_score([education_species_counts[code] for code in education_species_counts])
-        
-        # make copies of the baseline counts
-        housing_counts={k:self.housing_counts[k] for k in self.housing_counts}
-        education_counts={k:self.education_counts[k] for k in self.education_counts}
-        third_place_counts={k:self.third_place_counts[k] for k in self.third_place_counts}
-        
-        all_new_LBCS=[]
-        all_new_NAICS=[]
-        for cell in geogrid_data:
-            if cell['interactive']:
-                lbcs_this_cell=flatten_grid_cell_attributes(
-                        type_def=self.types_def[cell['name']], height=cell['height'],
-                        attribute_name='LBCS', area_per_floor=self.geogrid_header['cellSize']**2,
-                        return_units='floors')
-                naics_this_cell=flatten_grid_cell_attributes(
-                        type_def=self.types_def[cell['name']], height=cell['height'],
-                        attribute_name='NAICS', area_per_floor=self.geogrid_header['cellSize']**2,
-                        return_units='floors')
-                all_new_LBCS.append(lbcs_this_cell)
-                all_new_NAICS.append(naics_this_cell)
-                
-        all_new_LBCS_agg=collect_grid_cell_counts(all_new_LBCS)
-        all_new_NAICS_agg=collect_grid_cell_counts(all_new_NAICS)
-        
+
+    def prepare_species_index(self):
+        '''
+        Assigns a position to each species in the array of counts used by return_indicator:
+        jobs (two digit NAICS), third places (LBCS), education (NAICS), and the new housing (floor area of LBCS 1100).
+        '''
+        self.job_index={code: i for i, code in enumerate(self.two_digit_naics_species)}
+        start=len(self.job_index)
+        self.third_place_index={code: start+i for i, code in enumerate(self.third_place_counts)}
+        start+=len(self.third_place_index)
+        self.education_index={code: start+i for i, code in enumerate(self.education_counts)}
+        start+=len(self.education_index)
+        self.new_housing_position=start
+        self.n_species=start+1
+        self.species_slices={'jobs': slice(0, len(self.job_index)), 
+                             'third_places': slice(len(self.job_index), len(self.job_index)+len(self.third_place_index)),
+                             'education': slice(self.n_species-1-len(self.education_index), self.n_species-1)}
+        self.base_housing=np.array([self.housing_counts[code] for code in self.housing_counts], dtype=float)
+        self.new_housing_shares=np.array([0.8 if code=='R5' else (0.2 if code=='R6' else 0) for code in self.housing_counts])
+        self.base_species_counts=np.zeros(self.n_species)
+        for code in self.third_place_counts:
+            self.base_species_counts[self.third_place_index[code]]=self.third_place_counts[code]
+        for code in self.education_counts:
+            self.base_species_counts[self.education_index[code]]=self.education_counts[code]
+        self.cell_keys=None
+
+    def cell_species_counts(self, cell):
+        '''
+        Returns the contribution of a grid cell to the species counts (see prepare_species_index).
+        The NAICS composition of the cell is flattened once and used both for jobs (capacity) and education (floor area).
+        '''
+        counts=np.zeros(self.n_species)
+        if cell['name'] not in self.types_def:
+            return counts
+        type_def=self.types_def[cell['name']]
         area_one_floor=self.geogrid_header['cellSize']**2
-        # for each education lbcs, add new
-        # for each third_place lbcs add new
-        for lbcs in third_place_counts:
-            if lbcs in all_new_LBCS_agg:
-                third_place_counts[lbcs]+=all_new_LBCS_agg[lbcs]*area_one_floor
-        for naics in education_counts:
-            if naics in all_new_NAICS_agg:
-                education_counts[naics]+=all_new_NAICS_agg[naics]*area_one_floor
-            
-        # new_R5 = 80% of new housing
-        # new_R6 = 20% of new housing 
-        if '1100' in all_new_LBCS_agg:
-            new_housing=all_new_LBCS_agg['1100']*area_one_floor
-        else:
-            new_housing=0
-        housing_counts['R5']+=new_housing*0.8
-        housing_counts['R6']+=new_housing*0.2
-        
-        third_diversity=shannon_equitability_score([third_place_counts[code] for code in third_place_counts])
-        housing_diversity=shannon_equitability_score([housing_counts[code] for code in housing_counts])
-        edu_diversity=shannon_equitability_score([education_counts[code] for code in education_counts])
-        
-        
+        naics_floors=flatten_grid_cell_attributes(type_def=type_def, height=cell['height'], attribute_name='NAICS', 
+                                                  area_per_floor=area_one_floor, return_units='floors')
+        capacity_per_floor=(1/type_def['sqm_pperson'] if 'sqm_pperson' in type_def else 0)*area_one_floor
+        for code in naics_floors:
+            if code[:2] in self.job_index:
+                counts[self.job_index[code[:2]]]+=naics_floors[code]*capacity_per_floor
+        if cell['interactive']:
+            for code in naics_floors:
+                if code in self.education_index:
+                    counts[self.education_index[code]]+=naics_floors[code]*area_one_floor
+            lbcs_floors=flatten_grid_cell_attributes(type_def=type_def, height=cell['height'], attribute_name='LBCS', 
+                                                     area_per_floor=area_one_floor, return_units='floors')
+            for code in lbcs_floors:
+                if code in self.third_place_index:
+                    counts[self.third_place_index[code]]+=lbcs_floors[code]*area_one_floor
+            counts[self.new_housing_position]=lbcs_floors.get('1100', 0)*area_one_floor
+        return counts
+
+    def update_species_counts(self, geogrid_data):
+        '''
+        Returns the species counts of the grid (baseline included, see prepare_species_index).
+        In incremental mode, the contribution of each cell is kept between updates and only the cells whose type, 
+        height or interactivity changed are flattened again; the totals are updated with the difference.
+        '''
+        keys=[(cell['name'], tuple(cell['height']) if isinstance(cell['height'], list) else cell['height'], cell['interactive']) 
+              for cell in geogrid_data]
+        if (not self.incremental) or (self.cell_keys is None) or (len(keys)!=len(self.cell_keys)) or (self.cell_types_def is not self.types_def):
+            self.cell_counts=np.array([self.cell_species_counts(cell) for cell in geogrid_data]).reshape(len(geogrid_data), self.n_species)
+            self.species_counts=self.base_species_counts+self.cell_counts.sum(axis=0)
+            self.cell_keys=keys
+            self.cell_types_def=self.types_def
+            return self.species_counts
+        for i, key in enumerate(keys):
+            if key!=self.cell_keys[i]:
+                counts=self.cell_species_counts(geogrid_data[i])
+                self.species_counts+=counts-self.cell_counts[i]
+                self.cell_counts[i]=counts
+                self.cell_keys[i]=key
+        return self.species_counts
+
+    def return_indicator(self,geogrid_data):
+        species_counts=self.update_species_counts(geogrid_data)
+        housing_counts=self.base_housing+species_counts[self.new_housing_position]*self.new_housing_shares
+        job_diversity=shannon_equitability_scores(species_counts[self.species_slices['jobs']])
+        third_diversity=shannon_equitability_scores(species_counts[self.species_slices['third_places']])
+        edu_diversity=shannon_equitability_scores(species_counts[self.species_slices['education']])
+        housing_diversity=shannon_equitability_scores(housing_counts)
         return [{'name': 'Diversity Jobs', 'value': job_diversity,'raw_value': job_diversity, 
                  'viz_type': self.viz_type, 'units': None},
                 {'name': 'Diversity Third Places', 'value': third_diversity, 'raw_value': third_diversity, 
@@ -119,6 +159,7 @@ class DiversityIndicator(EconomicIndicatorBase):
                  'viz_type': self.viz_type, 'units': None},
                   {'name': 'Diversity Housing', 'value': housing_diversity, 'raw_value': housing_diversity,  
                  'viz_type': self.viz_type, 'units': None}]
+
         
 
 def main():
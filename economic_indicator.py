@@ -6,10 +6,12 @@ Created on Tue Mar 31 17:48:36 2020
 @author: doorleyr
 """
 import pandas as pd
+import numpy as np
 import json
+from warnings import warn
 
 from toolbox import Handler, Indicator
-from indicator_tools import EconomicIndicatorBase
+from indicator_tools import DATA_REGISTRY, EconomicIndicatorBase, compositions_to_matrix, code_hierarchy
 
 # def load_output_per_employee():
 #     industry_ouput=pd.read_csv('./tables/innovation_data/USA_industry_ouput.csv', skiprows=1)
@@ -81,10 +83,13 @@ class EconomicIndicator(EconomicIndicatorBase):
 #
 #        # self.output_per_employee_by_naics=self.load_output_per_employee(return_data=True)
         self.load_output_per_employee() #This function should load the df without the need of returning it 
-        salary_data=pd.read_excel('./tables/innovation_data/national_M2019_dl.xlsx')
-#        salary_data=salary_data.set_index('occ_code')
-        self.code_to_salary={salary_data.iloc[i]['occ_code']: salary_data.iloc[i]['a_mean']
-            for i in range(len(salary_data))}
+        # parsed from national_M2019_dl.xlsx only when the file changes (see DataLoader.load_salaries)
+        salary_data=DATA_REGISTRY.shared_table('salaries')
+        self.salaries=pd.Series(salary_data['a_mean'].values, index=salary_data['occ_code'].values)
+        self.code_to_salary=self.salaries.to_dict()
+        # salaries and outputs per employee aligned with lists of occupations and NAICS codes (see get_salary_vector and get_output_vector)
+        self.salary_vectors={}
+        self.output_vectors={}
         
     def return_indicator(self, geogrid_data):
         # add new workers to baseline workers
@@ -97,10 +102,13 @@ class EconomicIndicator(EconomicIndicatorBase):
 #            else:
 #                all_worker_composition[code]=new_worker_composition[code]  
         industry_composition=self.grid_to_industries(geogrid_data)
-        worker_composition   = self.industries_to_occupations(industry_composition)
-        num_workers=sum([worker_composition[code] for code in worker_composition])
+        naicsLevel=self.infer_naics_level(industry_composition)
+        industry_vector, _=self.industry_composition_to_vector(industry_composition, naicsLevel)
+        operator=self.get_industry_operator(naicsLevel)
+        workers=industry_vector.dot(operator['shares'])
+        num_workers=workers.sum()
         num_workers_per_km_sq=num_workers/4
-        avg_salary=self.get_avg_salary(worker_composition)
+        avg_salary=self.known_salary_average(workers, self.get_salary_vector(operator['occupations']), operator['occupations'])
 #        base_ouput=self.get_total_output(self.base_industry_composition)
         output=self.get_total_output(industry_composition)
         max_output=5e9
@@ -115,6 +123,118 @@ class EconomicIndicator(EconomicIndicatorBase):
                  'viz_type': self.viz_type, 'units': 'employees/sq_km'}]
         return self.value_indicators
         
+    def return_indicator_batch(self, industry_compositions):
+        '''
+        Calculates the indicators of return_indicator for several scenarios in one pass.
+
+        Parameters
+        ----------
+        industry_compositions : list or pandas.DataFrame
+            Industry composition of each scenario, as a list of dicts (see grid_to_industries) 
+            or a DataFrame with one row per scenario and one column per NAICS code.
+
+        Returns
+        -------
+        indicators : dict
+            For each indicator name, a dict with 'value' and 'raw_value' arrays (one value per scenario) and 'units'.
+        '''
+        matrix, codes = compositions_to_matrix(industry_compositions)
+        worker_compositions=self.industries_to_occupations_batch(industry_compositions)
+        workers=np.nan_to_num(worker_compositions.values)
+        num_workers=workers.sum(axis=1)
+        num_workers_per_km_sq=num_workers/4
+        occupations=list(worker_compositions.columns)
+        avg_salary=self.known_salary_average(workers, self.get_salary_vector(occupations), occupations)
+        output=self.known_total_output(matrix, self.get_output_vector(codes), codes)
+        max_output=5e9
+        max_workers_per_km_sq=7500
+        return {'Average Salary': {'value': np.minimum(1, avg_salary/80000), 'raw_value': avg_salary, 'units': 'USD'},
+                'Productivity': {'value': np.minimum(1, output/max_output), 'raw_value': output, 'units': 'USD'},
+                'Employment Density': {'value': np.minimum(1, num_workers_per_km_sq/max_workers_per_km_sq), 
+                                       'raw_value': num_workers_per_km_sq, 'units': 'employees/sq_km'}}
+
+    def get_salary_vector(self, occupations):
+        '''
+        Returns the mean salary of each occupation code (nan if not found).
+        Codes are zero padded to 7 characters and, if not found, the code without its last character is used.
+        The vector is resolved once per list of occupations.
+        '''
+        key=tuple(occupations)
+        if key not in self.salary_vectors:
+            if len(self.salary_vectors)>=128:
+                self.salary_vectors={}
+            padded=pd.Index([occ_code.ljust(7, '0') for occ_code in occupations])
+            fallback=pd.Index([occ_code[:-1].ljust(7, '0') for occ_code in occupations])
+            self.salary_vectors[key]=np.where(padded.isin(self.salaries.index), 
+                                              self.salaries.reindex(padded).values, 
+                                              self.salaries.reindex(fallback).values).astype(float)
+        return self.salary_vectors[key]
+
+    def known_salary_average(self, workers, salaries, occupations):
+        '''
+        Returns the average salary of the workers in occupations with salary data (0 if there are none), 
+        leaving the other occupations out of both the total salary and the number of workers,
+        so that the values posted to cityIO are never nan. Occupations with workers that are left out are reported with a warning.
+
+        Parameters
+        ----------
+        workers : numpy.ndarray
+            Number of workers in each occupation (last axis), for one scenario (1-D) or several (2-D, one scenario per row).
+        salaries : numpy.ndarray
+            Salary of each occupation (see get_salary_vector).
+        occupations : list
+            Occupation codes.
+        '''
+        known=~np.isnan(salaries)
+        dropped=[occ for occ, k, w in zip(occupations, known, np.abs(workers).reshape(-1, len(occupations)).sum(axis=0)) 
+                 if (not k) and (w>0)]
+        if len(dropped)>0:
+            warn('No salary data for occupations {}: left out of the average salary'.format(', '.join(dropped)))
+        num_workers=workers[..., known].sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_salary=workers[..., known].dot(salaries[known])/num_workers
+        return np.where(num_workers==0, 0, avg_salary)[()]
+
+    def known_total_output(self, numbers, output_per_code, codes):
+        '''
+        Returns the total output (in USD) of the workers of each NAICS code, leaving out the codes without output data,
+        so that the values posted to cityIO are never nan. Codes in the composition that are left out are reported with a warning.
+
+        Parameters
+        ----------
+        numbers : numpy.ndarray
+            Number of workers of each code (last axis, nan if the code is not in the composition), 
+            for one scenario (1-D) or several (2-D, one scenario per row, see compositions_to_matrix).
+        output_per_code : numpy.ndarray
+            Output per employee of each code (see get_output_vector).
+        codes : list
+            NAICS codes.
+        '''
+        known=~np.isnan(output_per_code)
+        present=(~np.isnan(numbers)).reshape(-1, len(codes)).any(axis=0)
+        dropped=[code for code, k, p in zip(codes, known, present) if (not k) and p]
+        if len(dropped)>0:
+            warn('No output data for NAICS codes {}: left out of the total output'.format(', '.join(dropped)))
+        return 1000*np.nan_to_num(numbers[..., known]).dot(output_per_code[known])
+
+    def get_output_vector(self, codes):
+        '''
+        Returns the output per employee of each NAICS code, as used by get_total_output 
+        (0 for agriculture and public order/safety, nan if not found).
+        The vector is resolved once per list of codes.
+        '''
+        key = tuple(codes)
+        if key not in self.output_vectors:
+            if len(self.output_vectors)>=128:
+                self.output_vectors = {}
+            self.load_output_per_employee()
+            hierarchy = code_hierarchy(codes)
+            # output per employee of each 2 digit code, mapped back to the codes through their ids at level 2
+            output = np.array([0 if code in ['11', '92'] else self.output_per_employee_by_naics.get(code, np.nan)
+                               for code in hierarchy.level_codes(2)], dtype=float)
+            self.output_vectors[key] = output[hierarchy.ids(2, codes)]
+        return self.output_vectors[key]
+
 #    def return_baseline(self):
 #        base_ouput=self.get_total_output(self.base_industry_composition)
 #        base_avg_salary=self.get_avg_salary(self.base_worker_composition)
@@ -125,29 +245,16 @@ class EconomicIndicator(EconomicIndicatorBase):
         
             
     def get_avg_salary(self, worker_composition):
-        total_salary=0
-        denom=0  
-        for occ_code in worker_composition:          
-            padded_occ_code=occ_code.ljust(7, '0')
-            if padded_occ_code in self.code_to_salary:
-                salary=self.code_to_salary[padded_occ_code]
-            else:
-                padded_occ_code=occ_code[:-1].ljust(7, '0')
-                salary=self.code_to_salary[padded_occ_code]
-            weight=worker_composition[occ_code]
-            total_salary+=salary*weight
-            denom+=weight
-    #            print('{} : {}'.format(padded_occ_code,self.code_to_salary[padded_occ_code]))
-        avg_salary=total_salary/denom
+        occupations=list(worker_composition.keys())
+        workers=np.array([worker_composition[occ_code] for occ_code in occupations], dtype=float)
+        avg_salary=self.known_salary_average(workers, self.get_salary_vector(occupations), occupations)
         return avg_salary
     
     def get_total_output(self, industry_composition):
-        total_ouput=0
-        for naics in industry_composition:
-            naics_2=naics[:2]
-            if not naics_2 in ['11', '92']: # ignore agriculture and public order/safety
-                total_ouput+=industry_composition[naics]*self.output_per_employee_by_naics[naics_2]
-        return 1000*total_ouput
+        # agriculture and public order/safety have no output (see get_output_vector)
+        codes=list(industry_composition.keys())
+        numbers=np.array([industry_composition[naics] for naics in codes], dtype=float)
+        return self.known_total_output(numbers, self.get_output_vector(codes), codes)
     
 def main():
     E = EconomicIndicator(table_name='corktown',
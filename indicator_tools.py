@@ -6,20 +6,32 @@ Created on Mon Mar  2 11:23:12 2020
 @author: doorleyr
 """
 import math
+import time
+import threading
+import hashlib
+from warnings import warn
+from io import BytesIO
 import pandas as pd
 import geopandas as gpd
-import requests
 import os
 from bs4 import BeautifulSoup
-from APICalls import ACSCall,patentsViewDownload,load_zipped_excel,CBPCall
+from APICalls import ACSCall,patentsViewRead,load_zipped_excel,CBPCall,fetch,download_files,atomic_write
 from download_shapeData import SHAPES_PATH
 from toolbox import Handler, Indicator
 import pandas as pd
 import random
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import train_test_split, RandomizedSearchCV
+from sklearn.model_selection import train_test_split, ParameterSampler, KFold
+from sklearn.metrics import r2_score
+from joblib import Parallel, delayed
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import sparse
+try:
+    import pyarrow
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 ############
 # Classes  #
@@ -30,6 +42,8 @@ class EconomicIndicatorBase(Indicator):
         self.IO_data = None
         self.output_per_employee_by_naics = None
         self.employees_by_naics = None
+        self.industry_operators = {}
+        self.IO_employment = None
         self.wac_cns_to_naics={
             'CNS01' : '11',
             'CNS02' : '21', 
@@ -59,7 +73,7 @@ class EconomicIndicatorBase(Indicator):
         Loads data on employment by industry and by occupation. 
         '''
         if self.IO_data is None:
-            self.IO_data = DataLoader().load_IO_data(return_data=True)
+            self.IO_data = DATA_REGISTRY.shared_table('IO_data')
 
     def grid_to_industries(self,geogrid_data):
         '''
@@ -114,29 +128,154 @@ class EconomicIndicatorBase(Indicator):
                                }
         '''
         if naicsLevel is None:
-            levels = list(set([len(k) for k in industry_composition]))
-            if len(levels)==1:
-                naicsLevel = levels[0]
-            else:
-                raise NameError('Unrecognized NAICS level')
+            naicsLevel = self.infer_naics_level(industry_composition)
+        industry_vector, industry_present = self.industry_composition_to_vector(industry_composition, naicsLevel)
+        operator = self.get_industry_operator(naicsLevel)
+        workers = industry_vector.dot(operator['shares'])
+        in_support = industry_present.dot(operator['support'])>0
+        worker_composition = {occ: workers[i] for i,occ in enumerate(operator['occupations']) if in_support[i]}
+        return worker_composition
 
-        self.load_IO_data()
+    def infer_naics_level(self,industry_composition):
+        '''
+        Returns the length of the NAICS codes in industry_composition (all codes should have the same length).
+        '''
+        levels = list(set([len(k) for k in industry_composition]))
+        if len(levels)==1:
+            return levels[0]
+        else:
+            raise NameError('Unrecognized NAICS level')
 
-        IO_data = self.IO_data[self.IO_data.columns]
-        IO_data['SELECTED_NAICS'] = IO_data['NAICS'].str[:naicsLevel]
+    def get_industry_operator(self,naicsLevel):
+        '''
+        Returns the linear map from industries to occupations at the given NAICS level.
+        It is rolled up once per level from the employment by full NAICS code (see get_IO_employment) and cached.
 
-        worker_composition = IO_data.groupby(['SELECTED_NAICS','SELECTED_LEVEL']).sum()[['TOT_EMP']].reset_index()
-        worker_composition = worker_composition.set_index(['SELECTED_NAICS','SELECTED_LEVEL'])/worker_composition.groupby('SELECTED_NAICS').sum()[['TOT_EMP']]
-        worker_composition = worker_composition.reset_index()
+        Returns
+        -------
+        operator : dict
+          naics: list of NAICS codes (rows)
+          naics_index: dict with the row of each NAICS code
+          occupations: list of occupation codes (columns)
+          shares: array with the share of the workers of each industry in each occupation
+          support: boolean array, True if the industry has any workers data for the occupation
+        '''
+        if naicsLevel not in self.industry_operators:
+            employment = self.get_IO_employment()
+            # rolls the employment of the full codes up to naicsLevel
+            aggregation = employment['hierarchy'].aggregation_matrix(naicsLevel).T
+            workers = aggregation.dot(employment['workers']).toarray()
+            # industries without workers have no shares, they do not add workers to any occupation
+            shares = share_of_total(workers,workers.sum(axis=1,keepdims=True))
+            support = (aggregation.dot(employment['support']).toarray()>0)
+            naics = employment['hierarchy'].level_codes(naicsLevel)
+            self.industry_operators[naicsLevel] = {
+                'naics': naics,
+                'naics_index': {code:i for i,code in enumerate(naics)},
+                'occupations': employment['occupations'],
+                'shares': shares,
+                'support': support.astype(float)
+            }
+        return self.industry_operators[naicsLevel]
+
+    def get_IO_employment(self):
+        '''
+        Returns the employment of IO_data by full NAICS code (rows, in the order of the hierarchy) and occupation (columns),
+        from which the industry operators of every level are rolled up (see get_industry_operator).
 
-        industry_composition_df = pd.DataFrame(industry_composition.items(),columns=['SELECTED_NAICS','number'])
-        industry_composition_df['SELECTED_NAICS'] = ('000000'+industry_composition_df['SELECTED_NAICS'].astype(str)).str[-1*naicsLevel:]
+        Returns
+        -------
+        employment : dict
+          hierarchy: CodeHierarchy of the NAICS codes of IO_data
+          occupations: list of occupation codes (columns)
+          workers: sparse matrix with the number of workers of each code in each occupation
+          support: sparse matrix with the number of rows of IO_data of each code and occupation
+        '''
+        if self.IO_employment is None:
+            self.load_IO_data()
+            naics, naics_index = factorize_codes(self.IO_data['NAICS'])
+            occupations, occupation_index = factorize_codes(self.IO_data['SELECTED_LEVEL'])
+            hierarchy = code_hierarchy(naics)
+            B = (naics_index>=0)&(occupation_index>=0)
+            rows = hierarchy.index(naics)[naics_index[B]]
+            cols = occupation_index[B]
+            shape = (len(hierarchy),len(occupations))
+            TOT_EMP = np.nan_to_num(self.IO_data['TOT_EMP'].values[B].astype(float))
+            self.IO_employment = {
+                'hierarchy': hierarchy,
+                'occupations': list(occupations),
+                'workers': sparse.csr_matrix((TOT_EMP,(rows,cols)),shape=shape),
+                'support': sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=shape)
+            }
+        return self.IO_employment
+
+    def industry_matrix_to_operator(self,matrix,codes,naicsLevel=None):
+        '''
+        Batch version of industry_composition_to_vector.
+        Takes the output of compositions_to_matrix and returns, for each scenario (rows), 
+        the number of workers in each industry of the industry operator and which of those industries are in the scenario.
+        '''
+        if naicsLevel is None:
+            naicsLevel = self.infer_naics_level(codes)
+        code_operator = self.get_code_operator(codes,naicsLevel)
+        industry_matrix = np.nan_to_num(matrix).dot(code_operator)
+        industry_present = ((~np.isnan(matrix)).astype(float).dot(code_operator)>0).astype(float)
+        return industry_matrix, industry_present
 
-        worker_composition = pd.merge(worker_composition,industry_composition_df)
-        worker_composition['TOT_EMP'] = worker_composition['TOT_EMP']*worker_composition['number']
-        worker_composition = worker_composition.groupby('SELECTED_LEVEL').sum()[['TOT_EMP']].reset_index()
-        worker_composition = dict(worker_composition.values)
-        return worker_composition
+    def get_code_operator(self,codes,naicsLevel):
+        '''
+        Returns the matrix (codes x industries of the industry operator) that maps each code, 
+        zero padded to naicsLevel, to its industry. Codes without IO data are mapped to nothing.
+        '''
+        operator = self.get_industry_operator(naicsLevel)
+        code_operator = np.zeros((len(codes),len(operator['naics'])))
+        for j,code in enumerate(codes):
+            code = ('000000'+str(code))[-1*naicsLevel:]
+            if code in operator['naics_index']:
+                code_operator[j,operator['naics_index'][code]] = 1
+        return code_operator
+
+    def industries_to_occupations_batch(self,industry_compositions,naicsLevel=None):
+        '''
+        Batch version of industries_to_occupations.
+
+        Parameters
+        ----------
+        industry_compositions : list or pandas.DataFrame
+          Industry composition of each scenario (see compositions_to_matrix).
+        naicsLevel : int 
+          NAICS level used. If not provided it will try to infer it from the data.
+
+        Returns
+        -------
+        worker_compositions : pandas.DataFrame
+          Number of workers of each scenario (rows) in each occupation (columns).
+          Occupations that would not be in the worker composition of a scenario are nan.
+        '''
+        matrix, codes = compositions_to_matrix(industry_compositions)
+        if naicsLevel is None:
+            naicsLevel = self.infer_naics_level(codes)
+        industry_matrix, industry_present = self.industry_matrix_to_operator(matrix,codes,naicsLevel)
+        operator = self.get_industry_operator(naicsLevel)
+        workers = industry_matrix.dot(operator['shares'])
+        workers[industry_present.dot(operator['support'])==0] = np.nan
+        return pd.DataFrame(workers,columns=operator['occupations'])
+
+    def industry_composition_to_vector(self,industry_composition,naicsLevel):
+        '''
+        Returns the number of workers in each industry of the industry operator (see get_industry_operator) as an array,
+        and a boolean array with the industries that appear in industry_composition.
+        Codes are zero padded to naicsLevel and codes without IO data are ignored.
+        '''
+        operator = self.get_industry_operator(naicsLevel)
+        industry_vector = np.zeros(len(operator['naics']))
+        industry_present = np.zeros(len(operator['naics']))
+        for code,number in industry_composition.items():
+            code = ('000000'+str(code))[-1*naicsLevel:]
+            if code in operator['naics_index']:
+                industry_vector[operator['naics_index'][code]] += number
+                industry_present[operator['naics_index'][code]] = 1
+        return industry_vector, industry_present
 
     def get_baseline_employees_by_naics(self,table_name, table_geoids,return_data=False):
         # Just for organization purposes, this function should be part of DataLoader and just be called from here. (see load_IO_data)
@@ -157,82 +296,61 @@ class EconomicIndicatorBase(Indicator):
             return self.employees_by_naics
 
     def load_output_per_employee(self,return_data=False):
-        # Just for organization purposes, this function should be part of DataLoader and just be called from here. (see load_IO_data)
+        '''
+        Loads the output per employee by NAICS code (see DataLoader.load_output_per_employee).
+        '''
         if self.output_per_employee_by_naics is None:
-            industry_ouput=pd.read_csv('./tables/innovation_data/USA_industry_ouput.csv', skiprows=1)
-            industry_ouput=industry_ouput.set_index('2017 NAICS code')
-            output_per_employee_by_naics={}
-            for ind_row, row in industry_ouput.iterrows():
-                output_per_emp=row['Sales, value of shipments, or revenue ($1,000)']/row['Number of employees']
-                if '-' in ind_row:
-                    from_code, to_code=ind_row.split('-')
-                    if '(' in to_code:
-                        to_code=to_code.split('(')[0]
-                    for code in range(int(from_code), int(to_code)+1):
-                        output_per_employee_by_naics[str(code)]=output_per_emp
-                else:
-                    output_per_employee_by_naics[ind_row]=output_per_emp
-            #        if '(' in ind_row:
-            #            ind_row=ind_row.split('(')[0]
-            #        output_per_employee_by_naics[ind_row]=output_per_emp
-            self.output_per_employee_by_naics = output_per_employee_by_naics
+            output_per_employee = DATA_REGISTRY.shared_table('output_per_employee')
+            self.output_per_employee_by_naics = dict(zip(output_per_employee['NAICS'],output_per_employee['output_per_employee']))
         if return_data:
             return self.output_per_employee_by_naics
 
     def standardize_NAICS_for_RnD(self,I_data,NAICS_col = 'NAICS'):
         '''
         Takes NAICS either at the 4 or 3 digit level.
+        Returns the RnD industry group of each row (see naics_RnD_group).
         '''
-        I_data = I_data.assign(NAICS_STD = I_data[NAICS_col].values)
-        inferred_NAICS_lvl = I_data[NAICS_col].str.len().max()
-        if (inferred_NAICS_lvl==4)|(inferred_NAICS_lvl==3):
-            B = (I_data['NAICS_STD'].str[0]=='3')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:3]
-            I_data.loc[I_data['NAICS_STD'].isin(['313','314','315','316']),'NAICS_STD'] = '313–16'
-
-            B = (I_data['NAICS_STD'].str[0]=='2')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:2]
-
-            B = (I_data['NAICS_STD'].str[0]=='4')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:2]
-            I_data.loc[I_data['NAICS_STD'].isin(['48','49']),'NAICS_STD'] = '48–49'
-
-            B = (I_data['NAICS_STD'].str[:2]=='51')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:3]
-            I_data.loc[B&(~I_data['NAICS_STD'].isin(['511','517','518'])),'NAICS_STD'] = 'other 51'
-
-            B = (I_data['NAICS_STD'].str[:2]=='52')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:2]
-
-            B = (I_data['NAICS_STD'].str[:2]=='53')
-            I_data.loc[B,'NAICS_STD'] = I_data[B]['NAICS_STD'].str[:3]
-            I_data.loc[B&(~I_data['NAICS_STD'].isin(['533'])),'NAICS_STD'] = 'other 53'
-
-            if inferred_NAICS_lvl==4:
-                B = (I_data['NAICS_STD'].str[:2]=='54')
-                I_data.loc[B&(~I_data['NAICS_STD'].isin(['5413','5415','5417'])),'NAICS_STD'] = 'other 54'
-            elif inferred_NAICS_lvl==3:
-                B = (I_data['NAICS_STD'].str[:2]=='54')
-                I_data.loc[B,'NAICS_STD'] = '541'
+        codes = plain_codes(I_data[NAICS_col]).astype(str)
+        inferred_NAICS_lvl = codes.str.len().max()
+        if (inferred_NAICS_lvl!=4)&(inferred_NAICS_lvl!=3):
+            raise NameError('Invalid NAICS; should be either 3 or 4 digit level')
+        hierarchy = code_hierarchy(codes.unique())
+        code_groups = np.array(hierarchy.groups(naics_RnD_group,int(inferred_NAICS_lvl)),dtype=object)
+        return code_groups[hierarchy.index(codes.values)]
 
-            I_data.loc[(I_data['NAICS_STD'].isin(['621','622','623'])),'NAICS_STD'] = '621–23'
-        else:
+    def RnD_group_matrix(self,codes,groups=None):
+        '''
+        Returns the sparse matrix (codes x groups) with a 1 in the column of the RnD industry group of each code (see standardize_NAICS_for_RnD).
+        Codes with a group not in groups are mapped to nothing.
+        '''
+        codes = [str(code) for code in codes]
+        inferred_NAICS_lvl = max([len(code) for code in codes])
+        if (inferred_NAICS_lvl!=4)&(inferred_NAICS_lvl!=3):
             raise NameError('Invalid NAICS; should be either 3 or 4 digit level')
-        return I_data['NAICS_STD'].values
+        hierarchy = code_hierarchy(codes)
+        matrix, groups = hierarchy.group_matrix(naics_RnD_group,groups,inferred_NAICS_lvl)
+        return matrix[hierarchy.index(codes)]
 
 
 
 class DataLoader:
-    def __init__(self,occLevel=3,saveData=True,data_path='tables/innovation_data',quietly=True):
+    def __init__(self,occLevel=3,saveData=True,data_path='tables/innovation_data',quietly=True,use_cache=True,cache_dir=None,lean=True,fetcher=None,n_workers=8):
         '''
         Class that contains multiple data loading functions. 
         Most of these functions need each other, which is why it makes sense to put this in a class.
         When given a data_path, it will save files in memory for future use. 
+        If use_cache=True, the processed national tables are stored in cache_dir (default: data_path/processed, see ProcessedTableCache).
+        If lean=True, the tables are stored with the dtypes of TABLE_SCHEMAS (categorical codes, downcasted counts).
+        Remote files are retrieved with the given fetcher (see APICalls.fetch), with at most n_workers concurrent downloads.
         '''
         self.occLevel   = (occLevel if occLevel<=2 else occLevel+1) 
         self.data_path  = data_path
         self.saveData   = saveData
         self.quietly    = quietly
+        self.lean       = lean
+        self.fetcher    = fetcher
+        self.n_workers  = n_workers
+        self.cache      = (ProcessedTableCache(cache_dir if cache_dir is not None else os.path.join(data_path,'processed'),quietly=quietly) if use_cache else None)
 
         # Tables used for model training:
         self.pop_msa = None
@@ -245,6 +363,8 @@ class DataLoader:
         self.RECPI = None
         self.RnD   = None
         self.IO_data = None
+        self.salaries = None
+        self.output_per_employee = None
 
         self.emp_msa_ind = None
 
@@ -255,6 +375,26 @@ class DataLoader:
         self.skill_names     = None
         self.knowledge_names = None
 
+    def _processed_tables(self,names,sources,build,occLevel=None):
+        '''
+        Returns the tables built by build (dict name:DataFrame) from the given source files, 
+        using the processed table cache when enabled (see ProcessedTableCache.get_tables).
+        '''
+        if self.cache is None:
+            return build()
+        return self.cache.get_tables(names,sources,build,occLevel=occLevel)
+
+    def _processed_table(self,name,sources,build,occLevel=None):
+        return self._processed_tables([name],sources,lambda: {name:build()},occLevel=occLevel)[name]
+
+    def _lean(self,name,table):
+        '''
+        Applies the schema of the given table (see TABLE_SCHEMAS) if lean=True.
+        '''
+        if self.lean:
+            return apply_schema(table,TABLE_SCHEMAS[name])
+        return table
+
     def load_RECPI(self,return_data=False):
         '''
         Loads entrepreneruship data from local directory (set in data_path=tables/innovation_data)
@@ -269,8 +409,10 @@ class DataLoader:
             file_path = os.path.join(self.data_path,'Entrepreneurship_by_ZIP_Code_policy.tab')
             if not os.path.isfile(file_path):
                 raise NameError('Entrepreneurship data not found. Please download from \nhttps://www.startupcartography.com/\nand save to '+self.data_path)
-            RECPI = pd.read_csv(file_path,delimiter='\t',dtype={'zipcode':str},low_memory=False)
-            self.RECPI = RECPI[RECPI['year'].isin([2014,2015,2016])].groupby(['zipcode','state']).agg({'EQI':'mean','SFR':'sum','RECPI':'sum'}).reset_index()[['zipcode','state','EQI','SFR','RECPI']]
+            def build():
+                RECPI = pd.read_csv(file_path,delimiter='\t',dtype={'zipcode':str},low_memory=False)
+                return RECPI[RECPI['year'].isin([2014,2015,2016])].groupby(['zipcode','state']).agg({'EQI':'mean','SFR':'sum','RECPI':'sum'}).reset_index()[['zipcode','state','EQI','SFR','RECPI']]
+            self.RECPI = self._processed_table('RECPI',[file_path],build)
         if return_data:
             return self.RECPI
 
@@ -279,20 +421,22 @@ class DataLoader:
         Loads employment by industry and occupation. 
         '''
         if self.IO_data is None:
-            if not os.path.isfile(os.path.join(self.data_path,'nat4d_M2018_dl.csv')):
-                url = 'https://www.bls.gov/oes/special.requests/oesm18in4.zip'
-                fname = 'oesm18in4/nat4d_M2018_dl.xlsx'
-                if not self.quietly:
-                    print('Loading IO data')
-                IO_dataRaw = load_zipped_excel(url,fname)
-                IO_dataRaw.to_csv(os.path.join(self.data_path,'nat4d_M2018_dl.csv'),index=False)
-            else:
-                IO_dataRaw = pd.read_csv(os.path.join(self.data_path,'nat4d_M2018_dl.csv'),low_memory=False)
-            IO_data = IO_dataRaw[(IO_dataRaw['OCC_GROUP']=='detailed')&(IO_dataRaw['TOT_EMP']!='**')]
-            IO_data = IO_data.astype({'TOT_EMP': 'float'})
-            IO_data = IO_data.assign(NAICS=('00'+IO_data['NAICS'].astype(str)).str[-6:])
-            IO_data = IO_data.assign(SELECTED_LEVEL=IO_data['OCC_CODE'].str[:self.occLevel])
-            self.IO_data = IO_data.groupby(['NAICS','SELECTED_LEVEL']).sum()[['TOT_EMP']].reset_index()
+            def build():
+                if not os.path.isfile(os.path.join(self.data_path,'nat4d_M2018_dl.csv')):
+                    url = 'https://www.bls.gov/oes/special.requests/oesm18in4.zip'
+                    fname = 'oesm18in4/nat4d_M2018_dl.xlsx'
+                    if not self.quietly:
+                        print('Loading IO data')
+                    IO_dataRaw = load_zipped_excel(url,fname)
+                    IO_dataRaw.to_csv(os.path.join(self.data_path,'nat4d_M2018_dl.csv'),index=False)
+                else:
+                    IO_dataRaw = pd.read_csv(os.path.join(self.data_path,'nat4d_M2018_dl.csv'),low_memory=False)
+                IO_data = IO_dataRaw[(IO_dataRaw['OCC_GROUP']=='detailed')&(IO_dataRaw['TOT_EMP']!='**')]
+                IO_data = IO_data.astype({'TOT_EMP': 'float'})
+                IO_data = IO_data.assign(NAICS=('00'+IO_data['NAICS'].astype(str)).str[-6:])
+                IO_data = IO_data.assign(SELECTED_LEVEL=IO_data['OCC_CODE'].str[:self.occLevel])
+                return IO_data.groupby(['NAICS','SELECTED_LEVEL']).sum()[['TOT_EMP']].reset_index()
+            self.IO_data = self._lean('IO_data',self._processed_table('IO_data',[os.path.join(self.data_path,'nat4d_M2018_dl.csv')],build,occLevel=self.occLevel))
         if return_data:
             return self.IO_data
 
@@ -315,51 +459,44 @@ class DataLoader:
                 zip_knowledge
 
         '''
-        onet_url = 'https://www.onetcenter.org/dl_files/database/db_24_2_excel/'
         if (self.skills is None)|(self.knowledge is None):
-            if os.path.isfile(os.path.join(self.data_path,'Skills.xlsx')):
-                if not self.quietly:
-                    print('Loading skillsRaw from file',os.path.join(self.data_path,'Skills.xlsx'))
-                skillsRaw = pd.read_excel(os.path.join(self.data_path,'Skills.xlsx'))
-            else:
-                if not self.quietly:
-                    print('Loading skillsRaw from url',onet_url+'Skills.xlsx')
-                skillsRaw = pd.read_excel(onet_url+'Skills.xlsx')
-                if self.saveData:
-                    skillsRaw.to_excel(os.path.join(self.data_path,'Skills.xlsx'),index=False)
-            if not self.quietly:
-                print('Grouping up skills')
-            skills = self.group_up_skills(skillsRaw)
-            skills = skills[['SELECTED_LEVEL','Element ID','Data Value']].drop_duplicates()
-            self.skills = skills
-            self.skill_names = skillsRaw[['Element ID','Element Name']].drop_duplicates()
+            self.skills,self.skill_names = self._load_onet_elements('Skills.xlsx','skills')
             if include_employment:
                 if not self.quietly:
                     print('Getting employment by msa by skill')
-                self.msa_skills = self._aggregate_to_GEO(skills,geoType='MSA')
-            
+                self.msa_skills = self._aggregate_to_GEO(self.skills,geoType='MSA')
             
-            if os.path.isfile(os.path.join(self.data_path,'Knowledge.xlsx')):
+            self.knowledge,self.knowledge_names = self._load_onet_elements('Knowledge.xlsx','knowledge')
+            if include_employment:
                 if not self.quietly:
-                    print('Loading knowledgeRaw from file',os.path.join(self.data_path,'Knowledge.xlsx'))
-                knowledgeRaw = pd.read_excel(os.path.join(self.data_path,'Knowledge.xlsx'))
+                    print('Getting employment by zipcode by knowledge')
+                self.zip_knowledge = self._aggregate_to_GEO(self.knowledge,geoType='ZIP')
+
+    def _load_onet_elements(self,fname,label):
+        '''
+        Loads one ONET file (Skills.xlsx or Knowledge.xlsx) and groups it up to occLevel (see group_up_skills).
+        Returns the grouped elements and the element names.
+        '''
+        onet_url = 'https://www.onetcenter.org/dl_files/database/db_24_2_excel/'
+        def build():
+            if os.path.isfile(os.path.join(self.data_path,fname)):
+                if not self.quietly:
+                    print('Loading {}Raw from file'.format(label),os.path.join(self.data_path,fname))
+                elementsRaw = pd.read_excel(os.path.join(self.data_path,fname))
             else:
                 if not self.quietly:
-                    print('Loading knowledgeRaw from url',onet_url+'Knowledge.xlsx')
-                knowledgeRaw = pd.read_excel(onet_url+'Knowledge.xlsx')
+                    print('Loading {}Raw from url'.format(label),onet_url+fname)
+                elementsRaw = pd.read_excel(onet_url+fname)
                 if self.saveData:
-                    knowledgeRaw.to_excel(os.path.join(self.data_path,'Knowledge.xlsx'),index=False)
+                    elementsRaw.to_excel(os.path.join(self.data_path,fname),index=False)
             if not self.quietly:
-                print('Grouping up knowledge')
-            knowledge = self.group_up_skills(knowledgeRaw)
-            knowledge = knowledge[['SELECTED_LEVEL','Element ID','Data Value']].drop_duplicates()               
-            self.knowledge = knowledge
-            self.knowledge_names = knowledgeRaw[['Element ID','Element Name']].drop_duplicates()
-            if include_employment:
-                if not self.quietly:
-                    print('Getting employment by zipcode by knowledge')
-                self.zip_knowledge = self._aggregate_to_GEO(knowledge,geoType='ZIP')
-
+                print('Grouping up {}'.format(label))
+            elements = self.group_up_skills(elementsRaw)
+            elements = elements[['SELECTED_LEVEL','Element ID','Data Value']].drop_duplicates()
+            return {label:elements,label+'_names':elementsRaw[['Element ID','Element Name']].drop_duplicates()}
+        sources = [os.path.join(self.data_path,fname),os.path.join(self.data_path,'national_M2018_dl.csv')]
+        tables = self._processed_tables([label,label+'_names'],sources,build,occLevel=self.occLevel)
+        return self._lean(label,tables[label]),tables[label+'_names']
 
     def _aggregate_to_GEO(self,skills,geoType='MSA',pivot=True):
         '''
@@ -391,14 +528,32 @@ class DataLoader:
         else:
             raise NameError('Unrecognized geoType:'+geoType)
         emp = (self.emp_msa if geoType=='MSA' else self.emp_zip)
-        msa_skills = pd.merge(emp,skills)
-        msa_skills = pd.merge(msa_skills,emp.groupby(geoCol).sum()[['TOT_EMP']].rename(columns={'TOT_EMP':'TOT_EMP_MSA'}).reset_index())
-        msa_skills['w'] = msa_skills['TOT_EMP']/msa_skills['TOT_EMP_MSA']
-        msa_skills['Data Value'] = msa_skills['Data Value']*msa_skills['w']
-        msa_skills = msa_skills.groupby([geoCol,'Element ID']).sum()[['Data Value']].reset_index()
+        # skill level per geo: (geo x occupation employment share) . (occupation x element value)
+        geos,geo_index = factorize_codes(emp[geoCol])
+        occupations,emp_occ_index = factorize_codes(pd.concat([plain_codes(emp['SELECTED_LEVEL']),plain_codes(skills['SELECTED_LEVEL'])]))
+        skill_occ_index = emp_occ_index[len(emp):]
+        emp_occ_index = emp_occ_index[:len(emp)]
+        elements,element_index = factorize_codes(skills['Element ID'])
+
+        TOT_EMP = np.nan_to_num(emp['TOT_EMP'].values.astype(float))
+        TOT_EMP_MSA = np.bincount(geo_index,weights=TOT_EMP,minlength=len(geos))
+        shares = sparse.csr_matrix((share_of_total(TOT_EMP,TOT_EMP_MSA[geo_index]),(geo_index,emp_occ_index)),shape=(len(geos),len(occupations)))
+        values = sparse.csr_matrix((np.nan_to_num(skills['Data Value'].values.astype(float)),(skill_occ_index,element_index)),shape=(len(occupations),len(elements)))
+        geo_values = np.asarray((shares.dot(values)).todense())
+        # (geo, element) pairs with at least one occupation in both tables
+        present = sparse.csr_matrix((np.ones(len(emp)),(geo_index,emp_occ_index)),shape=shares.shape).dot(
+                  sparse.csr_matrix((np.ones(len(skills)),(skill_occ_index,element_index)),shape=values.shape))
+        present = np.asarray(present.todense())>0
+
         if pivot:
-            msa_skills = msa_skills.pivot_table(values='Data Value',index=geoCol,columns='Element ID').reset_index().fillna(0)
+            rows = present.any(axis=1)
+            columns = present.any(axis=0)
+            msa_skills = pd.DataFrame(np.where(present,geo_values,0)[rows][:,columns],columns=list(elements[columns]))
+            msa_skills.insert(0,geoCol,geos[rows])
             msa_skills.columns = msa_skills.columns.values.tolist()
+        else:
+            rows,columns = np.nonzero(present)
+            msa_skills = pd.DataFrame({geoCol:geos[rows],'Element ID':elements[columns],'Data Value':geo_values[rows,columns]})
         return msa_skills
 
     def group_up_skills(self,skillsRaw,normalize=False):
@@ -422,15 +577,30 @@ class DataLoader:
 
         skills = skillsRaw[['O*NET-SOC Code','Element ID','Element Name','Data Value','Recommend Suppress','Not Relevant']]
         skills = skills[(skills['Not Relevant']!='Yes')&(skills['Recommend Suppress']!='Y')]
-        skills['SELECTED_LEVEL'] = skills['O*NET-SOC Code'].str[:self.occLevel]
-        skills['OCC_CODE'] = skills['O*NET-SOC Code'].str[:7]
-        skills = pd.merge(skills,empOcc[['OCC_CODE','TOT_EMP']])
-        skills = pd.merge(skills,empOcc.groupby('SELECTED_LEVEL').sum()[['TOT_EMP']].reset_index().rename(columns={'TOT_EMP':'TOT_EMP_3'}))
-        skills['w'] = skills['TOT_EMP']/skills['TOT_EMP_3']
-        skills['Data Value'] = skills['Data Value']*skills['w']
-        skills = skills.groupby(['SELECTED_LEVEL','Element ID','Element Name']).sum()[['Data Value']].reset_index()
+
+        # (level x occupation employment share) . (occupation x element value)
+        occupations,emp_occ_index = factorize_codes(pd.concat([plain_codes(empOcc['OCC_CODE']),skills['O*NET-SOC Code'].str[:7]]))
+        skill_occ_index = emp_occ_index[len(empOcc):]
+        emp_occ_index = emp_occ_index[:len(empOcc)]
+        levels,level_index = factorize_codes(empOcc['SELECTED_LEVEL'])
+        TOT_EMP = np.nan_to_num(empOcc['TOT_EMP'].values.astype(float))
+        TOT_EMP_3 = np.bincount(level_index,weights=TOT_EMP,minlength=len(levels))
+        shares = sparse.csr_matrix((share_of_total(TOT_EMP,TOT_EMP_3[level_index]),(level_index,emp_occ_index)),shape=(len(levels),len(occupations)))
+
+        element_keys = pd.MultiIndex.from_arrays([skills['Element ID'].values,skills['Element Name'].values])
+        element_index,elements = element_keys.factorize(sort=True)
+        values = sparse.csr_matrix((np.nan_to_num(skills['Data Value'].values.astype(float)),(skill_occ_index,element_index)),shape=(len(occupations),len(elements)))
+        level_values = np.asarray(shares.dot(values).todense())
+        # (level, element) pairs with at least one occupation in both tables
+        present = sparse.csr_matrix((np.ones(len(empOcc)),(level_index,emp_occ_index)),shape=shares.shape).dot(
+                  sparse.csr_matrix((np.ones(len(skills)),(skill_occ_index,element_index)),shape=values.shape))
+        rows,columns = np.nonzero(np.asarray(present.todense())>0)
+        skills = pd.DataFrame({'SELECTED_LEVEL':levels[rows],
+                               'Element ID':elements.get_level_values(0)[columns],
+                               'Element Name':elements.get_level_values(1)[columns],
+                               'Data Value':level_values[rows,columns]})
         if normalize:
-            skills = pd.merge(skills,skills.groupby('SELECTED_LEVEL').sum()[['Data Value']].rename(columns={'Data Value':'Normalization'}).reset_index())
+            skills = pd.merge(skills,skills.groupby('SELECTED_LEVEL',observed=True)[['Data Value']].sum().rename(columns={'Data Value':'Normalization'}).reset_index())
             skills['Data Value'] = skills['Data Value']/skills['Normalization']
         return skills
 
@@ -455,21 +625,23 @@ class DataLoader:
             self.pop_msa = pop_msa
 
         if self.emp_msa is None:
-            if not os.path.isfile(os.path.join(self.data_path,'MSA_M2018_dl.csv')):
-                url = 'https://www.bls.gov/oes/special.requests/oesm18ma.zip'
-                empRaw = load_zipped_excel(url,'oesm18ma/MSA_M2018_dl.xlsx')
-                if self.saveData:
-                    empRaw.to_csv(os.path.join(self.data_path,'MSA_M2018_dl.csv'),index=False)
-            else:
-                empRaw = pd.read_csv(os.path.join(self.data_path,'MSA_M2018_dl.csv'),low_memory=False)
-            emp = empRaw[(empRaw['OCC_GROUP']=='detailed')&(empRaw['TOT_EMP']!='**')]
-            emp = emp.astype({'TOT_EMP': 'float'})
-            emp = emp[['AREA','OCC_CODE','TOT_EMP']].rename(columns={'AREA':'GEOID'})
-            emp['GEOID'] = emp['GEOID'].astype(str)
-            emp['SELECTED_LEVEL'] = emp['OCC_CODE'].str[:self.occLevel]
-            emp = emp.groupby(['GEOID','SELECTED_LEVEL']).sum()[['TOT_EMP']].reset_index()
-            emp = emp[emp['GEOID'].isin(set(msas['GEOID']))]
-            self.emp_msa = emp
+            def build():
+                if not os.path.isfile(os.path.join(self.data_path,'MSA_M2018_dl.csv')):
+                    url = 'https://www.bls.gov/oes/special.requests/oesm18ma.zip'
+                    empRaw = load_zipped_excel(url,'oesm18ma/MSA_M2018_dl.xlsx')
+                    if self.saveData:
+                        empRaw.to_csv(os.path.join(self.data_path,'MSA_M2018_dl.csv'),index=False)
+                else:
+                    empRaw = pd.read_csv(os.path.join(self.data_path,'MSA_M2018_dl.csv'),low_memory=False)
+                emp = empRaw[(empRaw['OCC_GROUP']=='detailed')&(empRaw['TOT_EMP']!='**')]
+                emp = emp.astype({'TOT_EMP': 'float'})
+                emp = emp[['AREA','OCC_CODE','TOT_EMP']].rename(columns={'AREA':'GEOID'})
+                emp['GEOID'] = emp['GEOID'].astype(str)
+                emp['SELECTED_LEVEL'] = emp['OCC_CODE'].str[:self.occLevel]
+                return emp.groupby(['GEOID','SELECTED_LEVEL']).sum()[['TOT_EMP']].reset_index()
+            emp = self._processed_table('emp_msa',[os.path.join(self.data_path,'MSA_M2018_dl.csv')],build,occLevel=self.occLevel)
+            emp = emp[emp['GEOID'].isin(set(self.msas['GEOID']))]
+            self.emp_msa = self._lean('emp_msa',emp)
 
     def load_MSA_emp_byInd(self):
         '''
@@ -482,6 +654,11 @@ class DataLoader:
 
 
     def load_ZIP_data_byInd(self,year = '2016'):
+        '''
+        Loads employment by industry for each zip code from the LODES WAC files of all the states.
+        The state files are downloaded concurrently to data_path/LODES7, 
+        files already downloaded are reused so an interrupted download can be resumed.
+        '''
 
         if self.emp_zip_ind is None:
             if os.path.isfile(os.path.join(self.data_path,'us_wak_S00_JT00_{}_ZIPCODE.csv'.format(year))):
@@ -495,26 +672,26 @@ class DataLoader:
                 fname = '{}_wac_S000_JT00_{}.csv.gz'
                 base_url = 'https://lehd.ces.census.gov/data/lodes/LODES7/'
 
-                r = requests.get(base_url)
+                r = fetch(base_url,fetcher=self.fetcher)
                 soup = BeautifulSoup(r.content, 'html.parser')
                 states = [a[:-1] for a in [t.find('a')['href'] for t in soup.find_all('td') if t.find('a') is not None] if len(a.replace('/',''))==2]
 
+                files = [(os.path.join(base_url,'{}/wac',fname).format(state,state,year),os.path.join(self.data_path,'LODES7',fname.format(state,year))) for state in states]
+                fpaths = download_files(files,n_workers=self.n_workers,fetcher=self.fetcher,quietly=self.quietly)
+
                 emp_zip = []
-                for state in states:
-                    fpath = os.path.join(base_url,'{}/wac',fname)
-                    fpath = fpath.format(state,state,year)
-                    for i in range(3):
+                for fpath in fpaths:
+                    df = None
+                    if fpath is not None:
                         try:
                             if not self.quietly:
-                                print(fpath,i)
-                            df = pd.read_csv(fpath,compression='gzip',dtype={'w_geocode':str})
-                            break
-                        except:
-                            df = None
+                                print(fpath)
+                            df = self._read_LODES_wac(fpath)
+                        except Exception as e:
+                            # remove the file so that it is downloaded again in the next run
+                            print('Could not read {}: {}'.format(fpath,e))
+                            os.remove(fpath)
                     if df is not None:
-                        df = df[['w_geocode']+[c for c in df.columns if c[:2]=='CN']]
-                        df['GEOID'] = df['w_geocode'].str[:-3]
-                        df = df.drop('w_geocode',1).groupby('GEOID').sum().reset_index()
                         df_matched = pd.merge(df,zip_bg)
                         for c in [c for c in df_matched.columns if c[:2]=='CN']:
                             df_matched[c] = df_matched[c]*df_matched['weight']
@@ -524,13 +701,24 @@ class DataLoader:
                 if self.saveData:
                     emp_zip.to_csv(os.path.join(self.data_path,'us_wak_S00_JT00_{}_ZIPCODE.csv'.format(year)),index=False)
             emp_zip = emp_zip.assign(ZCTA5CE10 = ('000'+emp_zip['ZCTA5CE10'].astype(str)).str[-5:])
-            self.emp_zip_ind = emp_zip
+            self.emp_zip_ind = self._lean('emp_zip_ind',emp_zip)
+
+    def _read_LODES_wac(self,fpath,chunksize=500000):
+        '''
+        Reads a LODES WAC file in chunks, keeping only the employment by industry (CNS columns) aggregated to block groups (GEOID).
+        '''
+        block_groups = []
+        for chunk in pd.read_csv(fpath,compression='gzip',dtype={'w_geocode':str},usecols=lambda c: (c=='w_geocode')|(c[:2]=='CN'),chunksize=chunksize):
+            chunk['GEOID'] = chunk['w_geocode'].str[:-3]
+            block_groups.append(chunk.drop('w_geocode',axis=1).groupby('GEOID').sum())
+        return pd.concat(block_groups).groupby(level=0).sum().reset_index()
 
 
-    def load_ZIP_data(self):
+    def load_ZIP_data(self,chunk_size=2000):
         '''
         Loads employment data for each zip code from the LODES data. 
         It uses a self generated crosswalk between census blocks and zipcodes.
+        Employment by industry is distributed to occupations in chunks of chunk_size zip codes to limit the peak memory.
         '''
         year = '2016'
 
@@ -544,29 +732,35 @@ class DataLoader:
                       ('CNS13','55'),('CNS14','56'),('CNS15','61'),('CNS16','62'),('CNS17','71'),('CNS18','72'),('CNS19','81'),
                       ('CNS20','92')]
 
-                emp_zip = pd.melt(self.emp_zip_ind,id_vars='ZCTA5CE10',value_name='TOT_EMP')
-                emp_zip = pd.merge(emp_zip,pd.DataFrame(cw,columns=['variable','NAICS'])).drop('variable',1)
-                emp_zip = emp_zip[emp_zip['TOT_EMP']!=0]
-
                 match = pd.read_csv(os.path.join(SHAPES_PATH,'ZIP_MSA_matched_2019.csv'),dtype={'ZCTA5CE10':str})
-                emp_zip = emp_zip[emp_zip['ZCTA5CE10'].isin(set(match['ZCTA5CE10']))]
 
                 self.load_IO_data()
-                IO_data = self.IO_data.assign(NAICS = self.IO_data['NAICS'].str[:-4])
+                IO_data = self.IO_data.assign(NAICS = self.IO_data['NAICS'].astype(str).str[:-4])
                 IO_data.loc[IO_data['NAICS'].isin(['31','32','33']),'NAICS'] = '31-33'
                 IO_data.loc[IO_data['NAICS'].isin(['44','45']),'NAICS'] = '44-45'
                 IO_data.loc[IO_data['NAICS'].isin(['48','49']),'NAICS'] = '48-49'
-                IO_data = pd.merge(IO_data,IO_data.groupby('NAICS').sum().reset_index().rename(columns={'TOT_EMP':'TOT_EMP_NAICS'}))
+                IO_data = pd.merge(IO_data,IO_data.groupby('NAICS')[['TOT_EMP']].sum().reset_index().rename(columns={'TOT_EMP':'TOT_EMP_NAICS'}))
                 IO_data = IO_data.assign(weight=IO_data['TOT_EMP']/IO_data['TOT_EMP_NAICS'])
                 IO_data = IO_data[['NAICS','SELECTED_LEVEL','weight']]
 
-                emp_zip = pd.merge(emp_zip,IO_data)
-                emp_zip = emp_zip.assign(TOT_EMP=emp_zip['TOT_EMP']*emp_zip['weight']).groupby(['ZCTA5CE10','SELECTED_LEVEL']).sum()
-                emp_zip = emp_zip[['TOT_EMP']].reset_index()
+                emp_zip_ind = self.emp_zip_ind[self.emp_zip_ind['ZCTA5CE10'].isin(set(match['ZCTA5CE10']))]
+                zips = np.sort(emp_zip_ind['ZCTA5CE10'].astype(str).unique())
+                emp_zip = []
+                for i in range(0,len(zips),chunk_size):
+                    # all the rows of a zip code are in the same chunk, so the chunks can be aggregated separately
+                    chunk = emp_zip_ind[emp_zip_ind['ZCTA5CE10'].astype(str).isin(set(zips[i:i+chunk_size]))]
+                    chunk = pd.melt(chunk.astype({'ZCTA5CE10':str}),id_vars='ZCTA5CE10',value_name='TOT_EMP')
+                    chunk = pd.merge(chunk,pd.DataFrame(cw,columns=['variable','NAICS'])).drop('variable',axis=1)
+                    chunk = chunk[chunk['TOT_EMP']!=0]
+                    chunk = pd.merge(chunk,IO_data)
+                    chunk = chunk.assign(TOT_EMP=chunk['TOT_EMP']*chunk['weight']).groupby(['ZCTA5CE10','SELECTED_LEVEL'],observed=True)[['TOT_EMP']].sum()
+                    emp_zip.append(chunk.reset_index())
+                emp_zip = pd.concat(emp_zip,ignore_index=True)
+                emp_zip = emp_zip.astype({'SELECTED_LEVEL':str})
                 emp_zip = pd.merge(emp_zip,match)
                 if self.saveData:
                     emp_zip.to_csv(os.path.join(self.data_path,'us_wak_S00_JT00_{}_ZIPCODE_OCC.csv'.format(year)),index=False)
-            self.emp_zip = emp_zip
+            self.emp_zip = self._lean('emp_zip',emp_zip)
 
                 
     def load_OCC_data(self):
@@ -575,71 +769,127 @@ class DataLoader:
         This data is used to aggregate the occupation codes one level up.
         '''
         if self.emp_occ is None:
-            if not os.path.isfile(os.path.join(self.data_path,'national_M2018_dl.csv')):
-                url = 'https://www.bls.gov/oes/special.requests/oesm18nat.zip'
-                empOccRaw = load_zipped_excel(url,'oesm18nat/national_M2018_dl.xlsx')
-                if self.saveData:
-                    empOccRaw.to_csv(os.path.join(self.data_path,'national_M2018_dl.csv'),index=False)
-            else:
-                empOccRaw = pd.read_csv(os.path.join(self.data_path,'national_M2018_dl.csv'),low_memory=False)
-            empOcc = empOccRaw[empOccRaw['OCC_GROUP']=='detailed']
-            empOcc = empOcc[['OCC_CODE','TOT_EMP','OCC_GROUP']]
-            empOcc['SELECTED_LEVEL'] = empOcc['OCC_CODE'].str[:self.occLevel]
-            self.emp_occ = empOcc
+            def build():
+                if not os.path.isfile(os.path.join(self.data_path,'national_M2018_dl.csv')):
+                    url = 'https://www.bls.gov/oes/special.requests/oesm18nat.zip'
+                    empOccRaw = load_zipped_excel(url,'oesm18nat/national_M2018_dl.xlsx')
+                    if self.saveData:
+                        empOccRaw.to_csv(os.path.join(self.data_path,'national_M2018_dl.csv'),index=False)
+                else:
+                    empOccRaw = pd.read_csv(os.path.join(self.data_path,'national_M2018_dl.csv'),low_memory=False)
+                empOcc = empOccRaw[empOccRaw['OCC_GROUP']=='detailed']
+                empOcc = empOcc[['OCC_CODE','TOT_EMP','OCC_GROUP']]
+                empOcc['SELECTED_LEVEL'] = empOcc['OCC_CODE'].str[:self.occLevel]
+                return empOcc
+            self.emp_occ = self._lean('emp_occ',self._processed_table('emp_occ',[os.path.join(self.data_path,'national_M2018_dl.csv')],build,occLevel=self.occLevel))
     
     def load_RnD_data(self,return_data=False):
         '''
         Load data on RnD by industry.
         This data will be relevant for the innovation intensity of the industries in the area.
         '''
-        if not os.path.isfile(os.path.join(self.data_path,'nsf20311-tab002.csv')):
-            url = 'https://ncses.nsf.gov/pubs/nsf20311/assets/data-tables/tables/nsf20311-tab002.xlsx'
-            nsf = pd.read_excel(url)
-            if self.saveData:
-                nsf.to_csv(os.path.join(self.data_path,'nsf20311-tab002.csv'),index=False)
-        else:
-            nsf = pd.read_csv(os.path.join(self.data_path,'nsf20311-tab002.csv'),low_memory=False)
-        colnames = []
-        h = ''
-        for c1,c2 in (zip(*nsf.iloc[2:4].values)):
-            c1 = str(c1)
-            c2 = str(c2)
-            if c1!='nan':
-                h = c1
-            if (c1=='nan')&(c2=='nan'):
-                colnames.append(c1)
+        def build():
+            if not os.path.isfile(os.path.join(self.data_path,'nsf20311-tab002.csv')):
+                url = 'https://ncses.nsf.gov/pubs/nsf20311/assets/data-tables/tables/nsf20311-tab002.xlsx'
+                nsf = pd.read_excel(url)
+                if self.saveData:
+                    nsf.to_csv(os.path.join(self.data_path,'nsf20311-tab002.csv'),index=False)
             else:
-                if c2!='nan':
-                    colnames.append(h+' - '+c2)
+                nsf = pd.read_csv(os.path.join(self.data_path,'nsf20311-tab002.csv'),low_memory=False)
+            colnames = []
+            h = ''
+            for c1,c2 in (zip(*nsf.iloc[2:4].values)):
+                c1 = str(c1)
+                c2 = str(c2)
+                if c1!='nan':
+                    h = c1
+                if (c1=='nan')&(c2=='nan'):
+                    colnames.append(c1)
                 else:
-                    colnames.append(h)
-        nsf.columns = colnames
-        nsf = nsf.iloc[4:]
-        nsf = nsf[[c for c in nsf.columns if c!='nan']]
-
-        nsf = nsf[nsf['NAICS code']!='–']
-        nsf = nsf[nsf['NAICS code']!='\xa0']
-
-        selected = [
-            '311','312','313–16','321','322','323','324',
-            '325','326','327','331','332','333','334',
-            '335','336','337','339','454111–12',
-            '21','22','42','48–49','511','517','518',
-            'other 51','52','533','other 53','5413','5415','5417','other 54','621–23'
-        ]
-        nsf = nsf[nsf['NAICS code'].isin(selected)]
-        nsf.loc[nsf['NAICS code']=='454111–12','NAICS code'] = '4541'
-        nsf.loc[nsf['Worldwide R&D performance - Paid for by the company']=='11,873 - 12,096'] = 11985
-        nsf = nsf.assign(RnD_investment = 10e6*nsf['Domestic R&D performance - Paid for by the company'].astype(float))
-        self.RnD = nsf[['NAICS code','RnD_investment']]
+                    if c2!='nan':
+                        colnames.append(h+' - '+c2)
+                    else:
+                        colnames.append(h)
+            nsf.columns = colnames
+            nsf = nsf.iloc[4:]
+            nsf = nsf[[c for c in nsf.columns if c!='nan']]
+
+            nsf = nsf[nsf['NAICS code']!='–']
+            nsf = nsf[nsf['NAICS code']!='\xa0']
+
+            selected = [
+                '311','312','313–16','321','322','323','324',
+                '325','326','327','331','332','333','334',
+                '335','336','337','339','454111–12',
+                '21','22','42','48–49','511','517','518',
+                'other 51','52','533','other 53','5413','5415','5417','other 54','621–23'
+            ]
+            nsf = nsf[nsf['NAICS code'].isin(selected)]
+            nsf.loc[nsf['NAICS code']=='454111–12','NAICS code'] = '4541'
+            nsf.loc[nsf['Worldwide R&D performance - Paid for by the company']=='11,873 - 12,096'] = 11985
+            nsf = nsf.assign(RnD_investment = 10e6*nsf['Domestic R&D performance - Paid for by the company'].astype(float))
+            return nsf[['NAICS code','RnD_investment']]
+        self.RnD = self._processed_table('RnD',[os.path.join(self.data_path,'nsf20311-tab002.csv')],build)
         if return_data:
             return self.RnD
 
+    def load_salaries(self,return_data=False):
+        '''
+        Loads the mean annual salary of each occupation code (national OES data).
+        The excel file is only parsed when it changes (see ProcessedTableCache).
+        '''
+        file_path = os.path.join(self.data_path,'national_M2019_dl.xlsx')
+        def build():
+            salary_data = pd.read_excel(file_path)
+            salary_data = salary_data[['occ_code','a_mean']].drop_duplicates('occ_code',keep='last')
+            # wages not available are reported as '*' or '#'
+            salary_data = salary_data.assign(occ_code=salary_data['occ_code'].astype(str),a_mean=pd.to_numeric(salary_data['a_mean'],errors='coerce'))
+            return salary_data.reset_index(drop=True)
+        self.salaries = self._processed_table('salaries',[file_path],build)
+        if return_data:
+            return self.salaries
+
+    def load_output_per_employee(self,return_data=False):
+        '''
+        Loads the output (sales, in thousands of dollars) per employee of each NAICS code.
+        Code ranges (e.g. 31-33) are expanded to each code in the range.
+        '''
+        file_path = os.path.join(self.data_path,'USA_industry_ouput.csv')
+        def build():
+            industry_ouput = pd.read_csv(file_path, skiprows=1)
+            codes = industry_ouput['2017 NAICS code'].astype(str)
+            output_per_emp = (industry_ouput['Sales, value of shipments, or revenue ($1,000)']/industry_ouput['Number of employees']).values
+            B = codes.str.contains('-').to_numpy(dtype=bool)
+            bounds = codes[B].str.split('-',n=1)
+            starts = np.zeros(len(codes),dtype=int)
+            starts[B] = bounds.str[0].str.strip().astype(int).values
+            n_codes = np.ones(len(codes),dtype=int)
+            n_codes[B] = bounds.str[1].str.split('(').str[0].str.strip().astype(int).values-starts[B]+1
+            rows = np.repeat(np.arange(len(codes)),n_codes)
+            # position of each code within its range
+            offsets = np.arange(len(rows))-np.repeat(np.cumsum(n_codes)-n_codes,n_codes)
+            expanded = np.where(B[rows],(starts[rows]+offsets).astype(str),codes.to_numpy(dtype=object)[rows].astype(str)).astype(object)
+            table = pd.DataFrame({'NAICS':expanded,'output_per_employee':output_per_emp[rows]})
+            # later rows replace the codes of earlier ones
+            return table.drop_duplicates('NAICS',keep='last').reset_index(drop=True)
+        self.output_per_employee = self._processed_table('output_per_employee',[file_path],build)
+        if return_data:
+            return self.output_per_employee
+
 
-    def load_patent_data(self,pop_th=100000):
+    def load_patent_data(self,pop_th=100000,patents_dir=None,chunksize=1000000):
         '''
         Loads Patent Data from patentsView for each MSA.
         Only consideres MSAs above pop_th
+
+        Parameters
+        ----------
+        pop_th : int (default=100000)
+        patents_dir : str (optional)
+            Directory with local copies of the patentsView dumps (see APICalls.patentsViewRead). 
+            Defaults to data_path/patentsView if it exists, otherwise the tables are read from patentsView.
+        chunksize : int (default=1000000)
+            Number of rows read at a time from each table (see _stream_patent_tables).
         '''
         if (self.msas is None)|(self.pop_msa is None):
             self.load_MSA_data()
@@ -649,23 +899,9 @@ class DataLoader:
 
         if self.nPats is None:
             if not os.path.isfile(os.path.join(self.data_path,'nPats.csv')):
-                application = patentsViewDownload('application')
-                application['year'] = application['date'].str[:4].astype(float)
-                application = application[(application['year']>=2010)&
-                                          (application['year']<=2020)&
-                                          (application['country']=='US')]
-                patentSet = set(application['patent_id'])
-
-                patent_inventor = patentsViewDownload('patent_inventor')
-                patent_inventor = patent_inventor[patent_inventor['patent_id'].isin(patentSet)]
-                inventorSet = set(patent_inventor['inventor_id'])
-
-                location_inventor = patentsViewDownload('location_inventor')
-                location_inventor = location_inventor[location_inventor['inventor_id'].isin(inventorSet)]
-                locationSet = set(location_inventor['location_id'])
-
-                location = patentsViewDownload('location')
-                location = location[location['id'].isin(locationSet)]
+                if (patents_dir is None)&(os.path.isdir(os.path.join(self.data_path,'patentsView'))):
+                    patents_dir = os.path.join(self.data_path,'patentsView')
+                patent_inventor,location_inventor,location = self._stream_patent_tables(patents_dir=patents_dir,chunksize=chunksize)
 
                 location = gpd.GeoDataFrame(location,geometry=gpd.points_from_xy(location.longitude, location.latitude),crs={'init': 'epsg:4269'})
                 matched = gpd.sjoin(location,msas)
@@ -683,11 +919,269 @@ class DataLoader:
             else:
                 self.nPats = pd.read_csv(os.path.join(self.data_path,'nPats.csv'),dtype={'GEOID':str},low_memory=False)
 
+    def _stream_patent_tables(self,patents_dir=None,chunksize=1000000):
+        '''
+        Reads the patentsView tables in chunks of chunksize rows, with only the needed columns, 
+        keeping the rows linked to US patent applications between 2010 and 2020:
+            patent_inventor: patent_id, inventor_id
+            location_inventor: location_id, inventor_id
+            location: id, latitude, longitude
+        Each table is filtered chunk by chunk against the ids kept from the previous one, 
+        so the memory used is bounded by the chunk size and the kept rows.
+        '''
+        def read(tableName,usecols,dtype):
+            if not self.quietly:
+                print('Reading patentsView table',tableName)
+            return patentsViewRead(tableName,usecols=usecols,dtype=dtype,chunksize=chunksize,local_dir=patents_dir)
+
+        patentSet = set()
+        for chunk in read('application',['patent_id','date','country'],{'patent_id':str,'date':str,'country':str}):
+            year = chunk['date'].str[:4].astype(float)
+            chunk = chunk[(year>=2010)&(year<=2020)&(chunk['country']=='US')]
+            patentSet.update(chunk['patent_id'])
+
+        patent_inventor = pd.concat([chunk[chunk['patent_id'].isin(patentSet)] 
+                                     for chunk in read('patent_inventor',['patent_id','inventor_id'],str)],ignore_index=True)
+        inventorSet = set(patent_inventor['inventor_id'])
+        del patentSet
+
+        location_inventor = pd.concat([chunk[chunk['inventor_id'].isin(inventorSet)] 
+                                       for chunk in read('location_inventor',['location_id','inventor_id'],str)],ignore_index=True)
+        locationSet = set(location_inventor['location_id'])
+        del inventorSet
+
+        location = pd.concat([chunk[chunk['id'].isin(locationSet)] 
+                              for chunk in read('location',['id','latitude','longitude'],{'id':str,'latitude':float,'longitude':float})],ignore_index=True)
+        return patent_inventor,location_inventor,location
+
+
+class ProcessedTableCache:
+    '''
+    On-disk cache of the processed (filtered and grouped) tables built by DataLoader from the raw CSV and XLSX sources.
+    Tables are stored as parquet if pyarrow is available, otherwise as pickle, keeping their dtypes. 
+    Low-cardinality string columns are stored as categoricals and restored to their original dtype when read,
+    so a cached table is identical to the one built from the raw sources.
+
+    Each entry is keyed by the table name, the occupation level and the fingerprint (size and modification time) 
+    of its source files: when a source file changes, the entry is rebuilt from the raw sources.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory where the processed tables are stored.
+    quietly : boolean (default=True)
+    '''
+    def __init__(self,cache_dir,quietly=True):
+        self.cache_dir = cache_dir
+        self.quietly   = quietly
+        self.extension = ('parquet' if HAS_PYARROW else 'pkl')
+
+    def fingerprint(self,sources):
+        '''
+        Returns a hash of the name, size and modification time of the source files, or None if any of them does not exist.
+        '''
+        return file_fingerprint(sources)
+
+    def entry_path(self,name,occLevel,fingerprint):
+        return os.path.join(self.cache_dir,'{}_occ{}_{}.{}'.format(name,occLevel,fingerprint,self.extension))
+
+    def _write(self,table,fpath):
+        '''
+        Writes the table atomically, storing low-cardinality string columns as categoricals.
+        '''
+        dtypes = {c:str(table[c].dtype) for c in table.columns}
+        stored = table.copy(deep=False)
+        for c in stored.columns:
+            if (stored[c].dtype==object)|(str(stored[c].dtype) in ['str','string']):
+                values = stored[c].dropna()
+                if values.map(type).eq(str).all() and (values.nunique()<=0.5*len(values)):
+                    stored[c] = stored[c].astype('category')
+        stored.attrs = {'dtypes':dtypes}
+        content = BytesIO()
+        if self.extension=='parquet':
+            stored.to_parquet(content)
+        else:
+            stored.to_pickle(content)
+        atomic_write(fpath,content.getvalue())
+
+    def _read(self,fpath):
+        table = (pd.read_parquet(fpath) if self.extension=='parquet' else pd.read_pickle(fpath))
+        dtypes = table.attrs.get('dtypes',{})
+        for c in table.columns:
+            if isinstance(table[c].dtype,pd.CategoricalDtype) and (dtypes.get(c)!='category'):
+                table[c] = table[c].astype(dtypes.get(c,object))
+        table.attrs = {}
+        return table
+
+    def get_tables(self,names,sources,build,occLevel=None):
+        '''
+        Returns the processed tables (dict name:DataFrame) built from the given sources. 
+        They are read from the cache if all the entries exist for the current fingerprint of the sources, 
+        otherwise build() is called and its result (dict name:DataFrame) is stored.
+
+        Parameters
+        ----------
+        names : list
+            Names of the tables returned by build.
+        sources : list
+            Paths to the raw files the tables are built from. 
+            If any of them does not exist before the build, the tables are only cached if it exists after (e.g. downloaded and saved).
+        build : function
+            Function without arguments that builds the tables from the raw sources.
+        occLevel : int
+            Occupation level used to build the tables (None if they do not depend on it).
+        '''
+        fingerprint = self.fingerprint(sources)
+        if fingerprint is not None:
+            paths = {name:self.entry_path(name,occLevel,fingerprint) for name in names}
+            if all([os.path.isfile(fpath) for fpath in paths.values()]):
+                try:
+                    if not self.quietly:
+                        print('Loading processed tables from cache:',', '.join(names))
+                    return {name:self._read(fpath) for name,fpath in paths.items()}
+                except Exception as e:
+                    warn('Could not read processed tables {} from cache ({}), loading from raw sources'.format(', '.join(names),e))
+        tables = build()
+        fingerprint = self.fingerprint(sources)
+        if fingerprint is not None:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                for name in names:
+                    for fname in os.listdir(self.cache_dir):
+                        if fname.startswith('{}_occ{}_'.format(name,occLevel)):
+                            os.remove(os.path.join(self.cache_dir,fname))
+                    self._write(tables[name],self.entry_path(name,occLevel,fingerprint))
+            except Exception as e:
+                warn('Could not cache processed tables {} ({})'.format(', '.join(names),e))
+        return tables
+
+    def get_table(self,name,sources,build,occLevel=None):
+        '''
+        Same as get_tables for a single table (build returns a DataFrame).
+        '''
+        return self.get_tables([name],sources,lambda: {name:build()},occLevel=occLevel)[name]
+
+
+class DataRegistry:
+    '''
+    Process-wide registry of the national tables loaded by DataLoader.
+    Each table is loaded once (per occLevel and data_path) and shared by all the indicators of the process,
+    instead of each indicator parsing and holding its own copy.
+
+    Tables are handed out as shallow copies of the shared table, which share its data: adding, dropping 
+    or replacing whole columns of a shallow copy does not change the shared table, but in place writes 
+    (e.g. .loc[...] = value or fillna(inplace=True)) change it for every indicator of the process, 
+    unless pandas copy-on-write is enabled. The indicators only read the tables and build new ones from them; 
+    a caller that needs to modify a table in place must work on table.copy().
+
+    Loading is thread-safe: concurrent requests for the same table wait for a single load.
+    '''
+    # table name: (DataLoader method, keyword arguments)
+    TABLE_LOADERS = {
+        'IO_data':         ('load_IO_data',  {}),
+        'skills':          ('load_onet_data',{'include_employment':False}),
+        'knowledge':       ('load_onet_data',{'include_employment':False}),
+        'skill_names':     ('load_onet_data',{'include_employment':False}),
+        'knowledge_names': ('load_onet_data',{'include_employment':False}),
+        'RnD':             ('load_RnD_data', {}),
+        'RECPI':           ('load_RECPI',    {}),
+        'salaries':            ('load_salaries',            {}),
+        'output_per_employee': ('load_output_per_employee', {})
+    }
+
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._loaders = {}
+        self._tables  = {}
+
+    def _get_loader(self,occLevel,data_path):
+        '''
+        Returns the DataLoader (and its lock) of the given occLevel and data_path, creating it if needed.
+        '''
+        key = (occLevel,data_path)
+        with self._lock:
+            if key not in self._loaders:
+                self._loaders[key] = (DataLoader(occLevel=occLevel,data_path=data_path),threading.Lock())
+            return self._loaders[key]
+
+    def shared_table(self,name,occLevel=3,data_path='tables/innovation_data'):
+        '''
+        Returns a shallow copy of the given table, loading it the first time it is requested.
+        The copy shares the data of the table: it must not be modified in place (see DataRegistry).
+
+        Parameters
+        ----------
+        name : str
+            Name of the table (see DataRegistry.TABLE_LOADERS).
+        occLevel : int
+            Occupation level passed to the DataLoader.
+        data_path : str
+            Data path passed to the DataLoader.
+        '''
+        if name not in self.TABLE_LOADERS:
+            raise NameError('Unknown table: {}. Options are: {}'.format(name,', '.join(self.TABLE_LOADERS)))
+        key = (name,occLevel,data_path)
+        with self._lock:
+            table = self._tables.get(key)
+        if table is None:
+            loader,loader_lock = self._get_loader(occLevel,data_path)
+            with loader_lock:
+                with self._lock:
+                    table = self._tables.get(key)
+                if table is None:
+                    method,kwargs = self.TABLE_LOADERS[name]
+                    getattr(loader,method)(**kwargs)
+                    table = getattr(loader,name)
+                    if table is None:
+                        raise NameError('DataLoader.{} did not load the table {}'.format(method,name))
+                    with self._lock:
+                        # register every table loaded by the same method (e.g. skills and knowledge)
+                        for other,(other_method,_) in self.TABLE_LOADERS.items():
+                            if (other_method==method)&(getattr(loader,other) is not None):
+                                self._tables.setdefault((other,occLevel,data_path),getattr(loader,other))
+        return table.copy(deep=False)
+
+    def memory_report(self):
+        '''
+        Returns a DataFrame with the number of rows, columns and bytes (deep memory usage) of each loaded table.
+        '''
+        with self._lock:
+            tables = list(self._tables.items())
+        report = pd.DataFrame([{'table':name,'occLevel':occLevel,'data_path':data_path,
+                                'rows':len(table),'columns':table.shape[1],
+                                'bytes':int(table.memory_usage(deep=True).sum())}
+                               for (name,occLevel,data_path),table in tables],
+                              columns=['table','occLevel','data_path','rows','columns','bytes'])
+        return report.sort_values(by='bytes',ascending=False).reset_index(drop=True)
+
+    def clear(self):
+        '''
+        Drops all the loaded tables. Views handed out before remain valid.
+        '''
+        with self._lock:
+            self._loaders = {}
+            self._tables  = {}
+
+DATA_REGISTRY = DataRegistry()
+
 
 #############
 # Functions #
 #############
                 
+def file_fingerprint(sources):
+    '''
+    Returns a hash of the name, size and modification time of the source files, or None if any of them does not exist.
+    '''
+    stats = []
+    for source in sources:
+        if not os.path.isfile(source):
+            return None
+        stat = os.stat(source)
+        stats.append('{}:{}:{}'.format(os.path.basename(source),stat.st_size,stat.st_mtime_ns))
+    return hashlib.md5('|'.join(stats).encode()).hexdigest()[:16]
+
 def flatten_grid_cell_attributes(type_def, height, attribute_name, 
                                  area_per_floor, return_units='capacity'):
     if isinstance(height, list):
@@ -731,6 +1225,283 @@ def collect_grid_cell_counts(list_of_attr_dicts):
     return aggregated
                 
 
+# Dtypes of the DataLoader tables used when lean=True (see apply_schema).
+# 'category' for code columns, 'integer' for counts (downcasted only if all the values are integers).
+# Column names ending in * apply to all the columns with that prefix.
+TABLE_SCHEMAS = {
+    'IO_data':     {'NAICS':'category','SELECTED_LEVEL':'category','TOT_EMP':'integer'},
+    'emp_msa':     {'GEOID':'category','SELECTED_LEVEL':'category','TOT_EMP':'integer'},
+    'emp_occ':     {'OCC_CODE':'category','OCC_GROUP':'category','SELECTED_LEVEL':'category','TOT_EMP':'integer'},
+    'emp_zip_ind': {'ZCTA5CE10':'category','CNS*':'integer'},
+    'emp_zip':     {'ZCTA5CE10':'category','SELECTED_LEVEL':'category','TOT_EMP':'integer'},
+    'skills':      {'SELECTED_LEVEL':'category','Element ID':'category'},
+    'knowledge':   {'SELECTED_LEVEL':'category','Element ID':'category'}
+}
+
+def plain_codes(codes):
+    '''
+    Returns the values of a code column, converting categorical columns to the dtype of their categories.
+    '''
+    if isinstance(codes.dtype,pd.CategoricalDtype):
+        return codes.astype(codes.cat.categories.dtype)
+    return codes
+
+def factorize_codes(codes):
+    '''
+    Returns the sorted unique values of a code column (see plain_codes) and the index of each row in them.
+    '''
+    index,uniques = pd.factorize(plain_codes(codes),sort=True)
+    return np.asarray(uniques),index
+
+def share_of_total(values,totals):
+    '''
+    Returns values/totals, with 0 where the total is 0.
+    '''
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.nan_to_num(values/totals)
+
+def apply_schema(table,schema):
+    '''
+    Returns the table with the dtypes of the given schema (see TABLE_SCHEMAS).
+    Columns not in the table are ignored, and counts are only downcasted when no value changes.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+    schema : dict
+        Column name (or prefix ending in *) : 'category', 'integer' or any pandas dtype.
+    '''
+    dtypes = {}
+    for c in table.columns:
+        kind = schema.get(c)
+        if kind is None:
+            prefixes = [k for k in schema if (k[-1]=='*')&(str(c).startswith(k[:-1]))]
+            kind = (schema[prefixes[0]] if len(prefixes)!=0 else None)
+        if kind=='integer':
+            values = table[c]
+            if (values.dtype.kind in 'iuf') and values.notna().all() and ((values%1)==0).all():
+                dtypes[c] = ('int32' if (len(values)==0) or (values.abs().max()<2**31) else 'int64')
+        elif kind is not None:
+            dtypes[c] = kind
+    dtypes = {c:d for c,d in dtypes.items() if str(table[c].dtype)!=str(d)}
+    if len(dtypes)==0:
+        return table
+    return table.astype(dtypes)
+
+def naics_RnD_group(code,naicsLevel):
+    '''
+    Returns the RnD industry group of a NAICS code (see EconomicIndicatorBase.standardize_NAICS_for_RnD).
+    The 54 codes are kept as 5413, 5415, 5417 or 'other 54' at the 4 digit level and merged into 541 at the 3 digit level.
+    '''
+    if code[:1]=='3':
+        code = code[:3]
+        if code in ['313','314','315','316']:
+            return '313–16'
+        return code
+    if code[:1]=='2':
+        return code[:2]
+    if code[:1]=='4':
+        code = code[:2]
+        if code in ['48','49']:
+            return '48–49'
+        return code
+    if code[:2]=='51':
+        code = code[:3]
+        return (code if code in ['511','517','518'] else 'other 51')
+    if code[:2]=='52':
+        return code[:2]
+    if code[:2]=='53':
+        code = code[:3]
+        return (code if code=='533' else 'other 53')
+    if code[:2]=='54':
+        if naicsLevel==3:
+            return '541'
+        return (code if code in ['5413','5415','5417'] else 'other 54')
+    if code in ['621','622','623']:
+        return '621–23'
+    return code
+
+class CodeHierarchy:
+    '''
+    Index of hierarchical codes (NAICS, LBCS, ...) in which the code of the parent is a prefix of the code of the child.
+
+    Each code is mapped to an integer id at every level: the id of its prefix of that length among the sorted prefixes
+    of all the codes. Rolling up values from the codes (or from a level) to a coarser level is a product with a sparse
+    aggregation matrix, built once per pair of levels. Groupings that are not prefixes (like the RnD industry groups,
+    see naics_RnD_group) are supported through group_matrix.
+    Codes shorter than a level are their own prefix at that level (as with str[:level]).
+
+    Parameters
+    ----------
+    codes : list
+        Codes (as strings). Duplicates are ignored and the codes are kept sorted.
+    '''
+    def __init__(self,codes):
+        self.codes = sorted(set([str(code) for code in codes]))
+        self.code_index = {code:i for i,code in enumerate(self.codes)}
+        self._levels = {}
+        self._matrices = {}
+        self._groups = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _level(self,level):
+        '''
+        Returns the sorted prefixes of the given level and the id of the prefix of each code.
+        '''
+        if level not in self._levels:
+            uniques,ids = factorize_codes(pd.Series([code[:level] for code in self.codes],dtype=object))
+            self._levels[level] = (list(uniques),ids.astype(np.int64))
+        return self._levels[level]
+
+    def level_codes(self,level):
+        '''
+        Returns the sorted codes at the given level (prefixes of length level of the codes).
+        '''
+        return self._level(level)[0]
+
+    def ids(self,level,codes=None):
+        '''
+        Returns the id of the prefix at the given level of each code of the hierarchy, or of the given codes (-1 if not in the hierarchy).
+        '''
+        ids = self._level(level)[1]
+        if codes is None:
+            return ids
+        index = self.index(codes)
+        return np.where(index>=0,ids[index],-1)
+
+    def index(self,codes):
+        '''
+        Returns the position of each of the given codes in the hierarchy (-1 if not in the hierarchy).
+        '''
+        return np.array([self.code_index.get(str(code),-1) for code in codes],dtype=np.int64)
+
+    def aggregation_matrix(self,to_level,from_level=None):
+        '''
+        Returns the sparse matrix (codes, or codes at from_level, x codes at to_level) with a 1 in the column of the prefix of each row.
+        to_level should not be finer than from_level.
+        '''
+        key = (from_level,to_level)
+        if key not in self._matrices:
+            if from_level is None:
+                rows = np.arange(len(self.codes))
+                cols = self.ids(to_level)
+                n_rows = len(self.codes)
+            else:
+                if to_level>from_level:
+                    raise NameError('Cannot aggregate from level {} to the finer level {}'.format(from_level,to_level))
+                from_codes = self.level_codes(from_level)
+                # every code at from_level is the prefix of at least one code, and its parent is the parent of that code
+                first = np.unique(self.ids(from_level),return_index=True)[1]
+                rows = np.arange(len(from_codes))
+                cols = self.ids(to_level)[first]
+                n_rows = len(from_codes)
+            self._matrices[key] = sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=(n_rows,len(self.level_codes(to_level))))
+        return self._matrices[key]
+
+    def rollup(self,values,to_level,from_level=None):
+        '''
+        Sums values (last axis: the codes, or the codes at from_level) up to to_level.
+
+        Returns
+        -------
+        rolled_up : numpy.ndarray
+            Sum of the values of each code at to_level (last axis).
+        codes : list
+            Codes at to_level.
+        '''
+        values = np.asarray(values,dtype=float)
+        rolled_up = self.aggregation_matrix(to_level,from_level).T.dot(values.T).T
+        return rolled_up, self.level_codes(to_level)
+
+    def group_matrix(self,group_of,groups=None,*args):
+        '''
+        Returns the sparse matrix (codes x groups) with a 1 in the column of the group of each code.
+
+        Parameters
+        ----------
+        group_of : function
+            Takes a code (and args) and returns its group, for example naics_RnD_group.
+        groups : list (optional)
+            Groups (columns). Codes with a group not in groups are mapped to nothing. If not provided, the sorted groups of the codes.
+        args :
+            Additional arguments of group_of.
+
+        Returns
+        -------
+        matrix : scipy.sparse.csr_matrix
+        groups : list
+        '''
+        key = (group_of,args)
+        if key not in self._groups:
+            self._groups[key] = [group_of(code,*args) for code in self.codes]
+        code_groups = self._groups[key]
+        if groups is None:
+            groups = sorted(set(code_groups))
+        group_index = {group:i for i,group in enumerate(groups)}
+        rows = [i for i,group in enumerate(code_groups) if group in group_index]
+        cols = [group_index[code_groups[i]] for i in rows]
+        matrix = sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=(len(self.codes),len(groups)))
+        return matrix, list(groups)
+
+    def groups(self,group_of,*args):
+        '''
+        Returns the group of each code of the hierarchy (see group_matrix).
+        '''
+        if (group_of,args) not in self._groups:
+            self.group_matrix(group_of,None,*args)
+        return self._groups[(group_of,args)]
+
+_HIERARCHIES = {}
+_HIERARCHIES_LOCK = threading.Lock()
+
+def code_hierarchy(codes,max_cached=128):
+    '''
+    Returns the CodeHierarchy of the given codes, shared by all the callers with the same set of codes
+    so that its levels and aggregation matrices are only built once.
+    '''
+    key = frozenset([str(code) for code in codes])
+    with _HIERARCHIES_LOCK:
+        hierarchy = _HIERARCHIES.get(key)
+        if hierarchy is None:
+            if len(_HIERARCHIES)>=max_cached:
+                _HIERARCHIES.clear()
+            hierarchy = _HIERARCHIES[key] = CodeHierarchy(key)
+    return hierarchy
+
+def compositions_to_matrix(industry_compositions):
+    '''
+    Stacks several industry compositions (scenarios) into a matrix.
+
+    Parameters
+    ----------
+    industry_compositions : list or pandas.DataFrame
+        List of dicts {NAICS code: number of workers}, or DataFrame with one row per scenario and one column per NAICS code.
+
+    Returns
+    -------
+    matrix : numpy array
+        Number of workers of each scenario (rows) in each code (columns). 
+        Codes that are not in the composition of a scenario are nan.
+    codes : list
+        NAICS code of each column (as strings).
+    '''
+    if isinstance(industry_compositions, pd.DataFrame):
+        return industry_compositions.values.astype(float), [str(code) for code in industry_compositions.columns]
+    codes = []
+    code_index = {}
+    for composition in industry_compositions:
+        for code in composition:
+            if str(code) not in code_index:
+                code_index[str(code)] = len(codes)
+                codes.append(str(code))
+    matrix = np.full((len(industry_compositions), len(codes)), np.nan)
+    for i, composition in enumerate(industry_compositions):
+        for code, number in composition.items():
+            matrix[i, code_index[str(code)]] = number
+    return matrix, codes
+
 def shannon_equitability_score(species_counts):
     diversity=0
     pop_size=sum(species_counts)
@@ -744,6 +1515,31 @@ def shannon_equitability_score(species_counts):
     else:
         return 0
 
+def shannon_equitability_scores(species_counts):
+    '''
+    Vectorized shannon_equitability_score.
+
+    Parameters
+    ----------
+    species_counts : numpy.ndarray
+        Counts of each species (last axis), for one population (1-D) or several (2-D, one population per row).
+
+    Returns
+    -------
+    equitability : float or numpy.ndarray
+        Shannon equitability of each population (0 if the population is empty or there is only one species).
+    '''
+    species_counts = np.asarray(species_counts,dtype=float)
+    n_species = species_counts.shape[-1]
+    pop_size = species_counts.sum(axis=-1,keepdims=True)
+    if n_species<2:
+        return np.zeros(pop_size.shape[:-1]) if species_counts.ndim>1 else 0
+    with np.errstate(invalid='ignore',divide='ignore'):
+        pj = species_counts/pop_size
+        diversity = -np.where(pj>0,pj*np.log(np.where(pj>0,pj,1)),0).sum(axis=-1)
+    equitability = np.where(pop_size[...,0]>0,diversity/math.log(n_species),0)
+    return (equitability if species_counts.ndim>1 else float(equitability))
+
 def parse_CityScopeCategories(fpath,CS_column='CS Amenities ',NAICS_column='Unnamed: 5'):
     '''
     Useful function to parse the cityscope categories excel located at:
@@ -763,8 +1559,74 @@ def parse_CityScopeCategories(fpath,CS_column='CS Amenities ',NAICS_column='Unna
     CS_cats = CS_cats.drop(NAICS_column,1)
     return CS_cats
 
+_FOLD_CACHE = {}
+
+def cached_kfold(n_samples, cv=5):
+    '''
+    Returns the (train, test) indices of the KFold splits of n_samples rows.
+    The splits are computed once per (n_samples, cv) and shared by all the searches.
+    '''
+    key = (n_samples, cv)
+    if key not in _FOLD_CACHE:
+        _FOLD_CACHE[key] = list(KFold(n_splits=cv).split(np.zeros((n_samples, 1))))
+    return _FOLD_CACHE[key]
+
+def _fit_and_score_rf(params, n_estimators, X, y, train, test):
+    rfr = RandomForestRegressor(random_state=0, n_estimators=n_estimators, **params)
+    rfr.fit(X[train], y[train])
+    return r2_score(y[test], rfr.predict(X[test]))
+
 def fit_rf_regressor(df, cat_cols, numerical_cols, y_col,
-                     n_estimators=100, verbose=1):
+                     n_estimators=100, verbose=1, n_iter=200, cv=5, n_jobs=-1,
+                     max_time=300, max_fits=None, halving=True, factor=3, min_estimators=10):
+    '''
+    Fits a random forest, with a randomized search of its hyper-parameters.
+
+    The search uses successive halving: all the candidates are cross-validated with few trees, 
+    and only the best 1/factor of them move to the next round, which uses factor times more trees, 
+    until the last round uses n_estimators trees. 
+    The fits run in parallel and the search stops early if it runs out of time (max_time) or fits (max_fits); 
+    the winner is then the best candidate of the last round that was evaluated.
+    The search trajectory is stored in the search_trajectory_ attribute of the returned model.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Training data.
+    cat_cols : list
+        Categorical columns (one-hot encoded, dropping the first category).
+    numerical_cols : list
+        Numerical columns.
+    y_col : str
+        Column to predict.
+    n_estimators : int (default=100)
+        Number of trees of the final model.
+    verbose : int (default=1)
+        If larger than 0, it prints the progress of the search.
+    n_iter : int (default=200)
+        Number of sampled candidates.
+    cv : int (default=5)
+        Number of folds.
+    n_jobs : int (default=-1)
+        Number of parallel fits (-1 uses all the cores).
+    max_time : float (default=300)
+        Time budget of the search in seconds (None for no limit).
+    max_fits : int (optional)
+        Budget of forest fits of the search.
+    halving : boolean (default=True)
+        If False, all the candidates are evaluated with n_estimators trees (same as RandomizedSearchCV).
+    factor : int (default=3)
+        Elimination factor of each round.
+    min_estimators : int (default=10)
+        Number of trees of the first round.
+
+    Returns
+    -------
+    rfr_winner : sklearn.ensemble.RandomForestRegressor
+        Model with the best parameters, fitted on the train split.
+    features : list
+        Columns of the model.
+    '''
     features=[c for c in numerical_cols]
     for col in cat_cols:        
         new_dummies=pd.get_dummies(df[col], prefix=col, drop_first=True)
@@ -773,14 +1635,12 @@ def fit_rf_regressor(df, cat_cols, numerical_cols, y_col,
     X=np.array(df[features])
     y=np.array(df[y_col])
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=1)
-    rfr = RandomForestRegressor(random_state = 0, n_estimators=n_estimators)    
-#    pprint(rfr.get_params())
     
 # =============================================================================
 #     Randomised Grid Search for best hyper-parameters
 # =============================================================================
-# Number of features to consider at every split
-    max_features = ['auto', 'sqrt']
+# Number of features to consider at every split ('auto' is all of them for regressors)
+    max_features = [1.0, 'sqrt']
     # Maximum number of levels in tree
     max_depth = [int(x) for x in np.linspace(10, 110, num = 11)]
     max_depth.append(None)
@@ -797,14 +1657,59 @@ def fit_rf_regressor(df, cat_cols, numerical_cols, y_col,
                    'min_samples_split': min_samples_split,
                    'min_samples_leaf': min_samples_leaf,
                    'bootstrap': bootstrap}
-
-    # Create the random search object
-    rfr_random_search = RandomizedSearchCV(estimator = rfr, param_distributions = random_grid,
-                                   n_iter = 200, cv = 5, verbose=verbose, random_state=0, 
-                                   refit=True)
-    
-    rfr_random_search.fit(X_train, y_train)
-    rfr_winner=rfr_random_search.best_estimator_
+    candidates = list(ParameterSampler(random_grid, n_iter=n_iter, random_state=0))
+    folds = cached_kfold(len(X_train), cv)
+
+    # number of trees of each round
+    n_rounds = 1
+    if halving:
+        n_rounds += min(int(math.floor(math.log(max(n_estimators/min_estimators, 1))/math.log(factor))),
+                        int(math.ceil(math.log(max(len(candidates), 1))/math.log(factor))))
+    round_estimators = [max(min_estimators, int(n_estimators/factor**(n_rounds-1-k))) for k in range(n_rounds)]
+    round_estimators[-1] = n_estimators
+
+    start = time.time()
+    trajectory = []
+    n_fits = 0
+    best_params, out_of_budget = None, False
+    n_batch = max(1, (os.cpu_count() if n_jobs==-1 else n_jobs) or 1)
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for k, trees in enumerate(round_estimators):
+            scores = []
+            for b in range(0, len(candidates), n_batch):
+                if ((max_time is not None) and (time.time()-start>max_time)) or ((max_fits is not None) and (n_fits+cv>max_fits)):
+                    out_of_budget = True
+                    break
+                batch = candidates[b:b+n_batch]
+                if max_fits is not None:
+                    batch = batch[:(max_fits-n_fits)//cv]
+                fold_scores = parallel(delayed(_fit_and_score_rf)(params, trees, X_train, y_train, train, test) 
+                                       for params in batch for train, test in folds)
+                n_fits += len(fold_scores)
+                for i, params in enumerate(batch):
+                    score = float(np.mean(fold_scores[i*cv:(i+1)*cv]))
+                    scores.append(score)
+                    trajectory.append({'round': k, 'n_estimators': trees, 'params': params, 'score': score, 
+                                       'fits': n_fits, 'elapsed': time.time()-start})
+            if len(scores)!=0:
+                # the candidates of the last round reached win over the ones of earlier rounds, as they use more trees
+                best_params = candidates[int(np.argmax(scores))]
+                if verbose>0:
+                    print('Round {}: {} candidates with {} trees, best r2={:.3f} ({} fits, {:.0f}s)'.format(
+                          k, len(scores), trees, max(scores), n_fits, time.time()-start))
+            if out_of_budget:
+                if verbose>0:
+                    print('Search budget reached after {} fits and {:.0f}s'.format(n_fits, time.time()-start))
+                break
+            order = np.argsort(scores)[::-1]
+            candidates = [candidates[i] for i in order[:int(math.ceil(len(candidates)/factor))]]
+
+    if best_params is None:
+        warn('Search budget reached before any candidate was evaluated, using the default parameters')
+        best_params = {}
+    rfr_winner = RandomForestRegressor(random_state = 0, n_estimators=n_estimators, **best_params)
+    rfr_winner.fit(X_train, y_train)
+    rfr_winner.search_trajectory_ = trajectory
 #    best_params=rfr_random_search.best_params_
     return rfr_winner, features
     
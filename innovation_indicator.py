@@ -1,8 +1,10 @@
 import pandas as pd
 import os
 import numpy as np
-import joblib
-from indicator_tools import DataLoader, EconomicIndicatorBase
+from warnings import warn
+from indicator_tools import DATA_REGISTRY, EconomicIndicatorBase, compositions_to_matrix
+from compiled_models import compile_pipeline
+from model_registry import MODEL_REGISTRY
 
 class InnoIndicator(EconomicIndicatorBase):
 	def setup(self,occLevel=3,saveData=True,modelPath='tables/innovation_data',quietly=True):
@@ -21,7 +23,13 @@ class InnoIndicator(EconomicIndicatorBase):
 		self.knowledge = None
 		self.sks_model = None
 		self.kno_model = None
+		self.sks_compiled = None
+		self.kno_compiled = None
 		self.RnD_pc    = None
+		self.RnD_tables = {}
+
+		self.occupation_operators = {}
+		self.element_operators    = {}
 
 		self.kno_bounds = [-11,-7]
 		self.rnd_bounds = [4,5]
@@ -29,9 +37,10 @@ class InnoIndicator(EconomicIndicatorBase):
 		
 	def return_indicator(self, geogrid_data):
 		industry_composition  = self.grid_to_industries(geogrid_data)
-		worker_composition    = self.industries_to_occupations(industry_composition)
-		skill_composition     = self.occupations_to_skills(worker_composition)
-		knowledge_composition = self.occupations_to_knowledge(worker_composition)
+		naicsLevel            = self.infer_naics_level(industry_composition)
+		industry_vector, industry_present = self.industry_composition_to_vector(industry_composition,naicsLevel)
+		skill_composition     = self.industries_to_elements(industry_vector,industry_present,'skills',naicsLevel)
+		knowledge_composition = self.industries_to_elements(industry_vector,industry_present,'knowledge',naicsLevel)
 
 
 		skills    = self.SKSindicator(skill_composition)
@@ -84,8 +93,11 @@ class InnoIndicator(EconomicIndicatorBase):
 			If True, it will ensure the indicator returns values between 0 and 1. 
 		'''
 		self.load_module()
-		knowledge_composition = pd.DataFrame([knowledge_composition])
-		raw_value = self.kno_model.predict(knowledge_composition)[0]
+		if self.kno_compiled is not None:
+			raw_value = self.kno_compiled.predict_one(knowledge_composition)
+		else:
+			knowledge_composition = pd.DataFrame([knowledge_composition])
+			raw_value = self.kno_model.predict(knowledge_composition)[0]
 		norm_value = self.normalize_value(raw_value,self.kno_bounds)
 		return {'raw': raw_value, 'norm': norm_value}
 
@@ -101,25 +113,167 @@ class InnoIndicator(EconomicIndicatorBase):
 		normalize: boolean (default=True)
 			If True, it will ensure the indicator returns values between 0 and 1. 
 		'''
-		inferred_NAICS_lvl = max([len(k) for k in industry_composition.keys()])
+		RnD = self.RNDindicator_batch([industry_composition])
+		return {'raw': RnD['raw'][0], 'norm': RnD['norm'][0]}
 
-		industry_composition_df = pd.DataFrame(industry_composition.items(),columns=['NAICS','EMP'])
-		industry_composition_df = industry_composition_df.assign(NAICS = self.standardize_NAICS_for_RnD(industry_composition_df))
-		industry_composition_df = industry_composition_df.groupby('NAICS').sum().reset_index()
 
-		RnD_pc = self.RnD_pc
-		if inferred_NAICS_lvl==3:
-			RnD_pc.loc[(RnD_pc['NAICS'].str[:2]=='54')|(RnD_pc['NAICS']=='other 54'),'NAICS']='541'
-			RnD_pc = RnD_pc.groupby('NAICS').sum().reset_index()
-			RnD_pc = RnD_pc.assign(RnD_pc=RnD_pc['RnD_investment']/RnD_pc['TOT_EMP'])
+	def get_RnD_table(self,naicsLevel):
+		'''
+		Returns the RnD per capita by RnD industry group used for the given NAICS level.
+		At the 3 digit level all the 54 groups are merged into 541.
+		Tables are built once per level without modifying RnD_pc.
+		'''
+		if naicsLevel not in self.RnD_tables:
+			self.load_RnD_pc()
+			RnD_pc = self.RnD_pc
+			if naicsLevel==3:
+				RnD_pc = RnD_pc.copy()
+				RnD_pc.loc[(RnD_pc['NAICS'].str[:2]=='54')|(RnD_pc['NAICS']=='other 54'),'NAICS']='541'
+				RnD_pc = RnD_pc.groupby('NAICS').sum().reset_index()
+				RnD_pc = RnD_pc.assign(RnD_pc=RnD_pc['RnD_investment']/RnD_pc['TOT_EMP'])
+			self.RnD_tables[naicsLevel] = RnD_pc
+		return self.RnD_tables[naicsLevel]
 
-		industry_composition_df = pd.merge(industry_composition_df,RnD_pc)
-		RnD = (industry_composition_df['TOT_EMP']*industry_composition_df['RnD_pc']).sum()/industry_composition_df['TOT_EMP'].sum()
-		raw_value = RnD
+	def RNDindicator_batch(self,industry_compositions):
+		'''
+		Batch version of RNDindicator.
+		Takes the industry composition of several scenarios (see indicator_tools.compositions_to_matrix) 
+		and returns a dict with the raw and normalized values as arrays.
+		'''
+		matrix, codes = compositions_to_matrix(industry_compositions)
+		inferred_NAICS_lvl = max([len(code) for code in codes])
+		RnD_pc = self.get_RnD_table(inferred_NAICS_lvl)
+		# scenario x RnD group: True if any code of the group is in the scenario 
+		code_to_group = self.RnD_group_matrix(codes,list(RnD_pc['NAICS']))
+		groups_present = code_to_group.T.dot((~np.isnan(matrix)).astype(float).T).T>0
+		TOT_EMP = RnD_pc['TOT_EMP'].values
+		with np.errstate(invalid='ignore',divide='ignore'):
+			# groups without RnD per capita add workers but no investment, as in the sums of RNDindicator
+			RnD = groups_present.dot(np.nan_to_num(TOT_EMP*RnD_pc['RnD_pc'].values))/groups_present.dot(TOT_EMP)
 		raw_value_log = np.log10(RnD+1)
 		norm_value = self.normalize_value(raw_value_log,self.rnd_bounds)
-		return {'raw': raw_value, 'norm': norm_value}
+		return {'raw': RnD, 'norm': norm_value}
+
+	def industries_to_elements_batch(self,industry_matrix,industry_present,kind,naicsLevel):
+		'''
+		Batch version of industries_to_elements.
+		Takes the output of industry_matrix_to_operator and returns a DataFrame with the 
+		skill (kind='skills') or knowledge (kind='knowledge') composition of each scenario (rows).
+		Elements that would not be in the composition of a scenario are nan.
+		'''
+		operator = self.get_industry_element_operator(kind,naicsLevel)
+		totalWorkers = industry_matrix.dot(operator['workers'])
+		support = industry_present.dot(operator['support'])>0
+		with np.errstate(invalid='ignore',divide='ignore'):
+			values = industry_matrix.dot(operator['weights'])/totalWorkers.reshape(-1,1)
+			values[~support] = np.nan
+			values = values/np.nansum(values,axis=1).reshape(-1,1)
+		return pd.DataFrame(values,columns=operator['elements'])
+
+	def compositions_batch(self,industry_compositions,naicsLevel=None):
+		'''
+		Returns the skill and knowledge compositions (as DataFrames, one row per scenario) 
+		of the industry composition of several scenarios (see indicator_tools.compositions_to_matrix).
+		'''
+		matrix, codes = compositions_to_matrix(industry_compositions)
+		if naicsLevel is None:
+			naicsLevel = self.infer_naics_level(codes)
+		industry_matrix, industry_present = self.industry_matrix_to_operator(matrix,codes,naicsLevel)
+		skill_compositions     = self.industries_to_elements_batch(industry_matrix,industry_present,'skills',naicsLevel)
+		knowledge_compositions = self.industries_to_elements_batch(industry_matrix,industry_present,'knowledge',naicsLevel)
+		return skill_compositions, knowledge_compositions
 
+	def predict_batch(self,compositions,model_name):
+		'''
+		Returns the raw prediction of the sks or kno model (model_name) for each row of compositions.
+		'''
+		self.load_module()
+		compiled = self.sks_compiled if model_name=='sks' else self.kno_compiled
+		if compiled is not None:
+			return compiled.predict(compositions)
+		model = self.sks_model if model_name=='sks' else self.kno_model
+		return np.asarray(model.predict(compositions))
+
+	def gradient_batch(self,industry_compositions,model_name,normalize=True,naicsLevel=None):
+		'''
+		Returns the derivative of the sks or kno indicator (model_name) with respect to the number of workers of each NAICS code,
+		for each scenario. The derivatives are analytic: the chain of the industry-to-element operator, the normalization
+		of the element composition and the polynomial model (see compiled_models.CompiledLinearPipeline.gradient).
+
+		Parameters
+		----------
+		industry_compositions : list or pandas.DataFrame
+			Industry composition of each scenario (see indicator_tools.compositions_to_matrix).
+		model_name : str
+			'sks' or 'kno'.
+		normalize : boolean
+			If True, returns the derivative of the normalized value (see normalize_value), which is 0 where the value is clipped.
+
+		Returns
+		-------
+		gradient : pandas.DataFrame
+			One row per scenario and one column per NAICS code. Codes without IO data have derivative 0.
+		'''
+		self.load_module()
+		compiled = self.sks_compiled if model_name=='sks' else self.kno_compiled
+		if compiled is None:
+			raise NameError('Analytic gradients need a compiled {} model'.format(model_name))
+		kind = 'skills' if model_name=='sks' else 'knowledge'
+		matrix, codes = compositions_to_matrix(industry_compositions)
+		if naicsLevel is None:
+			naicsLevel = self.infer_naics_level(codes)
+		code_operator = self.get_code_operator(codes,naicsLevel)
+		industry_matrix, industry_present = self.industry_matrix_to_operator(matrix,codes,naicsLevel)
+		compositions = self.industries_to_elements_batch(industry_matrix,industry_present,kind,naicsLevel)
+		operator = self.get_industry_element_operator(kind,naicsLevel)
+		support = industry_present.dot(operator['support'])>0
+
+		# derivative of the model with respect to each element of the composition (0 for the elements outside the support, which are imputed)
+		model_gradient = compiled.gradient(compositions)
+		feature_index = {f:i for i,f in enumerate(compiled.features)}
+		element_gradient = np.zeros(compositions.shape)
+		for j,element in enumerate(operator['elements']):
+			if element in feature_index:
+				element_gradient[:,j] = model_gradient[:,feature_index[element]]
+
+		# composition c = v/sum(v) over the support, with v = x.dot(code_weights)
+		# dc_e/dx_k = (code_weights[k,e] - c_e*sum_{e' in support} code_weights[k,e'])/sum(v)
+		code_weights = code_operator.dot(operator['weights'])
+		values = np.where(support,industry_matrix.dot(operator['weights']),0)
+		with np.errstate(invalid='ignore',divide='ignore'):
+			gradient = (element_gradient.dot(code_weights.T) -
+						(element_gradient*np.nan_to_num(compositions.values)).sum(axis=1).reshape(-1,1)*support.astype(float).dot(code_weights.T))/values.sum(axis=1).reshape(-1,1)
+		if normalize:
+			bounds = self.sks_bounds if model_name=='sks' else self.kno_bounds
+			norm_value = (compiled.predict(compositions)-bounds[0])/(bounds[1]-bounds[0])
+			inside = (norm_value>0)&(norm_value<1)
+			gradient = np.where(inside.reshape(-1,1),gradient/(bounds[1]-bounds[0]),0)
+		return pd.DataFrame(gradient,columns=codes)
+
+	def return_indicator_batch(self,industry_compositions):
+		'''
+		Calculates the indicators of return_indicator for several scenarios in one pass.
+
+		Parameters
+		----------
+		industry_compositions : list or pandas.DataFrame
+			Industry composition of each scenario, as a list of dicts (see grid_to_industries) 
+			or a DataFrame with one row per scenario and one column per NAICS code.
+
+		Returns
+		-------
+		indicators : dict
+			For each indicator name, a dict with 'value' and 'raw_value' arrays (one value per scenario) and 'units'.
+		'''
+		skill_compositions, knowledge_compositions = self.compositions_batch(industry_compositions)
+		skills_raw    = self.predict_batch(skill_compositions,'sks')
+		knowledge_raw = self.predict_batch(knowledge_compositions,'kno')
+		RnD = self.RNDindicator_batch(industry_compositions)
+		return {
+			'Knowledge': {'value':self.normalize_value(knowledge_raw.copy(),self.kno_bounds),'raw_value':knowledge_raw,'units':None},
+			'Skills': {'value':self.normalize_value(skills_raw.copy(),self.sks_bounds),'raw_value':skills_raw,'units':None},
+			'R&D Funding': {'value':RnD['norm'],'raw_value':RnD['raw'],'units':'Millions of US Dollars'}
+		}
 
 	def SKSindicator(self,skill_composition):
 		'''
@@ -145,11 +299,17 @@ class InnoIndicator(EconomicIndicatorBase):
 			If True, it will ensure the indicator returns values between 0 and 1. 
 		'''
 		self.load_module()
-		skill_composition = pd.DataFrame([skill_composition])
-		raw_value = self.sks_model.predict(skill_composition)[0]
+		if self.sks_compiled is not None:
+			raw_value = self.sks_compiled.predict_one(skill_composition)
+		else:
+			skill_composition = pd.DataFrame([skill_composition])
+			raw_value = self.sks_model.predict(skill_composition)[0]
 		norm_value = self.normalize_value(raw_value,self.sks_bounds)
 		return {'raw': raw_value, 'norm': norm_value}
 
+	def watched_files(self):
+		return [self.sks_model_path,self.kno_model_path]
+
 	def load_module(self):
 		'''
 		Loads the coefficients for the fitted model found in coefs_path.
@@ -158,9 +318,29 @@ class InnoIndicator(EconomicIndicatorBase):
 		self.load_onet_data()
 		self.load_RnD_pc()
 		if self.sks_model is None:
-			self.sks_model = joblib.load(self.sks_model_path)
+			self.sks_model = MODEL_REGISTRY.get(self.sks_model_path,'pipeline',table=self.table_name)
+			self.sks_compiled = self.compile_model(self.sks_model,'sks')
 		if self.kno_model is None: 
-			self.kno_model = joblib.load(self.kno_model_path)
+			self.kno_model = MODEL_REGISTRY.get(self.kno_model_path,'pipeline',table=self.table_name)
+			self.kno_compiled = self.compile_model(self.kno_model,'kno')
+
+	def compile_model(self,model,model_name):
+		'''
+		Flattens the fitted pipeline into a numpy evaluator (see compiled_models.compile_pipeline).
+		The compiled model is checked against the pipeline and None is returned if it cannot be compiled or does not match, 
+		in which case the pipeline is used.
+		'''
+		try:
+			compiled = compile_pipeline(model)
+			if not compiled.verify(model,compiled.sample_inputs()):
+				warn('Compiled {} model does not match the pipeline, using the pipeline'.format(model_name))
+				return None
+		except Exception as e:
+			warn('Could not compile {} model, using the pipeline: {}'.format(model_name,e))
+			return None
+		if not self.quietly:
+			print('Compiled {} model: {} terms'.format(model_name,compiled.n_terms()))
+		return compiled
 
 	def load_RnD_pc(self):
 		'''
@@ -168,12 +348,13 @@ class InnoIndicator(EconomicIndicatorBase):
 		'''
 		self.load_IO_data()
 		if self.RnD_pc is None:
-			I_data = self.IO_data.groupby('NAICS').sum()[['TOT_EMP']].reset_index()
-			I_data = I_data.assign(NAICS = I_data['NAICS'].str[:4]).groupby('NAICS').sum()[['TOT_EMP']].reset_index()
+			employment = self.get_IO_employment()
+			TOT_EMP, naics = employment['hierarchy'].rollup(np.asarray(employment['workers'].sum(axis=1)).ravel(),4)
+			I_data = pd.DataFrame({'NAICS':naics,'TOT_EMP':TOT_EMP})
 			I_data = I_data.assign(NAICS = self.standardize_NAICS_for_RnD(I_data))
 			I_data = I_data.groupby('NAICS').sum()[['TOT_EMP']].reset_index()
 
-			RnD = DataLoader().load_RnD_data(return_data=True).rename(columns={'NAICS code':'NAICS'})
+			RnD = DATA_REGISTRY.shared_table('RnD').rename(columns={'NAICS code':'NAICS'})
 			I_data = pd.merge(I_data,RnD)
 			I_data['RnD_pc'] = I_data['RnD_investment']/I_data['TOT_EMP']
 			self.RnD_pc = I_data
@@ -198,16 +379,7 @@ class InnoIndicator(EconomicIndicatorBase):
 			 '51-2': 30.385813540925056,
 			 ...
 		'''
-		self.load_onet_data()
-		totalWorkers = sum(worker_composition.values())
-		nWorkers = pd.DataFrame(worker_composition.items(),columns=['SELECTED_LEVEL','N'])
-		workers_by_skill = pd.merge(self.skills,nWorkers)
-		workers_by_skill['w'] = workers_by_skill['N']/totalWorkers
-		workers_by_skill['Data Value'] = workers_by_skill['Data Value']*workers_by_skill['w']
-		skill_composition = workers_by_skill.groupby('Element ID').sum()[['Data Value']].reset_index()
-		skill_composition['Data Value'] = skill_composition['Data Value']/skill_composition['Data Value'].sum()
-		skill_composition = dict(skill_composition.values)
-		return skill_composition
+		return self.occupations_to_elements(worker_composition,'skills')
 
 	def occupations_to_knowledge(self,worker_composition):
 		'''
@@ -228,23 +400,112 @@ class InnoIndicator(EconomicIndicatorBase):
 			 '51-2': 30.385813540925056,
 			 ...
 		'''
-		self.load_onet_data()
+		return self.occupations_to_elements(worker_composition,'knowledge')
+
+	def get_occupation_operator(self,kind):
+		'''
+		Returns the linear map from occupations to ONET elements (kind='skills' or 'knowledge').
+		It is built once from the ONET data and cached.
+
+		Returns
+		-------
+		operator : dict
+			occupations: list of occupation codes (rows)
+			occupation_index: dict with the row of each occupation code
+			elements: list of element ids (columns)
+			weights: array with the Data Value of each element for each occupation
+			support: boolean array, True if the occupation has data for the element
+		'''
+		if kind not in self.occupation_operators:
+			self.load_onet_data()
+			onet_data = self.skills if kind=='skills' else self.knowledge
+			weights = onet_data.groupby(['SELECTED_LEVEL','Element ID'],observed=True)['Data Value'].sum().unstack()
+			self.occupation_operators[kind] = {
+				'occupations': list(weights.index),
+				'occupation_index': {occ:i for i,occ in enumerate(weights.index)},
+				'elements': list(weights.columns),
+				'weights': weights.fillna(0).values,
+				'support': weights.notna().values.astype(float)
+			}
+		return self.occupation_operators[kind]
+
+	def get_industry_element_operator(self,kind,naicsLevel):
+		'''
+		Returns the composition of the industry operator (see get_industry_operator) and the occupation operator (see get_occupation_operator),
+		a direct linear map from industries to ONET elements. It is built once per kind and NAICS level and cached.
+
+		Returns
+		-------
+		operator : dict
+			elements: list of element ids (columns)
+			weights: array (industries x elements), shares.dot(occupation weights)
+			support: boolean array, True if any occupation of the industry has data for the element
+			workers: array with the sum of the occupation shares of each industry
+		'''
+		key = (kind,naicsLevel)
+		if key not in self.element_operators:
+			industry_operator   = self.get_industry_operator(naicsLevel)
+			occupation_operator = self.get_occupation_operator(kind)
+			occupation_rows = [occupation_operator['occupation_index'].get(occ) for occ in industry_operator['occupations']]
+			aligned_weights = np.zeros((len(occupation_rows),len(occupation_operator['elements'])))
+			aligned_support = np.zeros((len(occupation_rows),len(occupation_operator['elements'])))
+			for i,row in enumerate(occupation_rows):
+				if row is not None:
+					aligned_weights[i] = occupation_operator['weights'][row]
+					aligned_support[i] = occupation_operator['support'][row]
+			self.element_operators[key] = {
+				'elements': occupation_operator['elements'],
+				'weights': industry_operator['shares'].dot(aligned_weights),
+				'support': industry_operator['support'].dot(aligned_support)>0,
+				'workers': industry_operator['shares'].sum(axis=1)
+			}
+		return self.element_operators[key]
+
+	def _normalized_composition(self,elements,values,support,totalWorkers):
+		'''
+		Returns the composition (normalized to sum 1) of the elements in the support.
+		'''
+		values = values[support]/totalWorkers
+		values = values/values.sum()
+		return dict(zip([e for e,keep in zip(elements,support) if keep],values))
+
+	def industries_to_elements(self,industry_vector,industry_present,kind,naicsLevel):
+		'''
+		Calculates the skill (kind='skills') or knowledge (kind='knowledge') composition of the workers of the given industries.
+		Same result as occupations_to_skills(industries_to_occupations(industry_composition)), using the precompiled operators.
+
+		Parameters
+		----------
+		industry_vector : numpy array
+			Number of workers in each industry (see industry_composition_to_vector).
+		industry_present : numpy array
+			Industries that appear in the industry composition (see industry_composition_to_vector).
+		'''
+		operator = self.get_industry_element_operator(kind,naicsLevel)
+		totalWorkers = industry_vector.dot(operator['workers'])
+		support = industry_present.dot(operator['support'])>0
+		return self._normalized_composition(operator['elements'],industry_vector.dot(operator['weights']),support,totalWorkers)
+
+	def occupations_to_elements(self,worker_composition,kind):
+		'''
+		Calculates the skill (kind='skills') or knowledge (kind='knowledge') composition of the given worker composition.
+		See occupations_to_skills.
+		'''
+		operator = self.get_occupation_operator(kind)
 		totalWorkers = sum(worker_composition.values())
-		nWorkers = pd.DataFrame(worker_composition.items(),columns=['SELECTED_LEVEL','N'])
-		workers_by_knowledge = pd.merge(self.knowledge,nWorkers)
-		workers_by_knowledge['w'] = workers_by_knowledge['N']/totalWorkers
-		workers_by_knowledge['Data Value'] = workers_by_knowledge['Data Value']*workers_by_knowledge['w']
-		knowledge_composition = workers_by_knowledge.groupby('Element ID').sum()[['Data Value']].reset_index()
-		knowledge_composition['Data Value'] = knowledge_composition['Data Value']/knowledge_composition['Data Value'].sum()
-		knowledge_composition = dict(knowledge_composition.values)
-		return knowledge_composition
+		worker_vector  = np.zeros(len(operator['occupations']))
+		worker_present = np.zeros(len(operator['occupations']))
+		for occ,n in worker_composition.items():
+			if occ in operator['occupation_index']:
+				worker_vector[operator['occupation_index'][occ]]  += n
+				worker_present[operator['occupation_index'][occ]] = 1
+		support = worker_present.dot(operator['support'])>0
+		return self._normalized_composition(operator['elements'],worker_vector.dot(operator['weights']),support,totalWorkers)
 
 	def load_onet_data(self):
 		if (self.skills is None)|(self.knowledge is None):
-			loader = DataLoader()
-			loader.load_onet_data(include_employment=False)
-			self.skills    = loader.skills
-			self.knowledge = loader.knowledge
+			self.skills    = DATA_REGISTRY.shared_table('skills')
+			self.knowledge = DATA_REGISTRY.shared_table('knowledge')
 
 
 import random
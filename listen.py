@@ -7,12 +7,11 @@ from buildings_indicator import BuildingsIndicator
 from diversity_indicator import DiversityIndicator
 
 import sys
-import json
 
 from statistics import mean
 
 def main(host_mode='remote', table_name='corktown_dev'):
-    reference=json.load(open('./tables/{}/reference.json'.format(table_name)))
+    reference_path='./tables/{}/reference.json'.format(table_name)
     if host_mode=='local':
         host = 'http://127.0.0.1:5000/'
     else:
@@ -36,7 +35,7 @@ def main(host_mode='remote', table_name='corktown_dev'):
             D]:
         indicator.viz_type='bar'
     
-    H = Handler(table_name, quietly=False, host_mode=host_mode, reference=reference)
+    H = Handler(table_name, quietly=False, host_mode=host_mode, reference_path=reference_path)
     
     H.add_indicators([
             I,
@@ -1,5 +1,4 @@
 import pandas as pd
-import numpy as np
 import joblib
 import os
 from innovation_indicator import InnoIndicator
@@ -7,44 +6,29 @@ from indicator_tools import DataLoader
 from APICalls import CBPCall
 
 def industry_to_skills_knowledge(Xdiff,I):
-	industry_compositions = Xdiff.to_dict('records')
-	skill_compositions = []
-	knowledge_compositions = []
-	for industry_composition in industry_compositions:
-		worker_composition    = I.industries_to_occupations(industry_composition)
-		skill_composition     = I.occupations_to_skills(worker_composition)
-		knowledge_composition = I.occupations_to_knowledge(worker_composition)
-		skill_compositions.append(skill_composition)
-		knowledge_compositions.append(knowledge_composition)
-	return skill_compositions,knowledge_compositions
-
-def AME_industry(I,col,X):
 	'''
-	Numbers should be interpreted as the change in the average indicator (over all X) as a result of a 0.1 increase in the given NAICS code
+	Returns the skill and knowledge compositions (DataFrames with one row per row of Xdiff) of the industry compositions in Xdiff.
 	'''
-	dx = np.median(np.diff(sorted(X[X[col]!=0][col])))
-
-	X_ = X.reset_index().drop('index',1)
-	X_[col] = X[col]+dx
-	Xdiff = pd.concat([X.reset_index().drop('index',1),X_]).sort_index().sort_values(by=col).sort_index()
-
-	skill_compositions,knowledge_compositions = industry_to_skills_knowledge(Xdiff,I)
-
-	Ypred = I.sks_model.predict(pd.DataFrame(skill_compositions))
-	if I.normalize:
-		Ypred = I.normalize_value(Ypred,I.sks_bounds)
-	dsks = np.diff(Ypred)[::2]
-	dsksdx = (dsks/dx)*0.1
+	return I.compositions_batch(Xdiff)
 
-	Ypred = I.kno_model.predict(pd.DataFrame(knowledge_compositions))
-	if I.normalize:
-		Ypred = I.normalize_value(Ypred,I.kno_bounds)
-	dkno = np.diff(Ypred)[::2]
-	dknodx = (dkno/dx)*0.1
-
-	return np.mean(dsksdx),np.mean(dknodx)
+def AME_industries(I,X,normalize=True):
+	'''
+	Returns the average marginal effect of each NAICS code (columns of X) on the sks and kno indicators.
+	Numbers should be interpreted as the change in the average indicator (over all X) as a result of a 0.1 increase in the given NAICS code.
+	All codes are derived at once from the analytic gradients of the indicators (see InnoIndicator.gradient_batch).
+
+	Returns
+	-------
+	sks_ames, kno_ames : dict
+		Average marginal effect of each NAICS code.
+	'''
+	sks_gradient = I.gradient_batch(X,'sks',normalize=normalize)
+	kno_gradient = I.gradient_batch(X,'kno',normalize=normalize)
+	sks_ames = (sks_gradient.mean()*0.1).to_dict()
+	kno_ames = (kno_gradient.mean()*0.1).to_dict()
+	return sks_ames,kno_ames
 
-def main():
+def main(normalize=True):
 	outPath = 'tables/innovation_data'
 	outfpath = os.path.join(outPath,'innovation_marginal_effect.csv')
 	if os.path.isfile(outfpath):
@@ -63,13 +47,8 @@ def main():
 		X = X.drop('TOTAL',1)
 		X = X.reset_index().drop('MSA',1)
 
-		kno_ames = {}
-		sks_ames = {}
-		for col in X.columns:
-			print('\tDerivating with respect to NAICS: {}'.format(col))
-			sks_ame,kno_ame = AME_industry(I,col,X)
-			sks_ames[col] = sks_ame
-			kno_ames[col] = kno_ame
+		print('Derivating with respect to {} NAICS codes'.format(len(X.columns)))
+		sks_ames,kno_ames = AME_industries(I,X,normalize=normalize)
 
 		print('Combining and saving results')
 		ames = pd.DataFrame(sks_ames.items(),columns=['NAICS','SKS_AME'])
@@ -14,14 +14,15 @@ import json
 import pandas as pd
 import matplotlib.pyplot as plt
 from indicator_tools import fit_rf_regressor
-import pickle
+from compiled_models import try_compile_forest
+from model_registry import MODEL_REGISTRY
 
 class MobilityIndicator(Indicator):
     def setup(self,*args,**kwargs):
-        self.fitted_co2_model_object_loc='./tables/corktown/fitted_co2_model.p'
-        self.fitted_pa_model_object_loc='./tables/corktown/fitted_pa_model.p'
         self.category='numeric'
         self.table_name=kwargs['table_name']
+        self.fitted_co2_model_object_loc='./tables/{}/fitted_co2_model.p'.format(self.table_name)
+        self.fitted_pa_model_object_loc='./tables/{}/fitted_pa_model.p'.format(self.table_name)
         self.train_data_loc='./tables/{}/mobility_sim_output.json'.format(self.table_name)
         
         
@@ -48,38 +49,58 @@ class MobilityIndicator(Indicator):
         pa_model_object={'model': self.pa_model, 'features': self.pa_model_features,
 #              'max': self.max_pa, 'min': self.min_pa
               }
-        pickle.dump(co2_model_object, open(self.fitted_co2_model_object_loc, 'wb'))
-        pickle.dump(pa_model_object, open(self.fitted_pa_model_object_loc, 'wb'))
+        MODEL_REGISTRY.dump(co2_model_object, self.fitted_co2_model_object_loc)
+        MODEL_REGISTRY.dump(pa_model_object, self.fitted_pa_model_object_loc)
        
     def normalised_prediction(self, model, X_in, y_max, y_min):
         y_pred=model.predict(X_in)[0]
 #        print(y_pred)
         return {'raw':y_pred, 'norm': max(0, min(1,(y_pred-y_min)/(y_max-y_min)))}
         
-    def load_module(self):
+    def watched_files(self):
+        return [self.fitted_co2_model_object_loc, self.fitted_pa_model_object_loc]
+
+    def prepare_reload(self):
+        # a model that fails to load during a reload is an error, not a reason to train
+        return Indicator.prepare_reload(self, train=False)
+
+    def load_module(self, train=True):
         print('loading')
         try:
-            fitted_co2_model=pickle.load(open(self.fitted_co2_model_object_loc, 'rb'))
-            self.co2_model=fitted_co2_model['model']
-            self.co2_model_features=fitted_co2_model['features']  
+            # the random forests are evaluated with numpy (see compiled_models.CompiledForest) and shared through the registry
+            self.co2_model, self.co2_model_features=MODEL_REGISTRY.get(self.fitted_co2_model_object_loc, 'forest', table=self.table_name)
 #            self.max_co2=fitted_co2_model['max'] 
 #            self.min_co2=fitted_co2_model['min'] 
-            fitted_pa_model=pickle.load(open(self.fitted_pa_model_object_loc, 'rb'))
-            self.pa_model=fitted_pa_model['model']
-            self.pa_model_features=fitted_pa_model['features']  
+            self.pa_model, self.pa_model_features=MODEL_REGISTRY.get(self.fitted_pa_model_object_loc, 'forest', table=self.table_name)
 #            self.max_pa=fitted_pa_model['max'] 
 #            self.min_pa=fitted_pa_model['min'] 
-        except:
+        except FileNotFoundError:
+            if not train:
+                raise
             print('Model not yet trained. Training now')
             self.train()            
+            self.co2_model=try_compile_forest(self.co2_model, self.co2_model_features, name='co2 model')
+            self.pa_model=try_compile_forest(self.pa_model, self.pa_model_features, name='pa model')
         self.min_co2=5
         self.max_co2=12
         self.min_pa=0
         self.max_pa=0.004
-        
-            
-    def return_indicator(self, geogrid_data, future_mobility=1):
-        X_co2, X_pa=[], []
+        self.build_feature_index()
+
+    def build_feature_index(self):
+        '''
+        Indexes the features of both models: self.features has the union of them, 
+        and self.co2_columns and self.pa_columns the position of the features of each model in it.
+        '''
+        self.features=[f for f in self.co2_model_features]+[f for f in self.pa_model_features if f not in self.co2_model_features]
+        self.feature_index={f: i for i, f in enumerate(self.features)}
+        self.co2_columns=np.array([self.feature_index[f] for f in self.co2_model_features], dtype=int)
+        self.pa_columns=np.array([self.feature_index[f] for f in self.pa_model_features], dtype=int)
+
+    def get_floor_counts(self, geogrid_data):
+        '''
+        Returns the total number of floors of each type in the grid.
+        '''
         floor_counts={}
         for cell in geogrid_data:
             height=cell['height']
@@ -89,31 +110,58 @@ class MobilityIndicator(Indicator):
                 floor_counts[cell['name']]+=height
             else:
                 floor_counts[cell['name']]=height
-        for feat in self.co2_model_features:
-            if feat=='future_mobility':
-                x=future_mobility
-            elif feat in floor_counts:
-                x=floor_counts[feat]
-            else:
-                x=0               
-            X_co2.append(x)
-        for feat in self.pa_model_features:
-            if feat=='future_mobility':
-                x=future_mobility
-            elif feat in floor_counts:
-                x=floor_counts[feat]
-            else:
-                x=0               
-            X_pa.append(x)
-#        print(self.co2_model_features)
-        co2=self.normalised_prediction(self.co2_model, np.array(X_co2).reshape(1, -1), 
-                                            self.max_co2, self.min_co2)
-        pa=self.normalised_prediction(self.pa_model, np.array(X_pa).reshape(1, -1), 
-                                           self.max_pa, self.min_pa)
-        self.value_indicators=[{'name': 'Mobility CO2 Performance', 'value': 1-co2['norm'], 
-                 'raw_value':co2['raw'],'viz_type': self.viz_type, 'units': 'kg/day'},
-                {'name': 'Mobility Health Impacts', 'value': pa['norm'], 
-                 'raw_value':pa['raw'], 'viz_type': self.viz_type, 'units': 'mortality/year'}]
+        return floor_counts
+
+    def return_indicator_batch(self, geogrid_datas, future_mobility=[0, 1]):
+        '''
+        Calculates the CO2 and physical activity outputs for several grid states and future_mobility levels,
+        with one call to each model.
+
+        Parameters
+        ----------
+        geogrid_datas : list or dict
+            Grid states to evaluate, as a list of geogrid_data or a dict {scenario name: geogrid_data}.
+        future_mobility : list (default=[0, 1])
+            Levels of future_mobility to evaluate for each grid state.
+
+        Returns
+        -------
+        outputs : pandas.DataFrame
+            One row per grid state and future_mobility level, with columns:
+                scenario: name (or position in the list) of the grid state
+                future_mobility: level of future_mobility
+                avg_co2, delta_f_physical_activity_pp: raw outputs of the models
+                Mobility CO2 Performance, Mobility Health Impacts: normalised indicators (as in return_indicator)
+        '''
+        if not isinstance(geogrid_datas, dict):
+            geogrid_datas={i: geogrid_data for i, geogrid_data in enumerate(geogrid_datas)}
+        future_mobility=list(future_mobility) if isinstance(future_mobility, (list, tuple, np.ndarray)) else [future_mobility]
+        X=np.zeros((len(geogrid_datas)*len(future_mobility), len(self.features)))
+        scenarios, levels=[], []
+        for i, name in enumerate(geogrid_datas):
+            floor_counts=self.get_floor_counts(geogrid_datas[name])
+            columns=[self.feature_index[t] for t in floor_counts if t in self.feature_index]
+            values=[floor_counts[t] for t in floor_counts if t in self.feature_index]
+            for j, level in enumerate(future_mobility):
+                row=i*len(future_mobility)+j
+                X[row, columns]=values
+                scenarios.append(name)
+                levels.append(level)
+        if 'future_mobility' in self.feature_index:
+            X[:, self.feature_index['future_mobility']]=levels
+        co2=self.co2_model.predict(X[:, self.co2_columns])
+        pa=self.pa_model.predict(X[:, self.pa_columns])
+        return pd.DataFrame({'scenario': scenarios, 'future_mobility': levels,
+                             'avg_co2': co2, 'delta_f_physical_activity_pp': pa,
+                             'Mobility CO2 Performance': 1-np.clip((co2-self.min_co2)/(self.max_co2-self.min_co2), 0, 1),
+                             'Mobility Health Impacts': np.clip((pa-self.min_pa)/(self.max_pa-self.min_pa), 0, 1)})
+            
+    def return_indicator(self, geogrid_data, future_mobility=1):
+        outputs=self.return_indicator_batch([geogrid_data], future_mobility=[future_mobility]).iloc[0]
+        self.value_indicators=[{'name': 'Mobility CO2 Performance', 'value': outputs['Mobility CO2 Performance'], 
+                 'raw_value':outputs['avg_co2'],'viz_type': self.viz_type, 'units': 'kg/day'},
+                {'name': 'Mobility Health Impacts', 'value': outputs['Mobility Health Impacts'], 
+                 'raw_value':outputs['delta_f_physical_activity_pp'], 'viz_type': self.viz_type, 'units': 'mortality/year'}]
         return self.value_indicators
         
     
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of the fitted models used by the indicators.
+
+Each model file is loaded once per process, the first time an indicator asks for it, and shared by all the indicators
+(of any table) that use it. Files with the same content (for example, a model copied to several tables) are shared too.
+The registry checks the size and modification time of the file on every request: if the file changed, the new version
+is loaded and swapped in, while indicators that still hold the previous version keep a valid model.
+Models should be written with dump, so that readers never see a partially written file.
+"""
+import os
+import pickle
+import hashlib
+import threading
+import joblib
+import pandas as pd
+from io import BytesIO
+
+from compiled_models import load_forest
+from indicator_tools import file_fingerprint
+from APICalls import atomic_write
+
+
+def load_pickle(fpath):
+    with open(fpath, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_pipeline(fpath):
+    # numpy arrays of uncompressed joblib files are memory mapped instead of read into memory
+    return joblib.load(fpath, mmap_mode='r')
+
+
+def content_hash(fpath, block_size=1<<20):
+    '''
+    Returns the md5 hash of the content of the file.
+    '''
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class ModelRegistry:
+    '''
+    Registry of fitted models keyed by (table, model kind, file fingerprint).
+
+    Model kinds (see ModelRegistry.LOADERS):
+        forest: pickled {'model': random forest, 'features': list}, returned as (CompiledForest, features)
+                with the nodes memory mapped (see compiled_models.load_forest).
+        pipeline: sklearn pipeline saved with joblib.
+        pickle: any pickled object.
+
+    Loading is thread-safe: concurrent requests for the same file wait for a single load.
+    '''
+    LOADERS = {
+        'forest':   load_forest,
+        'pipeline': load_pipeline,
+        'pickle':   load_pickle
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        # (table, kind, path): (file fingerprint, content hash, size)
+        self._entries = {}
+        # (kind, content hash): model
+        self._models = {}
+
+    def _file_lock(self, fpath):
+        with self._lock:
+            if fpath not in self._file_locks:
+                self._file_locks[fpath] = threading.Lock()
+            return self._file_locks[fpath]
+
+    def get(self, fpath, kind, table=None):
+        '''
+        Returns the model stored in fpath, loading it if it was not loaded before or if the file changed since.
+
+        Parameters
+        ----------
+        fpath : str
+            Path of the model file.
+        kind : str
+            Kind of model (see ModelRegistry.LOADERS).
+        table : str (optional)
+            Name of the table that uses the model.
+        '''
+        if kind not in self.LOADERS:
+            raise NameError('Unknown model kind: {}. Options are: {}'.format(kind, ', '.join(self.LOADERS)))
+        fpath = os.path.abspath(fpath)
+        key = (table, kind, fpath)
+        fingerprint = file_fingerprint([fpath])
+        if fingerprint is None:
+            raise FileNotFoundError('Model file not found: {}'.format(fpath))
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None) and (entry[0]==fingerprint):
+                return self._models[(kind, entry[1])]
+        with self._file_lock(fpath):
+            fingerprint = file_fingerprint([fpath])
+            size = os.path.getsize(fpath)
+            digest = content_hash(fpath)
+            with self._lock:
+                model = self._models.get((kind, digest))
+            if model is None:
+                model = self.LOADERS[kind](fpath)
+            with self._lock:
+                self._models.setdefault((kind, digest), model)
+                self._entries[key] = (fingerprint, digest, size)
+                self._drop_unused()
+                return self._models[(kind, digest)]
+
+    def has_changed(self, fpath, kind, table=None):
+        '''
+        Returns True if the file changed since the model was loaded (or if it was never loaded).
+        '''
+        key = (table, kind, os.path.abspath(fpath))
+        with self._lock:
+            entry = self._entries.get(key)
+        return (entry is None) or (entry[0]!=file_fingerprint([key[2]]))
+
+    def _drop_unused(self):
+        '''
+        Drops the models that no entry points to anymore (the indicators that hold them keep them alive).
+        '''
+        used = set([(kind, digest) for (_, kind, _), (_, digest, _) in self._entries.items()])
+        for key in [key for key in self._models if key not in used]:
+            del self._models[key]
+
+    def dump(self, model, fpath, kind='pickle'):
+        '''
+        Saves the model to fpath through a temporary file, so that readers see either the previous or the new file.
+
+        Parameters
+        ----------
+        model : object
+            Model to save.
+        fpath : str
+            Path of the model file.
+        kind : str (default='pickle')
+            Kind of model (see ModelRegistry.LOADERS). Pipelines are saved with joblib, everything else with pickle.
+        '''
+        content = BytesIO()
+        if kind=='pipeline':
+            joblib.dump(model, content)
+        else:
+            pickle.dump(model, content)
+        atomic_write(fpath, content.getvalue())
+
+    def memory_report(self):
+        '''
+        Returns a DataFrame with the loaded model files, the tables that use them and the content hash they share.
+        '''
+        with self._lock:
+            entries = list(self._entries.items())
+        return pd.DataFrame([{'table': table, 'kind': kind, 'path': fpath, 'size': size, 'content_hash': digest}
+                             for (table, kind, fpath), (_, digest, size) in entries],
+                            columns=['table', 'kind', 'path', 'size', 'content_hash'])
+
+    def clear(self):
+        '''
+        Drops all the loaded models. Models handed out before remain valid.
+        '''
+        with self._lock:
+            self._entries = {}
+            self._models = {}
+
+MODEL_REGISTRY = ModelRegistry()
@@ -16,8 +16,100 @@ from scipy import spatial
 import pyproj
 import random
 import requests
-from toolbox import Handler, Indicator
-from indicator_tools import flatten_grid_cell_attributes
+import time
+import os
+import pickle
+import hashlib
+from multiprocessing import Pool
+from collections import deque
+from contextlib import contextmanager
+from toolbox import Handler, Indicator, HeatmapColumns
+from indicator_tools import flatten_grid_cell_attributes, file_fingerprint
+from APICalls import atomic_write
+
+_transformers={}
+_search_state={}
+
+def get_transformer(from_crs, to_crs):
+    """
+    Returns a pyproj.Transformer between the two CRS (eg. 'EPSG:4326').
+    Transformers are cached so that each CRS pair is only initialised once per process.
+    Coordinates are always in (x, y) = (lon, lat) order.
+    """
+    key=(from_crs, to_crs)
+    if key not in _transformers:
+        _transformers[key]=pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return _transformers[key]
+
+@contextmanager
+def timed_stage(stage_name, timings):
+    """
+    Times the enclosed block, prints the result and saves it in timings[stage_name] (seconds).
+    """
+    start=time.time()
+    yield
+    timings[stage_name]=time.time()-start
+    print('\t{}: {:.2f}s'.format(stage_name, timings[stage_name]))
+
+def _init_search_worker(graph, radius, pois_at_nodes, poi_types):
+    """
+    Stores the state shared by all the searches of a worker process.
+    """
+    _search_state['graph']=graph
+    _search_state['radius']=radius
+    _search_state['pois_at_nodes']=pois_at_nodes
+    _search_state['poi_types']=poi_types
+
+def _accessibility_shard(sources):
+    """
+    For each source node, counts the POIs of each type at the nodes reachable within the radius.
+    Returns a list of (source, {poi_type: count}).
+    """
+    graph, radius=_search_state['graph'], _search_state['radius']
+    pois_at_nodes, poi_types=_search_state['pois_at_nodes'], _search_state['poi_types']
+    results=[]
+    for source in sources:
+        reachable=nx.single_source_dijkstra_path_length(graph, source, cutoff=radius, weight='weight')
+        counts={poi_type: 0 for poi_type in poi_types}
+        for n in reachable:
+            if n in pois_at_nodes:
+                for poi_type in poi_types:
+                    counts[poi_type]+=pois_at_nodes[n][poi_type]
+        results.append((source, counts))
+    return results
+
+def _reachable_shard(sources):
+    """
+    For each source node, lists the nodes reachable within the radius (including the source).
+    Returns a list of (source, [nodes]).
+    """
+    graph, radius=_search_state['graph'], _search_state['radius']
+    return [(source, list(nx.single_source_dijkstra_path_length(graph, source, cutoff=radius, weight='weight')))
+            for source in sources]
+
+def run_sharded_searches(shard_func, sources, graph, radius, pois_at_nodes=None, poi_types=None,
+                         n_jobs=1, shard_size=100, label='nodes'):
+    """
+    Runs shard_func over the source nodes in shards of shard_size, using a pool of n_jobs processes
+    (or the current process if n_jobs==1) and printing the progress.
+    Returns a dict {source: result}.
+    """
+    init_args=(graph, radius, pois_at_nodes, poi_types)
+    shards=[sources[i:i+shard_size] for i in range(0, len(sources), shard_size)]
+    results={}
+    def collect(shard_results):
+        results.update(shard_results)
+        print('{} of {} {}'.format(len(results), len(sources), label))
+    if n_jobs==1 or len(shards)<2:
+        _init_search_worker(*init_args)
+        for shard in shards:
+            collect(shard_func(shard))
+    else:
+        with Pool(processes=n_jobs, initializer=_init_search_worker, initargs=init_args) as pool:
+            for shard_results in pool.imap_unordered(shard_func, shards):
+                collect(shard_results)
+    _search_state.clear()
+    return results
 
 
 def approx_shape_centroid(geometry):
@@ -30,6 +122,13 @@ def approx_shape_centroid(geometry):
     else:
         print('Unknown geometry type')
 
+def geogrid_signature(geogrid):
+    """
+    Returns a hash of the header and the features of a GEOGRID.
+    """
+    content=json.dumps({'header': geogrid['properties']['header'], 'features': geogrid['features']}, sort_keys=True)
+    return hashlib.md5(content.encode()).hexdigest()
+
 class ProxIndicator(Indicator):
     def setup(self,host='https://cityio.media.mit.edu/', *args,**kwargs):
 #        self.viz_type = kwargs['viz_type_in']
@@ -49,7 +148,13 @@ class ProxIndicator(Indicator):
         assert(all(poi in self.scalers for poi in self.all_poi_types))
         self.radius=15 # minutes
         self.dummy_link_speed_met_min=2*1000/60
+        self.max_dist_virtual=30
         self.host=host
+        self.contract_network=kwargs.get('contract_network', False)
+        self.n_jobs=kwargs.get('n_jobs', 1) or os.cpu_count()
+        self.checkpoint_dir='./tables/{}/prepare_checkpoints/'.format(self.table_name)
+        self.stage_timings={}
+        self.cityio_geogrid=None
         # self.pois_per_lu={
         #           'Residential': {'housing': 200},
         #           'Office Tower': {'employment': 1200},
@@ -69,31 +174,150 @@ class ProxIndicator(Indicator):
                 }
         self.agg_pois={'3rd Places': ['restaurants', 'groceries']}
         
-    def prepare_model(self):
+    def prepare_stages(self):
+        """
+        Returns the stages of prepare_model in order, as tuples of
+        (stage name, method, attributes produced, settings the stage depends on).
+        The attributes are saved to a checkpoint after each stage and
+        a checkpoint is only reused if the settings have not changed.
+        The GEOGRID is downloaded from cityIO to check whether it changed since the spatial data was prepared.
+        """
+        if self.cityio_geogrid is None:
+            self.cityio_geogrid=self.download_geogrid()
+        stages=[
+            ('spatial_data', self.get_spatial_data,
+             ['geogrid', 'updatable_nodes', 'geogrid_header', 'geogrid_ll', 'geogrid_x', 'geogrid_y', 'geogrid_xy'],
+             {'host': self.host, 'local_epsg': self.table_configs['local_epsg'],
+              'geogrid': geogrid_signature(self.cityio_geogrid)}),
+            ('base_pois', self.get_base_pois,
+             ['base_amenities', 'zones'],
+             {'access_osm_pois': self.table_configs['access_osm_pois'],
+              'access_zonal_pois': self.table_configs['access_zonal_pois'],
+              'bboxes': self.table_configs.get('bboxes'), 'zones': file_fingerprint([self.zones_path])}),
+            ('transport_network', self.create_transport_network,
+             ['graph', 'nodes_x', 'nodes_y', 'node_ids', 'pois_at_base_nodes'],
+             {'nodes': file_fingerprint([self.ua_nodes_path]), 'edges': file_fingerprint([self.ua_edges_path]),
+              'all_poi_types': self.all_poi_types, 'dummy_link_speed_met_min': self.dummy_link_speed_met_min}),
+            ('sampling_grid', self.create_sampling_grid,
+             ['sample_x', 'sample_y', 'sample_lons', 'sample_lats'],
+             {'sampling_grid': self.table_configs['sampling_grid']})]
+        if self.contract_network:
+            stages.append(('simplify_network', self.simplify_network,
+                           ['graph', 'pois_at_base_nodes', 'simplification_stats'],
+                           {'max_dist_virtual': self.max_dist_virtual}))
+        stages+=[
+            ('link_sample_points', self.link_sample_points,
+             ['graph'],
+             {'max_dist_virtual': self.max_dist_virtual, 'dummy_link_speed_met_min': self.dummy_link_speed_met_min}),
+            ('baseline_accessibility', self.estimate_baseline_accessibility,
+             ['sample_nodes_acc_base', 'grid_nodes_acc_base'],
+             {'radius': self.radius, 'employment_types': self.employment_types,
+              'residential_types': self.residential_types}),
+            ('interactive_analysis', self.prepare_interatve_analysis,
+             ['affected_sample_nodes', 'affected_grid_nodes', 'from_employ_pois', 'from_housing_pois'],
+             {'radius': self.radius})]
+        return stages
+
+    def checkpoint_path(self, stage_name):
+        return os.path.join(self.checkpoint_dir, '{}.p'.format(stage_name))
+
+    def read_checkpoint(self, stage_name):
+        """
+        Returns the saved checkpoint of a stage or None if it does not exist or cannot be read.
+        """
+        try:
+            return pickle.load(open(self.checkpoint_path(stage_name), 'rb'))
+        except Exception:
+            return None
+
+    def write_checkpoint(self, stage_name, attributes, settings, upstream_created):
+        """
+        Saves the attributes produced by a stage.
+        The file is written with APICalls.atomic_write so that an interrupted run never leaves a partial checkpoint.
+        """
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        checkpoint={'stage': stage_name, 'settings': settings,
+                    'upstream_created': upstream_created, 'created': time.time(),
+                    'attributes': {attr: getattr(self, attr) for attr in attributes if hasattr(self, attr)}}
+        atomic_write(self.checkpoint_path(stage_name), pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL))
+        return checkpoint
+
+    def prepare_model(self, resume=True, rerun=None, n_jobs=None):
+        """
+        Runs the preparation stages (see prepare_stages) and saves the model parameters.
+
+        Parameters
+        ----------
+        resume : bool
+            If True, stages with a valid checkpoint are loaded from disk instead of being run again.
+            A checkpoint is invalid if the settings of its stage have changed or if an upstream stage was run again.
+        rerun : list
+            Names of stages to run again even if they have a valid checkpoint (the following stages are also run).
+        n_jobs : int
+            Number of processes used for the accessibility searches. Defaults to the value given at setup.
+        """
         print('Preparing model')
-        self.get_spatial_data()
-        self.get_base_pois()
-        self.create_transport_network()
-        self.create_sampling_grid()
-        self.estimate_baseline_accessibility()
-        self.prepare_interatve_analysis()
+        if n_jobs is not None:
+            self.n_jobs=n_jobs
+        rerun=rerun or []
+        self.set_projections()
+        self.cityio_geogrid=None
+        stages=self.prepare_stages()
+
+        # find the first stage that needs to run
+        checkpoints=[]
+        first_to_run=len(stages)
+        upstream_created=None
+        for i, (stage_name, _, _, settings) in enumerate(stages):
+            checkpoint=self.read_checkpoint(stage_name) if resume else None
+            if ((checkpoint is None) or (stage_name in rerun) or (checkpoint['settings']!=settings)
+                or (checkpoint['upstream_created']!=upstream_created)):
+                first_to_run=i
+                break
+            checkpoints.append(checkpoint)
+            upstream_created=checkpoint['created']
+
+        # load the valid checkpoints, skipping attributes that are overwritten by a later checkpoint
+        for i, checkpoint in enumerate(checkpoints):
+            later_attributes=set(attr for c in checkpoints[i+1:] for attr in c['attributes'])
+            print('Loading checkpoint: {}'.format(checkpoint['stage']))
+            for attr, value in checkpoint['attributes'].items():
+                if attr not in later_attributes:
+                    setattr(self, attr, value)
+
+        for stage_name, stage_method, attributes, settings in stages[first_to_run:]:
+            print('Running stage: {}'.format(stage_name))
+            stage_method()
+            upstream_created=self.write_checkpoint(stage_name, attributes, settings, upstream_created)['created']
         self.save_model_params()
-    
-    def get_spatial_data(self):
+
+    def set_projections(self):
         local_epsg = self.table_configs['local_epsg']
         self.projection=pyproj.Proj("+init=EPSG:"+local_epsg)
         self.wgs=pyproj.Proj("+init=EPSG:4326")
+        self.to_local=get_transformer('EPSG:4326', 'EPSG:'+local_epsg)
+        self.to_wgs=get_transformer('EPSG:'+local_epsg, 'EPSG:4326')
+
+    def download_geogrid(self):
         cityIO_get_url=self.host+'api/table/'+self.table_name
         with urllib.request.urlopen(cityIO_get_url+'/GEOGRID') as url:
-            self.geogrid=json.loads(url.read().decode())
+            return json.loads(url.read().decode())
+
+    def get_spatial_data(self):
+        self.set_projections()
+        # downloaded by prepare_stages
+        if self.cityio_geogrid is None:
+            self.cityio_geogrid=self.download_geogrid()
+        self.geogrid=self.cityio_geogrid
         self.updatable_nodes=[((feat['properties']['interactive']) or (feat['properties']['static_new'])) for feat in self.geogrid['features']]
         self.geogrid_header=self.geogrid['properties']['header']
         self.geogrid_ll=[self.geogrid['features'][i][
                 'geometry']['coordinates'][0][0
                 ] for i in range(len(self.geogrid['features']))] 
-        self.geogrid_x, self.geogrid_y=pyproj.transform(self.wgs, self.projection,
-              [self.geogrid_ll[p][0] for p in range(len(self.geogrid_ll))], 
-              [self.geogrid_ll[p][1] for p in range(len(self.geogrid_ll))])
+        geogrid_ll=np.array(self.geogrid_ll)
+        geogrid_x, geogrid_y=self.to_local.transform(geogrid_ll[:,0], geogrid_ll[:,1])
+        self.geogrid_x, self.geogrid_y=geogrid_x.tolist(), geogrid_y.tolist()
         self.geogrid_xy=[[self.geogrid_x[i], self.geogrid_y[i]] for i in range(len(self.geogrid_x))]
         
     def get_base_pois(self):
@@ -118,80 +342,93 @@ class ProxIndicator(Indicator):
             
     def create_transport_network(self):
         print('Building the base transport network')
-        self.edges=pd.read_csv(self.ua_edges_path)
-        self.nodes=pd.read_csv(self.ua_nodes_path)   
+        timings={}
+        with timed_stage('read network files', timings):
+            self.edges=pd.read_csv(self.ua_edges_path)
+            self.nodes=pd.read_csv(self.ua_nodes_path)
         
-        nodes_lon=self.nodes['x'].values
-        nodes_lat=self.nodes['y'].values
-        self.nodes_x, self.nodes_y= pyproj.transform(self.wgs, self.projection,nodes_lon, nodes_lat)
-        kdtree_base_nodes=spatial.KDTree(np.column_stack((self.nodes_x, self.nodes_y)))
+        with timed_stage('project nodes and build KD-tree', timings):
+            self.nodes_x, self.nodes_y=self.to_local.transform(self.nodes['x'].values, self.nodes['y'].values)
+            self.node_ids=self.nodes['id_int'].values
+            kdtree_base_nodes=spatial.cKDTree(np.column_stack((self.nodes_x, self.nodes_y)))
         
-        self.graph=nx.DiGraph()
-        for i, row in self.edges.iterrows():
-            self.graph.add_edge(row['from_int'], row['to_int'], weight=row['weight'])
-          
+        with timed_stage('add network edges', timings):
+            self.graph=nx.DiGraph()
+            self.graph.add_weighted_edges_from(zip(self.edges['from_int'].values.tolist(),
+                                                   self.edges['to_int'].values.tolist(),
+                                                   self.edges['weight'].values.tolist()))
 
         self.pois_at_base_nodes={n: {t:0 for t in self.all_poi_types} for n in self.graph.nodes} 
         
-        print('Finding closest node to each base POI')            
+        print('Finding closest node to each base POI')
         # associate each amenity with its closest node in the base network
-        for tag in self.base_amenities:
-            for ai in range(len(self.base_amenities[tag]['x'])):
-                nearest_node=self.nodes.iloc[kdtree_base_nodes.query(
-                        [self.base_amenities[tag]['x'][ai],
-                        self.base_amenities[tag]['y'][ai]])[1]]['id_int']
-                self.pois_at_base_nodes[nearest_node][tag]+=1
+        with timed_stage('snap OSM POIs to network', timings):
+            for tag in self.base_amenities:
+                if len(self.base_amenities[tag]['x'])==0:
+                    continue
+                _, nearest_inds=kdtree_base_nodes.query(np.column_stack((
+                        self.base_amenities[tag]['x'], self.base_amenities[tag]['y'])))
+                nearest_nodes, counts=np.unique(self.node_ids[nearest_inds], return_counts=True)
+                for nearest_node, count in zip(nearest_nodes.tolist(), counts.tolist()):
+                    if nearest_node in self.pois_at_base_nodes:
+                        self.pois_at_base_nodes[nearest_node][tag]+=count
         if self.table_configs['access_zonal_pois']:
-            count=0
-            for f in self.zones['features']:
-                count+=1
-                if count%1000==0:
-                    print('{} of {} zones'.format(count, len(self.zones['features'])))
-                if any(f['properties'][poi_type]>0 for poi_type in self.table_configs['access_zonal_pois']):
-                    centroid_xy=pyproj.transform(self.wgs, self.projection,f['properties']['centroid'][0], 
-                                                 f['properties']['centroid'][1])
-                    distance, nearest_node_ind=kdtree_base_nodes.query(centroid_xy)
-                    nearest_node=self.nodes.iloc[nearest_node_ind]['id_int']
-                    if distance<500: #(because some parcels are outside the network area)
-                        for poi_type in self.table_configs['access_zonal_pois']:
-                            if poi_type in f['properties']:
-                                self.pois_at_base_nodes[nearest_node][poi_type]+=f['properties'][poi_type]        
+            with timed_stage('snap zonal POIs to network', timings):
+                zonal_pois=self.table_configs['access_zonal_pois']
+                zones_with_pois=[f for f in self.zones['features'] if any(
+                        f['properties'][poi_type]>0 for poi_type in zonal_pois)]
+                print('{} of {} zones have POIs'.format(len(zones_with_pois), len(self.zones['features'])))
+                if len(zones_with_pois)>0:
+                    centroids=np.array([f['properties']['centroid'] for f in zones_with_pois])
+                    centroids_x, centroids_y=self.to_local.transform(centroids[:,0], centroids[:,1])
+                    distances, nearest_inds=kdtree_base_nodes.query(np.column_stack((centroids_x, centroids_y)))
+                    nearest_nodes=self.node_ids[nearest_inds].tolist()
+                    for f, distance, nearest_node in zip(zones_with_pois, distances, nearest_nodes):
+                        if distance<500 and nearest_node in self.pois_at_base_nodes: #(because some parcels are outside the network area)
+                            for poi_type in zonal_pois:
+                                if poi_type in f['properties']:
+                                    self.pois_at_base_nodes[nearest_node][poi_type]+=f['properties'][poi_type]
         # Add links for the new network defined by the interactive area  
         #print('Adding dummy links for the grid network') 
         interactive_meta_cells={i:i for i in range(len(self.geogrid['features']))}
         
-        self.createGridGraphs(interactive_meta_cells, 
-                               kdtree_base_nodes)
+        with timed_stage('add grid network', timings):
+            self.createGridGraphs(interactive_meta_cells, 
+                                   kdtree_base_nodes)
+        self.stage_timings['create_transport_network']=timings
         
     def createGridGraphs(self, interactive_meta_cells,
                          kd_tree_nodes, dist_thresh=100):
         """
         returns new networks including roads around the cells
         """
-    #    create graph internal to the grid
-    #    graph.add_nodes_from('g'+str(n) for n in range(len(grid_coords_xy)))
-        n_links_to_real_net=0
         nrows, ncols=self.geogrid_header['nrows'], self.geogrid_header['ncols']
         cell_size=self.geogrid_header['cellSize']
-        for c in range(ncols):
-            for r in range(nrows):
-                cell_num=r*ncols+c
-                if cell_num in interactive_meta_cells: # if this is an interactive cell
-                    # if close to any real nodes, make a link
-                    dist_to_closest, closest_ind=kd_tree_nodes.query(self.geogrid_xy[cell_num], k=1)
-                    if dist_to_closest<dist_thresh:
-                        n_links_to_real_net+=1
-                        closest_node_id=self.nodes.iloc[closest_ind]['id_int']
-                        self.graph.add_edge('g'+str(cell_num), closest_node_id, weight=dist_to_closest/self.dummy_link_speed_met_min)
-                        self.graph.add_edge(closest_node_id, 'g'+str(cell_num), weight=dist_to_closest/self.dummy_link_speed_met_min)                   
-                    # if not at the end of a row, add h link
-                    if not c==self.geogrid_header['ncols']-1:
-                        self.graph.add_edge('g'+str(r*ncols+c), 'g'+str(r*ncols+c+1), weight=cell_size/self.dummy_link_speed_met_min)
-                        self.graph.add_edge('g'+str(r*ncols+c+1), 'g'+str(r*ncols+c), weight=cell_size/self.dummy_link_speed_met_min)
-                    # if not at the end of a column, add v link
-                    if not r==nrows-1:
-                        self.graph.add_edge('g'+str(r*ncols+c), 'g'+str((r+1)*ncols+c), weight=cell_size/self.dummy_link_speed_met_min)
-                        self.graph.add_edge('g'+str((r+1)*ncols+c), 'g'+str(r*ncols+c), weight=cell_size/self.dummy_link_speed_met_min)
+        grid_link_time=cell_size/self.dummy_link_speed_met_min
+        cell_nums=[cell_num for cell_num in range(nrows*ncols) if cell_num in interactive_meta_cells]
+        if len(cell_nums)==0:
+            return
+        # find the closest real node to all interactive cells at once
+        dists_to_closest, closest_inds=kd_tree_nodes.query(
+                np.array([self.geogrid_xy[cell_num] for cell_num in cell_nums]), k=1)
+        closest_node_ids=self.node_ids[closest_inds].tolist()
+        new_edges=[]
+        for cell_num, dist_to_closest, closest_node_id in zip(cell_nums, dists_to_closest, closest_node_ids):
+            r, c=cell_num//ncols, cell_num%ncols
+            # if close to any real nodes, make a link
+            if dist_to_closest<dist_thresh:
+                new_edges.append(('g'+str(cell_num), closest_node_id, dist_to_closest/self.dummy_link_speed_met_min))
+                new_edges.append((closest_node_id, 'g'+str(cell_num), dist_to_closest/self.dummy_link_speed_met_min))
+            # if not at the end of a row, add h link
+            if not c==ncols-1:
+                new_edges.append(('g'+str(cell_num), 'g'+str(cell_num+1), grid_link_time))
+                new_edges.append(('g'+str(cell_num+1), 'g'+str(cell_num), grid_link_time))
+            # if not at the end of a column, add v link
+            if not r==nrows-1:
+                new_edges.append(('g'+str(cell_num), 'g'+str(cell_num+ncols), grid_link_time))
+                new_edges.append(('g'+str(cell_num+ncols), 'g'+str(cell_num), grid_link_time))
+        self.graph.add_weighted_edges_from(new_edges)
+        print('{} grid cells linked to the real network'.format(sum(dists_to_closest<dist_thresh)))
                             
        
     def create_sampling_grid(self):
@@ -206,77 +443,159 @@ class ProxIndicator(Indicator):
         sample_points_origin=grid_origin-row_margin_top*dXdRow-col_margin_left*dXdCol
         sample_points=np.array([sample_points_origin+stride*j*dXdCol+stride*i*dXdRow for i in range(
             int(cell_height/stride)) for j in range(int(cell_width/stride))])            
-        self.sample_x, self.sample_y= list(sample_points[:,0]), list(sample_points[:,1])
-        self.sample_lons, self.sample_lats=pyproj.transform(self.projection,self.wgs, 
-                                                            self.sample_x, self.sample_y)
-        
-    def estimate_baseline_accessibility(self):
-        print('Baseline Accessibility for sample nodes and grid nodes') 
-        all_nodes_ids, all_nodes_xy=[], []
-        for ind_node in range(len(self.nodes_x)):
-            all_nodes_ids.append(self.nodes.iloc[ind_node]['id_int'])
-            all_nodes_xy.append([self.nodes_x[ind_node], self.nodes_y[ind_node]])
-        for ind_grid_cell in range(len(self.geogrid_xy)):
-            all_nodes_ids.append('g'+str(ind_grid_cell))
-            all_nodes_xy.append(self.geogrid_xy[ind_grid_cell])
+        self.sample_x, self.sample_y= sample_points[:,0].tolist(), sample_points[:,1].tolist()
+        sample_lons, sample_lats=self.to_wgs.transform(sample_points[:,0], sample_points[:,1])
+        self.sample_lons, self.sample_lats=sample_lons.tolist(), sample_lats.tolist()
         
-        kdtree_all_nodes=spatial.KDTree(np.array(all_nodes_xy))
+    def simplify_network(self):
+        """
+        Optional preprocessing stage that shrinks the network before the accessibility searches.
+        It drops the components of the network that cannot be reached from the grid or from the sample points,
+        and contracts chains of nodes without POIs into single links that carry the summed travel time.
+        Nodes with POIs, nodes linked to the grid and nodes close enough to be linked to a sample point
+        are never removed, so travel times between all the nodes used by the searches are preserved.
+        Needs to run after create_sampling_grid and before estimate_baseline_accessibility.
+        """
+        print('Simplifying the transport network')
+        timings={}
+        n_nodes_before, n_edges_before=self.graph.number_of_nodes(), self.graph.number_of_edges()
+        with timed_stage('find protected nodes', timings):
+            grid_nodes=[n for n in self.graph.nodes if isinstance(n, str)]
+            protected=set(grid_nodes)
+            for g in grid_nodes:
+                protected.update(self.graph.predecessors(g))
+                protected.update(self.graph.successors(g))
+            protected.update(n for n in self.pois_at_base_nodes if any(
+                    self.pois_at_base_nodes[n][t]>0 for t in self.all_poi_types))
+            # nodes that estimate_baseline_accessibility could link to a sample point
+            kdtree_samples=spatial.cKDTree(np.column_stack((self.sample_x, self.sample_y)))
+            dist_to_sample, _=kdtree_samples.query(np.column_stack((self.nodes_x, self.nodes_y)), 
+                                                   distance_upper_bound=self.max_dist_virtual)
+            sample_anchors=set(self.node_ids[dist_to_sample<self.max_dist_virtual].tolist())
+            protected.update(sample_anchors)
         
-        # add the virtual links between sample points and closest nodes
-        MAX_DIST_VIRTUAL=30
-        all_sample_node_ids=[]
-        for p in range(len(self.sample_x)):
-            all_sample_node_ids.append('s'+str(p))
-            self.graph.add_node('s'+str(p))
-            distance_to_closest, closest_nodes=kdtree_all_nodes.query([self.sample_x[p], self.sample_y[p]], 5)
-            for candidate in zip(distance_to_closest, closest_nodes):
-                if candidate[0]<MAX_DIST_VIRTUAL:
-                    close_node_id=all_nodes_ids[candidate[1]]
-                    self.graph.add_edge('s'+str(p), close_node_id, 
-                                        weight=candidate[0]/(self.dummy_link_speed_met_min))
+        with timed_stage('drop unreachable components', timings):
+            seeds=set(grid_nodes)|sample_anchors
+            to_drop=[]
+            for component in nx.weakly_connected_components(self.graph):
+                if component.isdisjoint(seeds):
+                    to_drop.extend(component)
+            self.graph.remove_nodes_from(to_drop)
         
+        with timed_stage('contract chains of nodes', timings):
+            n_contracted=0
+            candidates=deque(n for n in self.graph.nodes if n not in protected)
+            while len(candidates)>0:
+                n=candidates.popleft()
+                if (n in protected) or (not self.graph.has_node(n)):
+                    continue
+                preds, succs=set(self.graph.predecessors(n)), set(self.graph.successors(n))
+                neighbours=preds|succs
+                if (n in neighbours) or (len(neighbours)>2):
+                    continue
+                # every path through n goes from a predecessor to a successor, 
+                # dead ends (only one neighbour) are never part of a shortest path
+                for u in preds:
+                    for v in succs:
+                        if u!=v:
+                            weight=self.graph[u][n]['weight']+self.graph[n][v]['weight']
+                            if (not self.graph.has_edge(u, v)) or (weight<self.graph[u][v]['weight']):
+                                self.graph.add_edge(u, v, weight=weight)
+                self.graph.remove_node(n)
+                n_contracted+=1
+                candidates.extend(neighbours)
         
-        # for each sample node, create an isochrone and count the amenities of each type        
-        self.sample_nodes_acc_base={str(n): {poi_type:0 for poi_type in self.all_poi_types} for n in range(len(self.sample_x))} 
-        for sn in self.sample_nodes_acc_base:
-            if int(sn)%200==0:
-                print('{} of {} sample nodes'.format(sn, len(self.sample_nodes_acc_base)))
-            isochrone_graph=nx.ego_graph(self.graph, 's'+str(sn), radius=self.radius, center=True, 
-                                         undirected=False, distance='weight')
-            reachable_real_nodes=[n for n in isochrone_graph.nodes if n in self.pois_at_base_nodes]
-            for poi_type in self.all_poi_types:
-                self.sample_nodes_acc_base[sn][poi_type]=sum([self.pois_at_base_nodes[reachable_node][poi_type] 
-                                                    for reachable_node in reachable_real_nodes])   
+        removed=[n for n in self.pois_at_base_nodes if not self.graph.has_node(n)]
+        for n in removed:
+            del self.pois_at_base_nodes[n]
+        n_nodes_after, n_edges_after=self.graph.number_of_nodes(), self.graph.number_of_edges()
+        self.simplification_stats={'nodes_before': n_nodes_before, 'nodes_after': n_nodes_after,
+                                   'edges_before': n_edges_before, 'edges_after': n_edges_after,
+                                   'dropped_unreachable': len(to_drop), 'contracted': n_contracted}
+        print('Nodes: {} -> {} ({:.1f}% reduction)'.format(n_nodes_before, n_nodes_after, 
+              100*(1-n_nodes_after/max(n_nodes_before, 1))))
+        print('Edges: {} -> {} ({:.1f}% reduction)'.format(n_edges_before, n_edges_after, 
+              100*(1-n_edges_after/max(n_edges_before, 1))))
+        self.stage_timings['simplify_network']=timings
+
+    def link_sample_points(self):
+        """
+        Adds the sample points to the graph, with virtual links to the closest nodes.
+        """
+        print('Linking sample points to the network')
+        timings={}
+        with timed_stage('link sample points to network', timings):
+            # nodes removed by simplify_network are all further than MAX_DIST_VIRTUAL from the sample points
+            all_nodes_ids=self.node_ids.tolist()+['g'+str(ind_grid_cell) for ind_grid_cell in range(len(self.geogrid_xy))]
+            all_nodes_xy=np.vstack((np.column_stack((self.nodes_x, self.nodes_y)), 
+                                    np.array(self.geogrid_xy).reshape(-1, 2)))
+            kdtree_all_nodes=spatial.cKDTree(all_nodes_xy)
             
+            # add the virtual links between sample points and closest nodes
+            MAX_DIST_VIRTUAL=self.max_dist_virtual
+            distances_to_closest, closest_nodes=kdtree_all_nodes.query(
+                    np.column_stack((self.sample_x, self.sample_y)), k=5, 
+                    distance_upper_bound=MAX_DIST_VIRTUAL)
+            sample_edges=[]
+            for p in range(len(self.sample_x)):
+                self.graph.add_node('s'+str(p))
+                for distance, closest_ind in zip(distances_to_closest[p], closest_nodes[p]):
+                    if distance<MAX_DIST_VIRTUAL:
+                        sample_edges.append(('s'+str(p), all_nodes_ids[closest_ind], 
+                                             distance/(self.dummy_link_speed_met_min)))
+            self.graph.add_weighted_edges_from(sample_edges)
+        self.stage_timings['link_sample_points']=timings
+
+    def estimate_baseline_accessibility(self):
+        """
+        For each sample node and each relevant grid node, counts the amenities of each type reachable within the radius.
+        The searches are split in shards and run on self.n_jobs processes.
+        Needs to run after link_sample_points.
+        """
+        print('Baseline Accessibility for sample nodes and grid nodes') 
+        timings={}
+        # for each sample node, search the network and count the amenities of each type        
+        with timed_stage('sample node isochrones', timings):
+            self.sample_nodes_acc_base={str(n): {poi_type:0 for poi_type in self.all_poi_types} for n in range(len(self.sample_x))} 
+            results=run_sharded_searches(_accessibility_shard, ['s'+sn for sn in self.sample_nodes_acc_base], 
+                                         self.graph, self.radius, self.pois_at_base_nodes, self.all_poi_types,
+                                         n_jobs=self.n_jobs, label='sample nodes')
+            for source, counts in results.items():
+                self.sample_nodes_acc_base[source[1:]]=counts
             
         # same for geogrid nodes
-        self.grid_nodes_acc_base={str(n): {poi_type:0 for poi_type in self.all_poi_types} for n in range(len(self.geogrid_xy))} 
-        for gn in self.grid_nodes_acc_base:
-            if int(gn)%200==0:
-                print('{} of {} geogrid nodes'.format(gn, len(self.grid_nodes_acc_base)))
-            base_lu=self.geogrid['features'][int(gn)]['properties']['type']
-            if ((base_lu in self.employment_types+self.residential_types) or self.updatable_nodes[int(gn)]):
-                isochrone_graph=nx.ego_graph(self.graph, 'g'+str(gn), radius=self.radius, center=True, 
-                                             undirected=False, distance='weight')
-                reachable_real_nodes=[n for n in isochrone_graph.nodes if n in self.pois_at_base_nodes]
-                for poi_type in self.all_poi_types:
-                    self.grid_nodes_acc_base[gn][poi_type]=sum([self.pois_at_base_nodes[reachable_node][poi_type] 
-                                                        for reachable_node in reachable_real_nodes]) 
+        with timed_stage('grid node isochrones', timings):
+            self.grid_nodes_acc_base={str(n): {poi_type:0 for poi_type in self.all_poi_types} for n in range(len(self.geogrid_xy))} 
+            grid_sources=[]
+            for gn in self.grid_nodes_acc_base:
+                base_lu=self.geogrid['features'][int(gn)]['properties']['type']
+                if ((base_lu in self.employment_types+self.residential_types) or self.updatable_nodes[int(gn)]):
+                    grid_sources.append('g'+gn)
+            results=run_sharded_searches(_accessibility_shard, grid_sources, 
+                                         self.graph, self.radius, self.pois_at_base_nodes, self.all_poi_types,
+                                         n_jobs=self.n_jobs, label='geogrid nodes')
+            for source, counts in results.items():
+                self.grid_nodes_acc_base[source[1:]]=counts
+        self.stage_timings['estimate_baseline_accessibility']=timings
+
     def prepare_interatve_analysis(self):
         print('Preparing for interactve updates. May take a few minutes.') 
-        rev_graph=self.graph.reverse()
-        # find the sample nodes affected by each interactive grid cell
-        self.affected_sample_nodes={} # to create the geojson
-        self.affected_grid_nodes={} # to get the average accessibility. eg. from all housing cells
-        for gi in range(len(self.geogrid_xy)):
-            if self.updatable_nodes[gi]:
-                a_node='g'+str(gi)
-                affected_nodes=nx.ego_graph(rev_graph, a_node, radius=self.radius, center=True, 
-                                            undirected=False, distance='weight').nodes
-                self.affected_grid_nodes[str(gi)]=[n for n in affected_nodes if 'g' in str(n)]
-                self.affected_sample_nodes[str(gi)]=[n for n in affected_nodes if 's' in str(n)]
+        timings={}
+        with timed_stage('reverse searches from interactive cells', timings):
+            rev_graph=self.graph.reverse()
+            # find the sample nodes affected by each interactive grid cell
+            self.affected_sample_nodes={} # to create the geojson
+            self.affected_grid_nodes={} # to get the average accessibility. eg. from all housing cells
+            sources=['g'+str(gi) for gi in range(len(self.geogrid_xy)) if self.updatable_nodes[gi]]
+            results=run_sharded_searches(_reachable_shard, sources, rev_graph, self.radius,
+                                         n_jobs=self.n_jobs, label='interactive grid nodes')
+            for a_node in sources:
+                affected_nodes=results[a_node]
+                self.affected_grid_nodes[a_node[1:]]=[n for n in affected_nodes if 'g' in str(n)]
+                self.affected_sample_nodes[a_node[1:]]=[n for n in affected_nodes if 's' in str(n)]
         self.from_employ_pois=['housing']
         self.from_housing_pois=[poi for poi in self.all_poi_types if not poi=='housing']
+        self.stage_timings['prepare_interatve_analysis']=timings
             
     def save_model_params(self):       
         output={'sample_nodes_acc_base': self.sample_nodes_acc_base,
@@ -290,9 +609,29 @@ class ProxIndicator(Indicator):
 #                'scalers': self.scalers,
                 'affected_grid_nodes': self.affected_grid_nodes,
                 'affected_sample_nodes': self.affected_sample_nodes,
-                'updatable_nodes': self.updatable_nodes}        
+                'updatable_nodes': self.updatable_nodes,
+                # the parameters are prepared again when the table configs change (see load_module)
+                'table_configs_hash': self.table_configs_hash()}        
         json.dump(output, open(self.params_path, 'w'))
+
+    def table_configs_hash(self):
+        with open(self.table_config_file_path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def params_match_configs(self, params):
+        """
+        Returns True if the saved parameters were prepared with the current table configs.
+        Parameters saved without the hash of the configs are accepted if they cover all the POI types.
+        """
+        if 'table_configs_hash' in params:
+            return params['table_configs_hash']==self.table_configs_hash()
+        acc_base=params['sample_nodes_acc_base']
+        return all(t in acc_base[n] for n in acc_base for t in self.all_poi_types)
         
+    def watched_files(self):
+        # the parameters file is rewritten by the reload itself; the hash of the configs saved in it tells whether it is stale (see load_module)
+        return [self.table_config_file_path]
+
     def load_module(self):
         try:
             params=json.load(open(self.params_path))
@@ -311,7 +650,42 @@ class ProxIndicator(Indicator):
         except:
             print('Parameters have not yet been saved. Preparing the model')
             self.prepare_model()
+        else:
+            if not self.params_match_configs(params):
+                # stages whose settings did not change are loaded from their checkpoints
+                print('Table configs changed since the parameters were saved. Preparing the model')
+                self.prepare_model()
+        self.prepare_arrays()
             
+    def prepare_arrays(self):
+        """
+        Converts the baseline accessibility and the affected nodes to arrays, 
+        so that each update only copies the baseline arrays and adds the new POIs to the affected rows.
+        Also creates the heatmap layer with the coordinates of the sample points.
+        """
+        self.poi_index={poi_type: i for i, poi_type in enumerate(self.all_poi_types)}
+        self.sample_acc_base=np.array([[self.sample_nodes_acc_base[str(n)][t] for t in self.all_poi_types] 
+                                       for n in range(len(self.sample_nodes_acc_base))], dtype=float).reshape(-1, len(self.all_poi_types))
+        self.grid_acc_base=np.array([[self.grid_nodes_acc_base[str(n)][t] for t in self.all_poi_types] 
+                                     for n in range(len(self.grid_nodes_acc_base))], dtype=float).reshape(-1, len(self.all_poi_types))
+        self.affected_sample_inds={gi: np.array([int(n[1:]) for n in self.affected_sample_nodes[gi]], dtype=int) 
+                                   for gi in self.affected_sample_nodes}
+        self.affected_grid_inds={gi: np.array([int(n[1:]) for n in self.affected_grid_nodes[gi]], dtype=int) 
+                                 for gi in self.affected_grid_nodes}
+        self.scaler_array=np.array([self.scalers[t] for t in self.all_poi_types], dtype=float)
+        self.heatmap=HeatmapColumns(np.column_stack((self.sample_lons, self.sample_lats)), self.all_poi_types)
+        # the sample points are a regular lattice (see create_sampling_grid), which allows the raster heatmap encoding
+        sampling_grid=self.table_configs['sampling_grid']
+        self.heatmap.set_grid(nrows=int(sampling_grid['cell_height']/sampling_grid['stride']), 
+                              ncols=int(sampling_grid['cell_width']/sampling_grid['stride']))
+
+    def create_access_heatmap(self, sample_acc):
+        """
+        takes an array with the accessibility of each sample point (rows) to each POI type (columns)
+        and returns the heatmap layer with the scaled values
+        """
+        return self.heatmap.with_values(sample_acc/self.scaler_array)
+
     def create_access_geojson(self, grids):
         """
         takes lists of x and y coordinates and a list containing the accessibility 
@@ -338,10 +712,8 @@ class ProxIndicator(Indicator):
 # =============================================================================
 #         Get accessibility results for each node
 # =============================================================================
-        sample_nodes_acc={n: {t:self.sample_nodes_acc_base[n][t] for t in self.all_poi_types
-                              } for n in self.sample_nodes_acc_base}
-        grid_nodes_acc={n: {t:self.grid_nodes_acc_base[n][t] for t in self.all_poi_types
-                              } for n in self.grid_nodes_acc_base}
+        sample_acc=self.sample_acc_base.copy()
+        grid_acc=self.grid_acc_base.copy()
         for gi, cell_data in enumerate(geogrid_data):
 #            if not type(usage)==list:
 #                print('Usage value is not a list: '+str(usage))
@@ -365,42 +737,37 @@ class ProxIndicator(Indicator):
 #                        new_housing_capacity=all_lbcs['1100']
 #                    else:
 #                        new_housing_capacity=0
-                    sample_nodes_to_update=self.affected_sample_nodes[str(gi)]
-                    grid_nodes_to_update=self.affected_grid_nodes[str(gi)]
-                    for n in sample_nodes_to_update:
-#                        sample_nodes_acc[n.split('s')[1]]['housing']+=new_housing_capacity
-                        sample_nodes_acc[n.split('s')[1]]['employment']+=n_new_jobs
-                    for n in grid_nodes_to_update:
-#                        grid_nodes_acc[n.split('g')[1]]['housing']+=new_housing_capacity
-                        grid_nodes_acc[n.split('g')[1]]['employment']+=n_new_jobs
+                    sample_inds_to_update=self.affected_sample_inds[str(gi)]
+                    grid_inds_to_update=self.affected_grid_inds[str(gi)]
+#                    sample_acc[sample_inds_to_update, self.poi_index['housing']]+=new_housing_capacity
+                    sample_acc[sample_inds_to_update, self.poi_index['employment']]+=n_new_jobs
+#                    grid_acc[grid_inds_to_update, self.poi_index['housing']]+=new_housing_capacity
+                    grid_acc[grid_inds_to_update, self.poi_index['employment']]+=n_new_jobs
                     if any (code in self.lbcs_to_pois for code in all_lbcs):
                         for lbcs in all_lbcs:
                             if lbcs in self.lbcs_to_pois:
                                 poi =self.lbcs_to_pois[lbcs]
                                 n_to_add=all_lbcs[lbcs]
-                                for n in sample_nodes_to_update:
-                                    sample_nodes_acc[n.split('s')[1]][poi]+=n_to_add
-                                for n in grid_nodes_to_update:
-                                    grid_nodes_acc[n.split('g')[1]][poi]+=n_to_add
+                                sample_acc[sample_inds_to_update, self.poi_index[poi]]+=n_to_add
+                                grid_acc[grid_inds_to_update, self.poi_index[poi]]+=n_to_add
 
 # =============================================================================
 #       Compute the indicator values and/or create geojson
 # =============================================================================
        
         indicators={}
+        cell_types=[cell_data['name'] for cell_data in geogrid_data]
+        employment_cells=np.array([t in self.employment_types for t in cell_types], dtype=bool)
+        residential_cells=np.array([t in self.residential_types for t in cell_types], dtype=bool)
         for poi in self.from_employ_pois:
             indicators[poi]={}
-            raw=np.mean([grid_nodes_acc[str(g)][poi
-                       ] for g in range(len(geogrid_data)
-                        ) if geogrid_data[g]['name'] in self.employment_types])
+            raw=np.mean(grid_acc[:len(geogrid_data)][employment_cells, self.poi_index[poi]])
             indicators[poi]['raw']=raw
             indicators[poi]['norm']=min(1, raw/self.scalers[poi])
         
         for poi in self.from_housing_pois:
             indicators[poi]={}
-            raw=np.mean([grid_nodes_acc[str(g)][poi
-                       ] for g in range(len(geogrid_data)
-                        ) if geogrid_data[g]['name'] in self.residential_types])
+            raw=np.mean(grid_acc[:len(geogrid_data)][residential_cells, self.poi_index[poi]])
             indicators[poi]['raw']=raw
             indicators[poi]['norm']=min(1, raw/self.scalers[poi])
 
@@ -422,8 +789,7 @@ class ProxIndicator(Indicator):
                                           'viz_type': self.viz_type, 
                                           'units': 'Capacity'})
         if self.indicator_type in ['heatmap', 'access']:            
-            grid_geojson=self.create_access_geojson(sample_nodes_acc)
-            return grid_geojson
+            return self.create_access_heatmap(sample_acc)
         else:
             return self.value_indicators
     
@@ -1,6 +1,9 @@
+import os
+import threading
 import requests
 import webbrowser
 import json
+import base64
 import Geohash
 import joblib
 import numpy as np
@@ -16,6 +19,185 @@ def is_number(s):
 	except:
 		return False
 
+class HeatmapColumns:
+	'''
+	Columnar heatmap layer: a fixed set of points and a 2-D array of values (points x properties).
+	Indicators of type heatmap can return this object instead of a geojson.
+	The Handler serializes it directly without building a dict per point.
+
+	The coordinates are usually computed once when the indicator is loaded:
+	> self.heatmap = HeatmapColumns(coordinates, properties)
+	and each update only provides a new array of values:
+	> return self.heatmap.with_values(values)
+
+	Parameters
+	----------
+	coordinates : array-like
+		Array of shape (n_points, 2) with the (lon, lat) of each point.
+	properties : list
+		Name of each column of values.
+	values : array-like (optional)
+		Array of shape (n_points, len(properties)). Defaults to zeros.
+	grid : dict (optional)
+		Affine grid descriptor of the points (see set_grid). Needed for the raster encoding.
+	'''
+	def __init__(self, coordinates, properties, values=None, grid=None):
+		self.coordinates = np.asarray(coordinates, dtype=float).reshape(-1,2)
+		self.properties = list(properties)
+		if values is None:
+			values = np.zeros((len(self.coordinates),len(self.properties)))
+		self.values = self._check_values(values)
+		self.grid = grid
+		self._feature_prefixes = [None] # shared by all the layers built with with_values
+
+	def __len__(self):
+		return len(self.coordinates)
+
+	def _check_values(self, values):
+		values = np.asarray(values, dtype=float)
+		if values.ndim==1:
+			values = values.reshape(-1,1)
+		if values.shape!=(len(self.coordinates),len(self.properties)):
+			raise NameError('Heatmap values should have shape {} got {}'.format((len(self.coordinates),len(self.properties)),values.shape))
+		return values
+
+	def with_values(self, values):
+		'''
+		Returns a new layer with the same points and properties and the given values.
+		'''
+		new_layer = HeatmapColumns.__new__(HeatmapColumns)
+		new_layer.coordinates = self.coordinates
+		new_layer.properties = self.properties
+		new_layer.values = self._check_values(values)
+		new_layer.grid = self.grid
+		new_layer._feature_prefixes = self._feature_prefixes
+		return new_layer
+
+	def same_points(self, other):
+		'''
+		Returns True if the other layer has the same points (in the same order).
+		'''
+		return (self.coordinates is other.coordinates) or ((self.coordinates.shape==other.coordinates.shape) and np.array_equal(self.coordinates,other.coordinates))
+
+	def combine(self, other):
+		'''
+		Returns a new layer with the properties of both layers. Both layers need to have the same points.
+		If a property is in both layers, the values of the other layer are kept.
+		'''
+		if not self.same_points(other):
+			raise NameError('Only heatmaps with the same points can be combined')
+		keep = [i for i,p in enumerate(self.properties) if p not in other.properties]
+		combined = HeatmapColumns.__new__(HeatmapColumns)
+		combined.coordinates = self.coordinates
+		combined.properties = [self.properties[i] for i in keep]+other.properties
+		combined.values = np.hstack((self.values[:,keep],other.values))
+		combined.grid = self.grid
+		combined._feature_prefixes = self._feature_prefixes
+		return combined
+
+	def to_geojson(self):
+		'''
+		Returns the layer as a cityIO geojson, with the properties of each feature given as a list.
+		'''
+		features = [{'type':'Feature','geometry':{'type':'Point','coordinates':coords},'properties':props} for coords,props in zip(self.coordinates.tolist(),self.values.tolist())]
+		return {'type':'FeatureCollection','properties':self.properties,'features':features}
+
+	def to_json(self):
+		'''
+		Serializes the layer to the same json as json.dumps(self.to_geojson()).
+		The part of each feature that does not depend on the values is only built once.
+		'''
+		if self._feature_prefixes[0] is None:
+			self._feature_prefixes[0] = ['{"type": "Feature", "geometry": {"type": "Point", "coordinates": '+json.dumps(coords)+'}, "properties": ' for coords in self.coordinates.tolist()]
+		features = ', '.join([prefix+json.dumps(props)+'}' for prefix,props in zip(self._feature_prefixes[0],self.values.tolist())])
+		return '{"type": "FeatureCollection", "properties": '+json.dumps(self.properties)+', "features": ['+features+']}'
+
+	def set_grid(self, nrows, ncols, max_error=0.05):
+		'''
+		Describes the points as a regular (possibly rotated) grid of nrows x ncols, stored row by row:
+			coordinates[row*ncols+col] = origin + col*col_step + row*row_step
+		The origin and steps are fitted by least squares and the grid is only kept if 
+		no point is further than max_error (as a fraction of the shortest step) from its grid position.
+		Grids defined in a local projection are not exactly regular in lon/lat, but the error is usually 
+		a few meters for a table sized area.
+
+		Returns
+		-------
+		grid : dict
+			The grid descriptor, or None if the points do not form a regular grid.
+		'''
+		self.grid = None
+		if nrows*ncols!=len(self.coordinates):
+			warn('Heatmap has {} points, not {} x {}: raster encoding disabled'.format(len(self.coordinates),nrows,ncols))
+			return None
+		rows, cols = np.divmod(np.arange(nrows*ncols),ncols)
+		design = np.column_stack((np.ones(nrows*ncols),cols,rows))
+		affine = np.linalg.lstsq(design,self.coordinates,rcond=None)[0]
+		step = min(np.linalg.norm(affine[1]),np.linalg.norm(affine[2])) if (nrows>1 and ncols>1) else max(np.linalg.norm(affine[1]),np.linalg.norm(affine[2]))
+		error = np.abs(design.dot(affine)-self.coordinates).max()/step if step>0 else np.inf
+		if error>max_error:
+			warn('Heatmap points are not a regular grid (max error {}): raster encoding disabled'.format(error))
+			return None
+		self.grid = {'origin':affine[0].tolist(),'col_step':affine[1].tolist(),'row_step':affine[2].tolist(),'nrows':int(nrows),'ncols':int(ncols)}
+		return self.grid
+
+	def to_raster(self, quantize=None):
+		'''
+		Encodes the layer as a grid descriptor plus one 2-D array per property (rows x cols, row by row),
+		serialized as base64 little-endian bytes. Missing values (NaN) are kept as nodata.
+		Use raster_to_geojson to decode it.
+
+		Parameters
+		----------
+		quantize : str (optional)
+			None to send float32 values, or 'uint8'/'uint16' to quantize each layer linearly between its min and max: 
+				value = code*scale+offset
+			The largest code is reserved for nodata.
+		'''
+		if self.grid is None:
+			raise NameError('Heatmap has no grid descriptor. Call set_grid first.')
+		if quantize not in [None,'uint8','uint16']:
+			raise NameError('quantize should be None, uint8, or uint16. Current value: '+str(quantize))
+		layers = []
+		for i,prop in enumerate(self.properties):
+			column = self.values[:,i]
+			if quantize is None:
+				layers.append({'name':prop,'dtype':'float32','data':base64.b64encode(column.astype('<f4').tobytes()).decode()})
+				continue
+			nodata = np.iinfo(quantize).max
+			finite = np.isfinite(column)
+			offset = float(column[finite].min()) if finite.any() else 0.0
+			value_range = float(column[finite].max())-offset if finite.any() else 0.0
+			scale = value_range/(nodata-1) if value_range>0 else 1.0
+			codes = np.full(len(column),nodata,dtype=quantize)
+			codes[finite] = np.rint((column[finite]-offset)/scale)
+			layers.append({'name':prop,'dtype':quantize,'scale':scale,'offset':offset,'nodata':int(nodata),
+						   'data':base64.b64encode(codes.astype(np.dtype(quantize).newbyteorder('<')).tobytes()).decode()})
+		return {'type':'RasterHeatmap','grid':self.grid,'properties':self.properties,'layers':layers}
+
+def raster_to_geojson(raster):
+	'''
+	Decodes the output of HeatmapColumns.to_raster into a cityIO geojson (a Point per grid cell and the properties as a list).
+	Quantized values are decoded to code*scale+offset and nodata to None.
+	'''
+	grid = raster['grid']
+	nrows, ncols = grid['nrows'], grid['ncols']
+	rows, cols = np.divmod(np.arange(nrows*ncols),ncols)
+	coordinates = np.array(grid['origin'])+np.outer(cols,grid['col_step'])+np.outer(rows,grid['row_step'])
+	columns = []
+	for layer in raster['layers']:
+		data = np.frombuffer(base64.b64decode(layer['data']),dtype=np.dtype(layer['dtype']).newbyteorder('<'))
+		if layer['dtype']=='float32':
+			column = data.astype(float)
+		else:
+			column = data*layer['scale']+layer['offset']
+			column[data==layer['nodata']] = np.nan
+		columns.append(column)
+	values = np.column_stack(columns).astype(object) if len(columns)!=0 else np.zeros((nrows*ncols,0),dtype=object)
+	values[np.isnan(values.astype(float))] = None
+	features = [{'type':'Feature','geometry':{'type':'Point','coordinates':coords},'properties':[None if v is None else float(v) for v in props]} for coords,props in zip(coordinates.tolist(),values.tolist())]
+	return {'type':'FeatureCollection','properties':list(raster['properties']),'features':features}
+
 class Handler:
 	'''
 	Class to handle the connection for indicators built based on data from the GEOGRID.
@@ -40,8 +222,16 @@ class Handler:
 		Name of variable with geometries.
 	quietly : boolean (default=True)
 		If True, it will show the status of every API call.
+	heatmap_encoding : str (default='geojson')
+		Encoding used to post heatmaps returned as HeatmapColumns.
+		'raster' sends the grid descriptor and one array per layer (see HeatmapColumns.to_raster) when the heatmap has a grid.
+	heatmap_quantize : str (optional)
+		None, 'uint8', or 'uint16'. Quantization used by the raster encoding.
+	reference_path : str (optional)
+		Path of a json file with the reference values, used if reference is not provided.
+		The file is reloaded when it changes (see start_watcher).
 	'''
-	def __init__(self, table_name, GEOGRIDDATA_varname = 'GEOGRIDDATA', GEOGRID_varname = 'GEOGRID', quietly=True, host_mode ='remote' , reference=None):
+	def __init__(self, table_name, GEOGRIDDATA_varname = 'GEOGRIDDATA', GEOGRID_varname = 'GEOGRID', quietly=True, host_mode ='remote' , reference=None, heatmap_encoding='geojson', heatmap_quantize=None, reference_path=None):
 
 		if host_mode=='local':
 			self.host = 'http://127.0.0.1:5000/'
@@ -73,7 +263,21 @@ class Handler:
 		self.geogrid_props=None
 		self.get_geogrid_props()
 
+		self.reference_path = reference_path
+		if (reference is None) and (reference_path is not None):
+			reference = json.load(open(reference_path))
 		self.reference =reference
+
+		# updates and reloads of indicators never overlap (see start_watcher)
+		self.update_lock = threading.Lock()
+		self.watched_stats = {}
+		self.watcher = None
+		self.stop_watching = threading.Event()
+
+		if heatmap_encoding not in ['geojson','raster']:
+			raise NameError('heatmap_encoding should either be geojson or raster. Current value: '+str(heatmap_encoding))
+		self.heatmap_encoding = heatmap_encoding
+		self.heatmap_quantize = heatmap_quantize
         
 	def check_table(self):
 		'''
@@ -274,7 +478,8 @@ class Handler:
 
 		if I.indicator_type in ['access','heatmap']:
 			new_value = I.return_indicator(geogrid_data)
-			new_value = self._format_geojson(new_value)
+			if not isinstance(new_value,HeatmapColumns):
+				new_value = self._format_geojson(new_value)
 			return [new_value]
 		elif I.indicator_type in ['numeric']:
 			new_value = I.return_indicator(geogrid_data)
@@ -307,7 +512,15 @@ class Handler:
 	def _combine_heatmap_values(self,new_values_heatmap):
 		'''
 		Combines a list of heatmap features (formatted as geojsons) into one cityIO GeoJson
+		If all the values are HeatmapColumns with the same points, they are combined into one HeatmapColumns.
 		'''
+		if (len(new_values_heatmap)!=0) and all([isinstance(new_value,HeatmapColumns) for new_value in new_values_heatmap]):
+			if all([new_values_heatmap[0].same_points(new_value) for new_value in new_values_heatmap[1:]]):
+				combined = new_values_heatmap[0]
+				for new_value in new_values_heatmap[1:]:
+					combined = combined.combine(new_value)
+				return combined
+		new_values_heatmap = [self._format_geojson(new_value.to_geojson()) if isinstance(new_value,HeatmapColumns) else new_value for new_value in new_values_heatmap]
 
 		all_properties = set([])
 		combined_features = {}
@@ -525,12 +738,19 @@ class Handler:
 		if not self.quietly:
 			print('Updating table with hash:',grid_hash_id)
 
-		new_values = self.update_package(geogrid_data=geogrid_data,append=append)
+		with self.update_lock:
+			new_values = self.update_package(geogrid_data=geogrid_data,append=append)
 
 		if len(new_values['numeric'])!=0:
 			r = requests.post(self.cityIO_post_url+'/indicators', data = json.dumps(new_values['numeric']))
 
-		if len(new_values['heatmap']['features'])!=0:
+		if isinstance(new_values['heatmap'],HeatmapColumns):
+			if len(new_values['heatmap'])!=0:
+				if (self.heatmap_encoding=='raster') and (new_values['heatmap'].grid is not None):
+					r = requests.post(self.cityIO_post_url+'/access', data = json.dumps(new_values['heatmap'].to_raster(quantize=self.heatmap_quantize)))
+				else:
+					r = requests.post(self.cityIO_post_url+'/access', data = new_values['heatmap'].to_json())
+		elif len(new_values['heatmap']['features'])!=0:
 			r = requests.post(self.cityIO_post_url+'/access', data = json.dumps(new_values['heatmap']))
 		if not self.quietly:
 			print('Done with update')
@@ -547,7 +767,105 @@ class Handler:
 		r = requests.post(self.cityIO_post_url+'/indicators', data = json.dumps(self.previous_indicators))
 		r = requests.post(self.cityIO_post_url+'/access', data = json.dumps(self.previous_access))
 
-	def listen(self,showFront=True,append=False):
+	def watched_files(self):
+		'''
+		Returns a dict with the files watched by the handler and the names of the indicators that depend on each of them 
+		(see Indicator.watched_files). The reference file (see reference_path) has no indicators.
+		'''
+		watched = {}
+		if self.reference_path is not None:
+			watched[os.path.abspath(self.reference_path)] = []
+		for indicator_name in self.indicators:
+			for fpath in self.indicators[indicator_name].watched_files():
+				watched.setdefault(os.path.abspath(fpath),[]).append(indicator_name)
+		return watched
+
+	def check_reloads(self):
+		'''
+		Reloads the indicators (and the reference values) whose watched files changed since the last check.
+		The new version of each indicator is prepared without holding the update lock (see Indicator.prepare_reload) 
+		and swapped in between updates. If preparing it fails, the indicator keeps its previous version.
+
+		Returns
+		-------
+		reloaded : list
+			Names of the indicators that were reloaded.
+		'''
+		from indicator_tools import file_fingerprint
+		changed_indicators = []
+		reload_reference = False
+		for fpath,indicator_names in self.watched_files().items():
+			stats = file_fingerprint([fpath])
+			if fpath not in self.watched_stats:
+				self.watched_stats[fpath] = stats
+				continue
+			if (stats is None) or (stats==self.watched_stats[fpath]):
+				continue
+			self.watched_stats[fpath] = stats
+			if not self.quietly:
+				print('Detected change in',fpath)
+			if len(indicator_names)==0:
+				reload_reference = True
+			changed_indicators += [name for name in indicator_names if name not in changed_indicators]
+
+		if reload_reference:
+			try:
+				reference = json.load(open(self.reference_path))
+				with self.update_lock:
+					self.reference = reference
+			except Exception as e:
+				warn('Could not reload reference values, keeping the previous ones: '+str(e))
+
+		reloaded = []
+		for indicator_name in changed_indicators:
+			I = self.indicators[indicator_name]
+			try:
+				state = I.prepare_reload()
+			except Exception as e:
+				warn('Could not reload indicator {}, keeping the previous version: {}'.format(indicator_name,e))
+				continue
+			with self.update_lock:
+				I.apply_reload(state)
+			reloaded.append(indicator_name)
+			if not self.quietly:
+				print('Reloaded indicator',indicator_name)
+		return reloaded
+
+	def start_watcher(self,interval=5):
+		'''
+		Starts a background thread that checks the watched files every interval seconds and reloads the indicators 
+		that depend on the files that changed (see check_reloads), so that models and configs can be updated without
+		restarting the listener.
+
+		Parameters
+		----------
+		interval : float (default=5)
+			Seconds between checks.
+		'''
+		if (self.watcher is not None) and self.watcher.is_alive():
+			return
+		from indicator_tools import file_fingerprint
+		self.stop_watching.clear()
+		self.watched_stats = {fpath:file_fingerprint([fpath]) for fpath in self.watched_files()}
+		def watch():
+			while not self.stop_watching.wait(interval):
+				try:
+					self.check_reloads()
+				except Exception as e:
+					warn('Watcher error: '+str(e))
+		self.watcher = threading.Thread(target=watch,daemon=True)
+		self.watcher.start()
+
+	def stop_watcher(self):
+		'''
+		Stops the thread started by start_watcher.
+		'''
+		self.stop_watching.set()
+		if self.watcher is not None:
+			self.watcher.join()
+			self.watcher = None
+
+	def listen(self,showFront=True,append=False,watch=True,watch_interval=5):
 		'''
 		Listen for changes in the table's geogrid and update all indicators accordingly. 
 		You can use the update_package method to see the object that will be posted to the table.
@@ -559,6 +877,10 @@ class Handler:
 			If True, it will open the front-end URL in a webbrowser at start.
 		append : boolean (dafault=False)
 			If True, it will append the new indicators to whatever is already there.
+		watch : boolean (default=True)
+			If True, indicators are reloaded when their models or configs change (see start_watcher).
+		watch_interval : float (default=5)
+			Seconds between checks of the watched files.
 		'''
 		if not self.quietly:
 			print('Table URL:',self.front_end_url)
@@ -571,6 +893,8 @@ class Handler:
 			print(self.update_package())
 		self.perform_update(append=append)
 
+		if watch:
+			self.start_watcher(interval=watch_interval)
 		if showFront:
 			webbrowser.open(self.front_end_url, new=2)
 		while True:
@@ -598,8 +922,12 @@ class Indicator:
 				self.name = kwargs[k]
 		if self.indicator_type in ['heatmap','access']:
 			self.viz_type = None
+		self.setup_args = args
+		self.setup_kwargs = kwargs
 		self.setup(*args,**kwargs)
-		self.load_module()
+		# prepare_reload builds new versions without loading them right away (see prepare_reload)
+		if not getattr(self,'_defer_load_module',False):
+			self.load_module()
 
 	def _transform_geogrid_data_to_df(self,geogrid_data):
 		'''
@@ -702,6 +1030,40 @@ class Indicator:
 	def setup(self):
 		pass
 
+	def watched_files(self):
+		'''
+		Returns the files (models, configs) the indicator depends on.
+		When the Handler watcher is running, the indicator is reloaded when any of them changes (see Handler.start_watcher).
+		'''
+		return ([self.model_path] if self.model_path is not None else [])
+
+	# attributes assigned by the Handler (see assign_geogrid_props) or by the user after the indicator is created
+	RELOAD_KEEP = ['types_def','int_types_def','geogrid_header','viz_type']
+
+	def prepare_reload(self,**kwargs):
+		'''
+		Builds a new version of the indicator from scratch, with the arguments it was created with, 
+		without modifying the indicator or sharing any state with it. Keyword arguments are passed to load_module.
+		Only the attributes in RELOAD_KEEP are carried over to the new version.
+		Returns the state of the new version, to be applied with apply_reload.
+		'''
+		cls = type(self)
+		new = cls.__new__(cls)
+		new._defer_load_module = True
+		new.__init__(*self.setup_args,**self.setup_kwargs)
+		del new._defer_load_module
+		for attr in self.RELOAD_KEEP:
+			if hasattr(self,attr):
+				setattr(new,attr,getattr(self,attr))
+		new.load_module(**kwargs)
+		return new.__dict__
+
+	def apply_reload(self,state):
+		'''
+		Swaps in the state returned by prepare_reload, replacing the whole state of the indicator.
+		'''
+		self.__dict__ = state
+
 	def load_module(self):
 		if self.model_path is not None:
 			self.pickled_model = joblib.load(self.model_path)
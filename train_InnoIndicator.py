@@ -7,16 +7,19 @@ import matplotlib.pyplot as plt
 from toolbox import Handler,Indicator
 from innovation_indicator import InnoIndicator
 from indicator_tools import DataLoader
+from model_registry import MODEL_REGISTRY
 
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.impute import SimpleImputer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder, PolynomialFeatures
-from sklearn.linear_model import LogisticRegression, Lasso, Ridge, LinearRegression
-from sklearn.model_selection import train_test_split, GridSearchCV, cross_val_predict
+from sklearn.linear_model import LogisticRegression, Lasso, Ridge, LinearRegression, lasso_path
+from sklearn.model_selection import train_test_split, GridSearchCV, cross_val_predict, KFold, LeaveOneOut
 from sklearn.decomposition import PCA
 from sklearn.base import TransformerMixin, BaseEstimator, clone
 from sklearn.metrics import r2_score
+from scipy import sparse
+from joblib import Parallel, delayed
 
 class FactorExtractor(TransformerMixin, BaseEstimator):
 	def __init__(self, factor):
@@ -36,30 +39,145 @@ class FactorExtractor(TransformerMixin, BaseEstimator):
 	def fit(self, *_):
 		return self
 
-def param_search(pipelines,X,Y):
+# Design matrices (output of the preprocessing steps of a pipeline) already computed, see design_matrix
+_DESIGN_CACHE = {}
+
+def design_matrix(pipeline,X):
+	'''
+	Returns the design matrix of the given pipeline: the output of all its steps but the last one, fitted on X.
+	Matrices are cached by preprocessing parameters and data, so pipelines that share the preprocessing 
+	(e.g. Ridge and Lasso pipelines of define_sks_pipeline) only compute it once.
+	'''
+	preprocessing = Pipeline(pipeline.steps[:-1])
+	key = (joblib.hash(clone(preprocessing)),joblib.hash(X))
+	if key not in _DESIGN_CACHE:
+		Z = clone(preprocessing).fit_transform(X)
+		if sparse.issparse(Z):
+			Z = Z.toarray()
+		_DESIGN_CACHE[key] = np.asarray(Z,dtype=float)
+	return _DESIGN_CACHE[key]
+
+def ridge_loo_predictions(Z,Y,alphas):
+	'''
+	Leave-one-out predictions of a Ridge regression (with intercept) on the design matrix Z for each alpha, 
+	computed in closed form from one SVD of the centered design matrix:
+		y_loo = y - (y - y_hat)/(1 - h), where h is the diagonal of the hat matrix.
+
+	Returns
+	-------
+	Y_pred : numpy array
+		Array of shape (len(Y), len(alphas)).
+	'''
+	n = len(Y)
+	Zc = Z-Z.mean(axis=0)
+	y_mean = Y.mean()
+	U,S,_ = np.linalg.svd(Zc,full_matrices=False)
+	UtY = U.T.dot(Y-y_mean)
+	Y_pred = np.zeros((n,len(alphas)))
+	for j,alpha in enumerate(alphas):
+		shrink = S**2/(S**2+alpha)
+		Y_hat = y_mean+U.dot(shrink*UtY)
+		h = 1./n+(U**2).dot(shrink)
+		Y_pred[:,j] = Y-(Y-Y_hat)/(1-h)
+	return Y_pred
+
+def _lasso_fold(Z,Y,train,test,alphas,max_iter):
+	'''
+	Fits the Lasso path (warm-started from the largest alpha) on the train rows and predicts the test rows.
+	Centering the train rows is equivalent to fitting the intercept.
+	'''
+	z_mean = Z[train].mean(axis=0)
+	y_mean = Y[train].mean()
+	_,coefs,_ = lasso_path(Z[train]-z_mean,Y[train]-y_mean,alphas=alphas,max_iter=max_iter)
+	return test,(Z[test]-z_mean).dot(coefs)+y_mean
+
+def lasso_cv_predictions(Z,Y,alphas,cv,max_iter=10000,n_jobs=-1):
+	'''
+	Cross validated predictions of a Lasso regression (with intercept) on the design matrix Z for each alpha.
+	Each fold fits the whole regularization path at once, and folds run in parallel.
+
+	Parameters
+	----------
+	cv : int or cross-validation generator
+		Number of folds (KFold, as GridSearchCV) or a generator with a split method.
+
+	Returns
+	-------
+	Y_pred : numpy array
+		Array of shape (len(Y), len(alphas)).
+	folds : list
+		Test indices of each fold.
+	'''
+	alphas = np.asarray(alphas,dtype=float)
+	order = np.argsort(alphas)[::-1]
+	cv = (KFold(n_splits=cv) if isinstance(cv,int) else cv)
+	results = Parallel(n_jobs=n_jobs)(delayed(_lasso_fold)(Z,Y,train,test,alphas[order],max_iter) for train,test in cv.split(Z))
+	Y_pred = np.zeros((len(Y),len(alphas)))
+	folds = []
+	for test,pred in results:
+		Y_pred[np.ix_(test,order)] = pred
+		folds.append(test)
+	return Y_pred,folds
+
+def param_search(pipelines,X,Y,fast=False,n_jobs=-1):
+	'''
+	Searches the best alpha of the Lasso and Ridge pipelines.
+	If fast=True, the preprocessing is fitted once on all the data (see design_matrix) instead of once per fold, 
+	the Ridge alphas are scored with the closed form leave-one-out (see ridge_loo_predictions) 
+	and the Lasso alphas with the same folds as GridSearchCV using warm-started paths (see lasso_cv_predictions).
+	'''
 	best_params = {}
+	if fast:
+		Y = np.asarray(Y)
+		alphas = np.logspace(-5,0,6)
+		Z = design_matrix(pipelines['Lasso'],X)
+		Y_pred,folds = lasso_cv_predictions(Z,Y,alphas,cv=int(0.1*len(Y)),max_iter=pipelines['Lasso'].steps[-1][1].max_iter,n_jobs=n_jobs)
+		# same score as GridSearchCV: mean R2 over the folds
+		scores = [np.mean([r2_score(Y[test],Y_pred[test,j]) for test in folds]) for j in range(len(alphas))]
+		best_params['lasso__alpha'] = alphas[int(np.argmax(scores))]
+
+		Z = design_matrix(pipelines['Ridge'],X)
+		Y_pred = ridge_loo_predictions(Z,Y,alphas)
+		scores = [r2_score(Y,Y_pred[:,j]) for j in range(len(alphas))]
+		best_params['ridge__alpha'] = alphas[int(np.argmax(scores))]
+		return best_params
 
 	param_grid = {'lasso__alpha': np.logspace(-5,0,6)}
-	search = GridSearchCV(pipelines['Lasso'], param_grid, n_jobs=-1,cv=int(0.1*len(Y)))
+	search = GridSearchCV(pipelines['Lasso'], param_grid, n_jobs=n_jobs,cv=int(0.1*len(Y)))
 	search.fit(X,Y)
 	best_params = {**best_params,**search.best_params_}
 
 	param_grid = {'ridge__alpha': np.logspace(-5,0,6),}
-	search = GridSearchCV(pipelines['Ridge'], param_grid, n_jobs=-1,cv=int(0.1*len(Y)))
+	search = GridSearchCV(pipelines['Ridge'], param_grid, n_jobs=n_jobs,cv=int(0.1*len(Y)))
 	search.fit(X,Y)
 	best_params = {**best_params,**search.best_params_}
 	return best_params
 
 
-def CV_r2(model,X,Y):
-	Y_pred = cross_val_predict(model,X,Y,cv=len(Y))
+def CV_predict(model,X,Y,fast=False,n_jobs=-1):
+	'''
+	Leave-one-out predictions of the given pipeline.
+	If fast=True, the preprocessing is fitted once on all the data (see design_matrix); 
+	Ridge predictions are then computed in closed form and Lasso folds are fitted in parallel on the cached design matrix.
+	'''
+	Y = np.asarray(Y)
+	estimator = model.steps[-1][1]
+	if fast and isinstance(estimator,(Ridge,Lasso)):
+		Z = design_matrix(model,X)
+		if isinstance(estimator,Ridge):
+			return ridge_loo_predictions(Z,Y,[estimator.alpha])[:,0]
+		return lasso_cv_predictions(Z,Y,[estimator.alpha],cv=LeaveOneOut(),max_iter=estimator.max_iter,n_jobs=n_jobs)[0][:,0]
+	return cross_val_predict(model,X,Y,cv=len(Y),n_jobs=n_jobs)
+
+def CV_r2(model,X,Y,fast=False,n_jobs=-1):
+	Y_pred = CV_predict(model,X,Y,fast=fast,n_jobs=n_jobs)
 	return r2_score(Y, Y_pred)
 
-def CV_test_model(test_pipelines,X,Y,draw_scatter=False,find_best_params=False):
+def CV_test_model(test_pipelines,X,Y,draw_scatter=False,find_best_params=False,fast=False,n_jobs=-1):
 	for model in test_pipelines.values():
 		model.fit(X, Y)
 	if find_best_params:
-		best_params = param_search(test_pipelines,X,Y)
+		best_params = param_search(test_pipelines,X,Y,fast=fast,n_jobs=n_jobs)
 		print('Best Parameters:',best_params)
 
 	if draw_scatter:
@@ -68,7 +186,7 @@ def CV_test_model(test_pipelines,X,Y,draw_scatter=False,find_best_params=False):
 		for k in test_pipelines:
 			model = test_pipelines[k]
 			print('LeaveOneOut cross validation score {}:'.format(k))
-			Y_pred = cross_val_predict(model,X,Y,cv=len(Y))
+			Y_pred = CV_predict(model,X,Y,fast=fast,n_jobs=n_jobs)
 			print('\tR2 score:',print(r2_score(Y, Y_pred)))
 			plt.subplot(1,len(test_pipelines),i)
 			i+=1
@@ -77,7 +195,7 @@ def CV_test_model(test_pipelines,X,Y,draw_scatter=False,find_best_params=False):
 		for k in test_pipelines:
 			model = test_pipelines[k]
 			print('LeaveOneOut cross validation score {}:'.format(k))
-			print('\tR2 score:',CV_r2(model,X,Y))
+			print('\tR2 score:',CV_r2(model,X,Y,fast=fast,n_jobs=n_jobs))
 
 
 def define_sks_pipeline(feature_list):
@@ -144,7 +262,7 @@ def define_kno_pipeline(feature_list):
 	return pipeline_r,pipeline_l
 
 
-def train_sks_indicator(data,sks_model_path,test_model=True,draw_scatter=False,find_best_params=False):
+def train_sks_indicator(data,sks_model_path,test_model=True,draw_scatter=False,find_best_params=False,fast=False):
 	msa_skills = data.msa_skills
 	skills_columns = msa_skills.drop('GEOID',1).columns.tolist()
 
@@ -154,7 +272,7 @@ def train_sks_indicator(data,sks_model_path,test_model=True,draw_scatter=False,f
 	    df[c] = df[c]/df['TOT_SKS']
 
 	df = pd.merge(df,data.nPats,how='inner')
-	df = pd.merge(df,data.emp_msa.groupby('GEOID').sum().reset_index())
+	df = pd.merge(df,data.emp_msa.groupby('GEOID',observed=True)[['TOT_EMP']].sum().reset_index())
 	df = df.assign(pats_pc = df['nPats']/df['pop'])
 
 	X = df.drop(['GEOID','nPats','pop','pats_pc','TOT_EMP','TOT_SKS'],1)
@@ -169,13 +287,13 @@ def train_sks_indicator(data,sks_model_path,test_model=True,draw_scatter=False,f
 			'Lasso': clone(pipeline_l)
 		}
 		print('Testing SKS indicators')
-		CV_test_model(test_pipelines,X,Y,draw_scatter=draw_scatter,find_best_params=find_best_params)
+		CV_test_model(test_pipelines,X,Y,draw_scatter=draw_scatter,find_best_params=find_best_params,fast=fast)
 
 	pipeline_l.fit(X,Y)
-	joblib.dump(pipeline_l,sks_model_path)
+	MODEL_REGISTRY.dump(pipeline_l,sks_model_path,kind='pipeline')
 
 
-def train_kno_indicator(data,kno_model_path,test_model=True,draw_scatter=False,find_best_params=False):
+def train_kno_indicator(data,kno_model_path,test_model=True,draw_scatter=False,find_best_params=False,fast=False):
 
 	zip_knowledge = data.zip_knowledge
 	knowledge_columns = zip_knowledge.drop('ZCTA5CE10',1).columns.tolist()
@@ -185,7 +303,7 @@ def train_kno_indicator(data,kno_model_path,test_model=True,draw_scatter=False,f
 	for c in knowledge_columns:
 	    df[c] = df[c]/df['TOT_KNO']
 
-	df = pd.merge(df,data.emp_zip.groupby('ZCTA5CE10').sum()[['TOT_EMP']].reset_index())
+	df = pd.merge(df,data.emp_zip.groupby('ZCTA5CE10',observed=True)[['TOT_EMP']].sum().reset_index())
 	df = pd.merge(df,data.emp_zip[['ZCTA5CE10','CBSAFP']].drop_duplicates())
 	df = df.assign(ZCTA5CE10=('000'+df['ZCTA5CE10'].astype(str)).str[-5:])
 	df = pd.merge(df,data.RECPI[['zipcode','state','RECPI','EQI','SFR']].rename(columns={'zipcode':'ZCTA5CE10'}))
@@ -208,10 +326,10 @@ def train_kno_indicator(data,kno_model_path,test_model=True,draw_scatter=False,f
 			'Lasso': clone(pipeline_l)
 		}
 		print('Testing KNO indicators')
-		CV_test_model(test_pipelines,X,Y,draw_scatter=draw_scatter,find_best_params=find_best_params)
+		CV_test_model(test_pipelines,X,Y,draw_scatter=draw_scatter,find_best_params=find_best_params,fast=fast)
 
 	pipeline_l.fit(X,Y)
-	joblib.dump(pipeline_l,kno_model_path)
+	MODEL_REGISTRY.dump(pipeline_l,kno_model_path,kind='pipeline')
 
 
 def main():